@@ -1,4 +1,7 @@
 import logging
+import os
+import random
+import numpy as np
 import torch
 import math
 import time
@@ -6,9 +9,14 @@ from tracker import Diary, DiaryPage, InfoMaxStats
 from defaultparams import DefaultParams
 from adversarial import Adversarial
 from model_interface import ModelInterface
+from subspace import get_sampler
+from budget import BudgetExhausted
 
 
 class Attack:
+    # Per-image attributes changed by the iterations, saved in checkpoints. Subclasses add their own.
+    CHECKPOINT_ATTRIBUTES = ('prev_t', 'prev_s', 'prev_e')
+
     def __init__(self, model_interface, data_shape, device=None, params: DefaultParams = None):
         self.model_interface: ModelInterface = model_interface
         self.targeted = params.targeted
@@ -27,6 +35,21 @@ class Attack:
         self.prior_frac = params.prior_frac
         self.queries = params.queries
         self.grad_queries = params.grad_queries
+        self.regenerate_directions = params.regenerate_directions
+        self.regen_chunk_size = params.regen_chunk_size
+        self.sequential_grad = params.sequential_grad
+        self.sequential_z = params.sequential_z
+        self.search_arity = params.search_arity  # k of the k-ary binary search (k - 1 points tested per round)
+        if self.search_arity < 2:
+            raise RuntimeError(f'search_arity must be at least 2, got {self.search_arity}')
+        self.stop_window = params.stop_window
+        self.stop_rel_improvement = params.stop_rel_improvement
+        self.max_model_calls = params.max_model_calls
+        self.target_distance = params.target_distance
+        # Checkpoint of the attack state every checkpoint_every iterations, one file per image in checkpoint_dir
+        self.checkpoint_every = params.checkpoint_every
+        self.checkpoint_dir = params.checkpoint_dir
+        self.checkpoint_path = None
 
         # Set constraint based on the distance.
         if params.distance in ['MSE', 'L2', 'l2']:
@@ -37,6 +60,9 @@ class Attack:
         # Set binary search threshold.
         self.shape = data_shape
         self.d = int(torch.prod(torch.tensor(self.shape)))
+        # Random directions are drawn in a subspace of dimension d_eff (d_eff = d for the full pixel space)
+        self.sampler = get_sampler(params.sampling_basis, self.shape, params.subspace_ratio, params.basis_path, device)
+        self.d_eff = self.d if self.sampler is None else self.sampler.dim
         self.grid_size = params.grid_size[params.dataset]
         if self.constraint == "l2":
             self.theta_det = self.gamma / (math.sqrt(self.d) * self.d)
@@ -44,19 +70,45 @@ class Attack:
         else:
             self.theta_det = self.gamma / (self.d * self.d)
 
-    def attack(self, images, labels, starts=None, targeted_labels=None, iterations=64):
+    def attack(self, images, labels, starts=None, targeted_labels=None, iterations=64, store=None):
+        """
+        :param store: optional ShardedResultStore. Every diary is written to it as soon as its image is done instead of
+                      being kept in memory, and images already in the store are skipped (resume).
+        """
         raw_results = []
         distances = []
         for i, (image, label) in enumerate(zip(images, labels)):
+            if store is not None and i in store:
+                continue
+            if self.model_interface.budget.run_exhausted():
+                logging.warning("Run query budget exhausted, skipping remaining {} images".format(len(images) - i))
+                break
             logging.warning("Attacking Image: {}".format(i))
             a = Adversarial(image=image, label=label, targeted_label=targeted_labels[i], device=self.device)
             if starts is not None:
                 a.set_starting_point(starts[i], self.bounds)
             self.reset_variables(a)
-            self.attack_one(iterations)
-            if len(self.diary.iterations) > 0:
-                distances.append(a.distance)
-            raw_results.append(self.diary)
+            checkpoint = None
+            if self.checkpoint_dir is not None and self.checkpoint_every is not None:
+                self.checkpoint_path = os.path.join(self.checkpoint_dir, 'image_{}.pt'.format(i))
+                if os.path.exists(self.checkpoint_path):
+                    checkpoint = self.load_checkpoint(self.checkpoint_path)
+                    logging.warning('Resuming image {} after iteration {}'.format(i, checkpoint['step']))
+            with self.model_interface.profiler.trace('image_{}'.format(i)):
+                self.attack_one(iterations, checkpoint=checkpoint)
+            distance = a.distance if len(self.diary.iterations) > 0 else None
+            if distance is not None:
+                distances.append(distance)
+            if store is None:
+                raw_results.append(self.diary)
+            else:
+                store.append(i, self.diary, distance)
+            # The checkpoint is only removed once the result is stored, a crash in between resumes from it
+            if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            self.checkpoint_path = None
+        if store is not None:
+            distances = store.distances()
         median = torch.median(torch.tensor(distances))
         return median, raw_results
 
@@ -97,9 +149,37 @@ class Attack:
         """
         raise NotImplementedError
 
-    def attack_one(self, iterations=64):
+    def attack_one(self, iterations=64, initial_projection=None, checkpoint=None):
+        """
+        :param initial_projection: optional result of bin_search_step(original, starting point) computed outside of the
+                                   attack (e.g. by MultiTargetAttack), in which case the initial binary search is skipped
+        :param checkpoint: optional state returned by load_checkpoint, the attack continues after its last iteration
+        """
+        budget = self.model_interface.budget
+        try:
+            self.run_iterations(iterations, initial_projection, checkpoint)
+        except BudgetExhausted as e:
+            logging.warning('Query budget exhausted, keeping best adversarial found so far ({})'.format(e))
+            self.diary.stop_reason = 'query_budget'
+        if self.diary.stop_reason is None:
+            self.diary.stop_reason = 'iterations'
+        budget.set_phase('other')
+        self.model_interface.profiler.reset()
+        self.diary.budget = budget.report()
+        return self.diary
+
+    def run_iterations(self, iterations, initial_projection=None, checkpoint=None):
+        budget = self.model_interface.budget
+        profiler = self.model_interface.profiler
+        profiler.reset()
+        if checkpoint is not None:
+            last_step, perturbed, dist_post_update, estimates, dist = self.restore_checkpoint(checkpoint)
+            original = self.a.unperturbed
+            return self.iterate(original, perturbed, dist_post_update, estimates, dist, last_step + 1, iterations)
         self.diary.epoch_start = time.time()
 
+        budget.set_phase('initialization')
+        profiler.set_phase('initialization')
         self.perform_initialization()
         original, perturbed = self.a.unperturbed, self.a.perturbed
 
@@ -107,16 +187,27 @@ class Attack:
         self.diary.initialization_calls = self.model_interface.model_calls
         self.diary.epoch_initialization = time.time()
 
-        perturbed, dist_post_update, estimates = self.bin_search_step(original, perturbed)
+        budget.set_phase('bin_search')
+        profiler.set_phase('bin_search')
+        if initial_projection is None:
+            perturbed, dist_post_update, estimates = self.bin_search_step(original, perturbed)
+        else:
+            perturbed, dist_post_update, estimates = initial_projection
         if estimates is not None:
             self.diary.init_infomax = InfoMaxStats(estimates['s'], estimates['t'], None, estimates['e'], estimates['n'])
         self.diary.epoch_initial_bin_search = time.time()
         self.diary.initial_projection = perturbed
         self.diary.calls_initial_bin_search = self.model_interface.model_calls
+        self.diary.profile = profiler.collect()
 
         dist = self.compute_distance(perturbed, original)
-        distance = self.a.distance
-        for step in range(1, iterations + 1):
+        self.iterate(original, perturbed, dist_post_update, estimates, dist, 1, iterations)
+
+    def iterate(self, original, perturbed, dist_post_update, estimates, dist, first_step, iterations):
+        """ Runs the iterations first_step..iterations starting from the boundary point perturbed """
+        budget = self.model_interface.budget
+        profiler = self.model_interface.profiler
+        for step in range(first_step, iterations + 1):
             self.step = step
             page = DiaryPage()
             page.time.start = time.time()
@@ -124,6 +215,8 @@ class Attack:
 
             delta = self.select_delta(dist_post_update, step)
             num_evals_det = int(min([self.initial_num_evals * math.sqrt(step), self.max_num_evals]))
+            budget.set_phase('approx_grad')
+            profiler.set_phase('approx_grad')
             gradf = self.gradient_approximation_step(perturbed, num_evals_det, delta, dist_post_update,
                                                      estimates, page)
             page.num_eval_det = num_evals_det
@@ -136,11 +229,14 @@ class Attack:
             update = gradf if self.constraint == 'l2' else torch.sign(gradf)
 
             # find step size.
+            budget.set_phase('step_search')
+            profiler.set_phase('step_search')
             epsilon = self.geometric_progression_for_stepsize(perturbed, update, dist, step, original)
             page.time.step_search = time.time()
             page.calls.step_search = self.model_interface.model_calls
 
             # Update the sample.
+            profiler.set_phase('opposite')
             perturbed = self.make_gradient_step(epsilon, perturbed, update)
             page.approx_grad = perturbed
 
@@ -150,6 +246,8 @@ class Attack:
             page.opposite = perturbed
 
             # Binary search to return to the boundary.
+            budget.set_phase('bin_search')
+            profiler.set_phase('bin_search')
             perturbed, dist_post_update, estimates = self.bin_search_step(original, perturbed, page, estimates, step)
             page.time.bin_search = time.time()
             page.calls.bin_search = self.model_interface.model_calls
@@ -165,10 +263,94 @@ class Attack:
 
             page.time.end = time.time()
             page.calls.end = self.model_interface.model_calls
+            page.profile = profiler.collect()
             page.perturbed = self.a.perturbed
             page.distance = self.a.distance
             self.diary.iterations.append(page)
-        return self.diary
+
+            stop_reason = self.check_stopping_criteria()
+            if stop_reason is not None:
+                logging.info('Stopping after iteration {}: {}'.format(step, stop_reason))
+                self.diary.stop_reason = stop_reason
+                break
+            if self.checkpoint_path is not None and step % self.checkpoint_every == 0:
+                self.save_checkpoint(step, perturbed, dist_post_update, estimates, dist)
+
+    def save_checkpoint(self, step, perturbed, dist_post_update, estimates, dist):
+        """
+        Saves everything needed to continue the attack of the current image after iteration `step`: the loop state,
+        the per-image attributes, the best adversarial, the model calls and budget, the query log, the partial diary
+        and the random generators. The file is written to a temporary path first, so a crash keeps the last checkpoint.
+        """
+        state = {
+            'step': step,
+            'perturbed': perturbed,
+            'dist_post_update': dist_post_update,
+            'estimates': estimates,
+            'dist': dist,
+            'attributes': {name: getattr(self, name) for name in self.CHECKPOINT_ATTRIBUTES},
+            'adversarial': {'perturbed': self.a.perturbed, 'distance': self.a.distance},
+            'model_calls': self.model_interface.model_calls,
+            'budget': self.model_interface.budget.state_dict(),
+            'diary': self.diary,
+            'rng': {'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                    'random': random.getstate(),
+                    'numpy': np.random.get_state()},
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        tmp_path = self.checkpoint_path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    @staticmethod
+    def load_checkpoint(path):
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+    def restore_checkpoint(self, state):
+        """
+        Puts the attack (already reset on the same image) back in the state saved by save_checkpoint
+        :return: (step, perturbed, dist_post_update, estimates, dist) to continue the iterations from
+        """
+        def to_device(value):
+            if torch.is_tensor(value):
+                return value.to(self.device) if self.device is not None else value
+            if isinstance(value, dict):
+                return {k: to_device(v) for k, v in value.items()}
+            return value
+
+        for name, value in state['attributes'].items():
+            setattr(self, name, to_device(value))
+        self.a.perturbed = to_device(state['adversarial']['perturbed'])
+        self.a.distance = state['adversarial']['distance']
+        self.model_interface.model_calls = state['model_calls']
+        self.model_interface.budget.load_state_dict(state['budget'])
+        self.diary = state['diary']
+        rng = state['rng']
+        torch.set_rng_state(rng['torch'])
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        random.setstate(rng['random'])
+        np.random.set_state(rng['numpy'])
+        return (state['step'], to_device(state['perturbed']), state['dist_post_update'], to_device(state['estimates']),
+                state['dist'])
+
+    def check_stopping_criteria(self):
+        """
+        Decides whether attack_one can stop before running all the iterations
+        :return: None to continue, otherwise the reason for stopping ('target_distance', 'query_budget' or 'plateau')
+        """
+        pages = self.diary.iterations
+        distance = pages[-1].distance
+        if self.target_distance is not None and distance <= self.target_distance:
+            return 'target_distance'
+        if self.max_model_calls is not None and self.model_interface.model_calls >= self.max_model_calls:
+            return 'query_budget'
+        if self.stop_window is not None and len(pages) > self.stop_window:
+            previous = pages[-1 - self.stop_window].distance
+            if previous > 0 and (previous - distance) / previous < self.stop_rel_improvement:
+                return 'plateau'
+        return None
 
     def make_gradient_step(self, epsilon, perturbed, update):
         perturbed = torch.clamp(perturbed + epsilon * update, self.clip_min, self.clip_max)
@@ -176,6 +358,7 @@ class Attack:
 
     def reset_variables(self, a):
         self.model_interface.model_calls = 0
+        self.model_interface.budget.start_image()
         self.a: Adversarial = a
         self.prev_t = None
         self.prev_s = None
@@ -200,27 +383,143 @@ class Attack:
             if num_evals > 1e4:
                 return
 
-    def generate_random_vectors(self, batch_size):
+    def generate_random_vectors(self, batch_size, generator=None, out=None):
+        """
+            Samples unit-norm random directions. When `out` is given, the directions are written into it in-place.
+        """
         noise_shape = [int(batch_size)] + list(self.shape)
-        if self.constraint == "l2":
-            rv = torch.randn(size=noise_shape, device=self.device)
+        if self.sampler is not None:
+            rv = self.sampler.sample(batch_size, self.constraint, generator)
+            if out is not None:
+                rv = out.copy_(rv)
+        elif self.constraint == "l2":
+            rv = torch.randn(size=noise_shape, generator=generator, out=out, device=self.device)
         elif self.constraint == "linf":
-            rv = 2 * torch.rand(size=noise_shape) - 1  # random vector between -1 and +1
+            # random vector between -1 and +1
+            rv = torch.rand(size=noise_shape, generator=generator, out=out, device=self.device).mul_(2).sub_(1)
         else:
             raise RuntimeError("Unknown constraint metric: {}".format(self.constraint))
         axis = tuple(range(1, 1 + len(self.shape)))
-        rv = rv / torch.sqrt(torch.sum(rv ** 2, dim=axis, keepdim=True))
+        rv = rv.div_(torch.sqrt(torch.sum(rv ** 2, dim=axis, keepdim=True)))
         return rv
 
-    def _gradient_estimator(self, sample, num_evals, delta):
+    def _perturb_from_seed(self, sample, delta, seed, batch_size, buffer, generator):
+        """
+            Fills `buffer` with the clamped points sample + delta * rv, where rv is drawn from the counter-based `seed`.
+            Calling it twice with the same seed gives back the same points.
+        """
+        generator.manual_seed(seed)
+        perturbed = self.generate_random_vectors(batch_size, generator=generator, out=buffer[:batch_size])
+        perturbed = perturbed.mul_(delta).add_(sample)
+        return torch.clamp(perturbed, self.clip_min, self.clip_max, out=perturbed)
+
+    def _regenerated_sum_directions(self, sample, num_rvs, delta, decision_fn, queries, target_cos=None):
+        """
+            Memory-lean version of the accumulation loop in _gradient_estimator.
+            Directions are queried in chunks of `regen_chunk_size` through one preallocated buffer and are never kept
+            alive for a whole batch. Once the decisions of a batch are known, each chunk is regenerated from its
+            counter-based seed and its contribution is added to sum_directions.
+            :param decision_fn: decision_by_averaging or decision_by_polling
+            :param queries: number of queries summed up in each decision
+            :param target_cos: if not None, stop after the first batch at which the estimate reaches target_cos
+            :return: (sum_directions, number of directions used)
+        """
+        chunk_size = min(self.regen_chunk_size, self.batch_size)
+        device = self.device if self.device is not None else 'cpu'
+        generator = torch.Generator(device=device)
+        base_seed = int(torch.randint(2 ** 62, size=(1,)))
+        buffer = torch.empty([chunk_size] + list(self.shape), device=self.device)
+        flat_sample = sample.flatten()
+        sum_halves = torch.zeros([2, self.d], device=self.device)
+        num_batchs = int(math.ceil(num_rvs * 1.0 / self.batch_size))
+        counter = 0
+        for j in range(num_batchs):
+            batch_size = min(self.batch_size, num_rvs - j * self.batch_size)
+            chunks = [(base_seed + counter + c, min(chunk_size, batch_size - c)) for c in range(0, batch_size, chunk_size)]
+            counter += batch_size
+            decisions = torch.cat([decision_fn(self._perturb_from_seed(sample, delta, seed, n, buffer, generator))
+                                   for seed, n in chunks])
+            # Map (0, q) -> (-q, +q)
+            fval = 2 * decisions.float() - queries
+            # Baseline subtraction (when fval differs)
+            if target_cos is not None:
+                vals = self._split_half_baseline(fval, queries)
+            elif torch.abs(torch.mean(fval / queries)) == 1.0:
+                vals = fval
+            else:
+                vals = fval - torch.mean(fval)
+            offset = 0
+            for seed, n in chunks:
+                perturbed = self._perturb_from_seed(sample, delta, seed, n, buffer, generator)
+                rv = perturbed.view(n, -1).sub_(flat_sample).div_(delta)
+                chunk_vals = vals[offset:offset + n]
+                # Even samples of the batch go to the first half, odd ones to the second
+                for h in range(2):
+                    k = (h + offset) % 2
+                    sum_halves[h].add_(chunk_vals[k::2] @ rv[k::2])
+                offset += n
+            if target_cos is not None and self._reached_target_cos(sum_halves, target_cos):
+                break
+        return sum_halves.sum(dim=0).view(self.shape), counter
+
+    def _split_half_baseline(self, fval, queries):
+        """
+            Baseline subtraction done separately on even and odd samples, so that the two halves of the sequential
+            estimator stay independent. A shared baseline makes them anti-correlated whenever clamping gives the
+            directions a non-zero mean.
+        """
+        vals = fval.clone()
+        for h in range(2):
+            half = fval[h::2]
+            if len(half) > 0 and torch.abs(torch.mean(half / queries)) != 1.0:
+                vals[h::2] = half - torch.mean(half)
+        return vals
+
+    def _reached_target_cos(self, sum_halves, target_cos):
+        """
+            Split-half convergence test of the sequential gradient estimator.
+            If each half has an expected cosine c with the true gradient, the cosine between the two halves is about
+            c^2 = 1 / (1 + 2K/n), while the full estimate has cos = 1 / sqrt(1 + K/n) (see infomax.get_cos_from_n).
+            Writing each half as c g + sqrt(1 - c^2) u with an isotropic noise direction u, the cosine between halves
+            has variance (1 - c^4) / d_eff at the current n. It is lowered by `sequential_z` of these standard
+            deviations, with c^2 estimated by the cosine itself, so that an early, lucky batch does not stop the
+            estimation.
+        """
+        cos_halves = float(torch.nn.functional.cosine_similarity(sum_halves[0].flatten(), sum_halves[1].flatten(),
+                                                                 dim=0))
+        c2 = min(max(cos_halves, 0.), 1.)
+        cos_halves = cos_halves - self.sequential_z * math.sqrt((1. - c2 ** 2) / self.d_eff)
+        if cos_halves <= 0:
+            return False
+        cos_full = 1. / math.sqrt(1. + (1. / cos_halves - 1.) / 2.)
+        return cos_full >= float(target_cos)
+
+    def affordable_directions(self, num_rvs, cost):
+        """
+            Shrinks the number of fresh directions (each costing `cost` queries) to what the query budget still allows
+        """
+        num_rvs = int(min(num_rvs, self.model_interface.budget.remaining() // cost))
+        if num_rvs < 1:
+            raise BudgetExhausted('No query left for gradient estimation')
+        return num_rvs
+
+    def _gradient_estimator(self, sample, num_evals, delta, target_cos=None):
         """
             Computes an approximation by querying every point `grad_queries` times
             Result is accumulated by doing averaging
+            If target_cos is given, sampling stops as soon as the estimate is expected to reach it (sequential mode)
         """
         # Generate random vectors.
-        num_rvs = int(num_evals/self.grad_queries)
+        num_rvs = self.affordable_directions(int(num_evals/self.grad_queries), self.grad_queries)
+        if self.regenerate_directions:
+            sum_directions, num_rvs = self._regenerated_sum_directions(
+                sample, num_rvs, delta, self.decision_by_averaging, self.grad_queries, target_cos)
+            gradf = sum_directions / (num_rvs*self.grad_queries)
+            return gradf / torch.norm(gradf)
         sum_directions = torch.zeros(self.shape, device=self.device)
+        sum_halves = torch.zeros([2] + list(self.shape), device=self.device)
         num_batchs = int(math.ceil(num_rvs * 1.0 / self.batch_size))
+        num_used = 0
         for j in range(num_batchs):
             batch_size = min(self.batch_size, num_rvs - j*self.batch_size)
             rv = self.generate_random_vectors(batch_size)
@@ -231,14 +530,23 @@ class Attack:
             decision_shape = [len(decisions)] + [1] * len(self.shape)
             # Map (0, 1) -> (-1, +1)
             fval = 2 * decisions.view(decision_shape) - self.grad_queries
-            # Baseline subtraction (when fval differs)
-            if torch.abs(torch.mean(fval/self.grad_queries)) == 1.0:
-                vals = fval
-            else:
-                vals = fval - torch.mean(fval)
-            sum_directions = sum_directions + torch.sum(vals * rv, dim=0)
+            num_used += batch_size
+            if target_cos is None:
+                # Baseline subtraction (when fval differs)
+                if torch.abs(torch.mean(fval/self.grad_queries)) == 1.0:
+                    vals = fval
+                else:
+                    vals = fval - torch.mean(fval)
+                sum_directions = sum_directions + torch.sum(vals * rv, dim=0)
+                continue
+            vals = self._split_half_baseline(fval, self.grad_queries)
+            sum_halves[0] += torch.sum(vals[0::2] * rv[0::2], dim=0)
+            sum_halves[1] += torch.sum(vals[1::2] * rv[1::2], dim=0)
+            if self._reached_target_cos(sum_halves, target_cos):
+                break
+        sum_directions = sum_directions + sum_halves.sum(dim=0)
         # Get the gradient direction.
-        gradf = sum_directions / (num_rvs*self.grad_queries)
+        gradf = sum_directions / (num_used*self.grad_queries)
         gradf = gradf / torch.norm(gradf)
         return gradf
 
@@ -251,6 +559,30 @@ class Attack:
         decisions = decisions.sum(dim=1)
         return decisions
 
+    def kary_search_points(self, lows, highs):
+        """
+            k-1 evenly spaced points strictly between lows and highs (the midpoint when k = 2)
+            :return: tensor of shape [len(lows), k-1]
+        """
+        k = self.search_arity
+        fractions = torch.arange(1, k, device=lows.device, dtype=lows.dtype)
+        return (lows[:, None] * (k - fractions[None, :]) + highs[:, None] * fractions[None, :]) / k
+
+    def kary_search_update(self, lows, highs, mids, decisions):
+        """
+            Narrows every [low, high] to the sub-interval in which the decision first becomes adversarial
+            :param mids: points returned by kary_search_points, shape [len(lows), k-1]
+            :param decisions: shape [len(lows), k-1], 1 where the point at mids is adversarial
+        """
+        adversarial = decisions == 1
+        found = adversarial.any(dim=1)
+        first = torch.argmax(adversarial.int(), dim=1)  # index of first adversarial point (0 if there is none)
+        rows = torch.arange(len(lows), device=lows.device)
+        below = torch.where(first > 0, mids[rows, (first - 1).clamp(min=0)], lows)
+        new_highs = torch.where(found, mids[rows, first], highs)
+        new_lows = torch.where(found, below, mids[:, -1])
+        return new_lows, new_highs
+
     def geometric_progression_for_stepsize(self, x, update, dist, current_iteration, original=None):
         """
             Decides the appropriate step-size in the estimated gradient direction
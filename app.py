@@ -2,6 +2,7 @@ import argparse
 import logging
 import os
 import torch
+import shutil
 import time
 from datetime import datetime
 from defaultparams import DefaultParams
@@ -11,15 +12,26 @@ from hopskip import HopSkipJump, HopSkipJumpRepeated, HopSkipJumpRepeatedWithPSJ
 from img_utils import get_sample, read_image, get_samples, get_shape, get_device, find_adversarial_images, get_samples_for_cropping
 from model_factory import get_model, get_models_from_file
 from model_interface import ModelInterface
+from budget import QueryBudget
+from multi_target import MultiTargetAttack
+from result_store import ShardedResultStore
+from profiler import Profiler
 
 logging.root.setLevel(logging.WARNING)
 OUT_DIR = 'thesis'
+# Parameters that do not change the results of the images already in the store: a run may resume with other values
+# (the selection of n images is a prefix of any larger one, so num_samples can grow)
+RESUME_IGNORED_PARAMS = ('resume', 'experiment_name', 'num_samples', 'checkpoint_every', 'checkpoint_dir', 'profile',
+                         'profile_trace_dir')
 parser = argparse.ArgumentParser()
 
 feature_parser = parser.add_mutually_exclusive_group(required=False)
 feature_parser.add_argument('--targeted', dest='targeted', action='store_true')
 feature_parser.add_argument('--no-targeted', dest='targeted', action='store_false')
 parser.set_defaults(targeted=False)
+parser.add_argument('--all_targets', action='store_true',
+                    help="(Optional) With --targeted, attack every image towards all the other labels "
+                    "(queries of initialization and first binary search are shared between targets)")
 
 
 parser.add_argument("-d", "--dataset", type=str,
@@ -64,12 +76,67 @@ parser.add_argument("-dr", "--drop_rate", type=float, default=0.,
                     help="(Optional) rate for dropout noise")
 parser.add_argument("-ef", "--eval_factor", type=int, default=1,
                     help="(Optional) Multiply number of queries in grad step by eval_factor")
+parser.add_argument("-rd", "--regenerate_directions", action='store_true',
+                    help="(Optional) Regenerate random directions from counter-based seeds in grad step "
+                    "instead of keeping whole batches in memory")
+parser.add_argument("-rcs", "--regen_chunk_size", type=int, default=64,
+                    help="(Optional) Number of directions kept in memory at once with --regenerate_directions")
+parser.add_argument("-sb", "--sampling_basis", type=str, default="full",
+                    help="(Optional) Subspace for random directions in grad step. supported: full, dct, resize, custom")
+parser.add_argument("-sr", "--subspace_ratio", type=float, default=0.25,
+                    help="(Optional) Fraction of height and width kept by the dct and resize sampling bases")
+parser.add_argument("-bp", "--basis_path", type=str, default=None,
+                    help="(Optional) Path to a [k, d] tensor with orthonormal rows for the custom sampling basis")
+parser.add_argument("-sg", "--sequential_grad", action='store_true',
+                    help="(Optional) Stop sampling in PSJ grad step once the target cosine is reached")
+parser.add_argument("-sz", "--sequential_z", type=float, default=1.0,
+                    help="(Optional) Confidence margin (in std devs) of the sequential grad step stopping test")
+parser.add_argument("-ka", "--search_arity", type=int, default=2,
+                    help="(Optional) Test k-1 points per round of binary search (k=2 is plain binary search)")
+parser.add_argument("-ss", "--stepsize_search", type=str, default="fixed",
+                    help="(Optional) Step-size search of HSJ attacks. supported: fixed, geometric")
+parser.add_argument("-sl", "--stepsize_ladder", type=int, default=10,
+                    help="(Optional) Number of halvings evaluated together by the geometric step-size search")
+parser.add_argument("-see", "--stepsize_early_exit", action='store_true',
+                    help="(Optional) Try the largest step-size alone before evaluating the whole ladder")
+parser.add_argument("-sw", "--stop_window", type=int, default=None,
+                    help="(Optional) Stop attacking an image when distance plateaus over this many iterations")
+parser.add_argument("-sri", "--stop_rel_improvement", type=float, default=0.01,
+                    help="(Optional) Relative improvement over the stop window below which distance has plateaued")
+parser.add_argument("-mmc", "--max_model_calls", type=int, default=None,
+                    help="(Optional) Stop attacking an image after this many model calls")
+parser.add_argument("-td", "--target_distance", type=float, default=None,
+                    help="(Optional) Stop attacking an image once its distance reaches this value")
+parser.add_argument("-qb", "--query_budget", type=int, default=None,
+                    help="(Optional) Hard limit on model calls per image")
+parser.add_argument("-qbs", "--query_budget_shares", type=str, default=None,
+                    help="(Optional) Share of the per-image budget per phase, e.g. bin_search:0.3,approx_grad:0.6")
+parser.add_argument("-rqb", "--run_query_budget", type=int, default=None,
+                    help="(Optional) Hard limit on model calls over all images")
+parser.add_argument("-ve", "--vectorize_ensemble", action='store_true',
+                    help="(Optional) Run same-architecture models as one vectorised ensemble, picking a model per sample")
+parser.add_argument("-ib", "--inference_backend", type=str, default="eager",
+                    help="(Optional) Inference backend of the cifar10 model. supported: eager, fold_bn, torchscript, compile")
+parser.add_argument("-idt", "--image_dtype", type=str, default="float32",
+                    help="(Optional) Storage dtype of images in raw_data.pkl. supported: float32, float16, uint8")
+parser.add_argument("--resume", action='store_true',
+                    help="(Optional) Continue an interrupted run of the same experiment, skipping images already done")
+parser.add_argument("-cke", "--checkpoint_every", type=int, default=None,
+                    help="(Optional) Checkpoint the attack every this many iterations, --resume continues from it")
+parser.add_argument("-prof", "--profile", action='store_true',
+                    help="(Optional) Record per-phase wall time, model forward time, batch sizes and memory of every "
+                    "iteration in raw_data.pkl (see plotting/plot_timings.py)")
+parser.add_argument("-ptr", "--profile_trace", action='store_true',
+                    help="(Optional) With --profile, also save a torch.profiler trace of every image in <exp>/traces")
+parser.add_argument("-qz", "--quantize", type=str, default=None,
+                    help="(Optional) Int8 quantization of the models (CPU only). supported: dynamic, static")
 
 
 def validate_args(args):
     assert args.dataset is not None
     assert args.noise is not None
     assert args.attack is not None
+    assert args.search_arity >= 2, '--search_arity must be at least 2'
 
 
 def create_attack(exp_name, dataset, params):
@@ -81,15 +148,21 @@ def create_attack(exp_name, dataset, params):
 
     if params.model_keys_filepath is None:
         models = [get_model(k, dataset, params.noise, params.flip_prob, params.beta, get_device(), params.smoothing_noise,
-                            params.crop_size, params.drop_rate)
+                            params.crop_size, params.drop_rate, backend=params.inference_backend,
+                            quantize=params.quantize)
                   for k in params.model_keys[dataset]]
     else:
         n_models = 1
         models = get_models_from_file(params.model_keys_filepath, dataset, params.noise, params.flip_prob, params.beta,
-                                      get_device(), params.smoothing_noise, params.crop_size, params.drop_rate, n_models)
+                                      get_device(), params.smoothing_noise, params.crop_size, params.drop_rate, n_models,
+                                      quantize=params.quantize)
     model_interface = ModelInterface(models, bounds=params.bounds, n_classes=10, slack=params.slack,
                                      noise=params.noise, device=get_device(), flip_prob=params.flip_prob,
-                                     smoothing_noise=params.smoothing_noise, crop_size=params.crop_size)
+                                     smoothing_noise=params.smoothing_noise, crop_size=params.crop_size,
+                                     budget=QueryBudget(params.query_budget, params.query_budget_shares,
+                                                        params.run_query_budget),
+                                     vectorize_ensemble=params.vectorize_ensemble,
+                                     profiler=Profiler(params.profile, get_device(), params.profile_trace_dir))
     attacks_factory = {
         'hsj': HopSkipJump,
         'hsj_rep': HopSkipJumpRepeated,
@@ -103,14 +176,22 @@ def create_attack(exp_name, dataset, params):
     return attacks_factory.get(params.attack)(model_interface, get_shape(dataset), get_device(), params)
 
 
-def run_attack(attack, dataset, params):
+def run_attack(attack, dataset, params, store=None):
     starts = None
     if params.experiment_mode:
         crop_model = get_model(params.model_keys[dataset][0], dataset, noise='cropping', crop_size=22)
-        imgs, labels = get_samples_for_cropping(dataset, crop_model, params.num_samples, params.orig_image_conf)
+        # The selection of n images is a prefix of any larger one (see get_samples_for_cropping), so skipping the first
+        # samples_from images gives the images of a run over the full range
+        imgs, labels = get_samples_for_cropping(dataset, crop_model, params.samples_from + params.num_samples,
+                                                params.orig_image_conf)
+        imgs, labels = imgs[params.samples_from:], labels[params.samples_from:]
         # det_model = get_model(key=params.model_keys[dataset][0], dataset=dataset, noise='deterministic')
         # imgs, labels = get_samples(dataset, n_samples=params.num_samples, conf=params.orig_image_conf,
         #                            model=det_model, samples_from=params.samples_from)
+        if params.targeted and params.all_targets:
+            targets = [[t for t in range(10) if t != label] for label in labels]
+            return MultiTargetAttack(attack).attack_all(imgs, labels, targets, iterations=params.num_iterations,
+                                                        store=store)
         starts, targeted_labels = find_adversarial_images(dataset, labels)
     else:
         if params.input_image_path is None or params.input_image_label is None:
@@ -121,7 +202,7 @@ def run_attack(attack, dataset, params):
 
         if params.init_image_path is not None:
             starts = [read_image(params.init_image_path)]
-    return attack.attack(imgs, labels, starts, targeted_labels, iterations=params.num_iterations)
+    return attack.attack(imgs, labels, starts, targeted_labels, iterations=params.num_iterations, store=store)
 
 
 def merge_params(params: DefaultParams, args):
@@ -129,6 +210,7 @@ def merge_params(params: DefaultParams, args):
     params.beta = args.beta
     params.attack = args.attack
     params.targeted = args.targeted
+    params.all_targets = args.all_targets
     params.dataset = args.dataset
     params.prior_frac = args.prior_frac
     params.queries = args.queries_per_loc
@@ -144,9 +226,41 @@ def merge_params(params: DefaultParams, args):
     params.crop_size = args.crop_size
     params.drop_rate = args.drop_rate
     params.eval_factor = args.eval_factor
+    params.regenerate_directions = args.regenerate_directions
+    params.regen_chunk_size = args.regen_chunk_size
+    params.sampling_basis = args.sampling_basis
+    params.subspace_ratio = args.subspace_ratio
+    params.basis_path = args.basis_path
+    params.sequential_grad = args.sequential_grad
+    params.sequential_z = args.sequential_z
+    params.search_arity = args.search_arity
+    params.stepsize_search = args.stepsize_search
+    params.stepsize_ladder = args.stepsize_ladder
+    params.stepsize_early_exit = args.stepsize_early_exit
+    params.stop_window = args.stop_window
+    params.stop_rel_improvement = args.stop_rel_improvement
+    params.max_model_calls = args.max_model_calls
+    params.target_distance = args.target_distance
+    params.query_budget = args.query_budget
+    if args.query_budget_shares is not None:
+        params.query_budget_shares = {phase: float(share) for phase, share in
+                                      (item.split(':') for item in args.query_budget_shares.split(','))}
+    params.run_query_budget = args.run_query_budget
+    params.vectorize_ensemble = args.vectorize_ensemble
+    params.inference_backend = args.inference_backend
+    params.quantize = args.quantize
+    params.image_dtype = args.image_dtype
+    params.resume = args.resume
+    params.checkpoint_every = args.checkpoint_every
+    params.profile = args.profile
     return params
 
 
+def store_config(params):
+    """ Parameters the results depend on, checked by the result store before resuming """
+    return {name: value for name, value in vars(params).items() if name not in RESUME_IGNORED_PARAMS}
+
+
 def get_experiment_name(args, params):
     if params.experiment_name is not None:
         return params.experiment_name
@@ -161,10 +275,20 @@ def main(params=None):
     params = merge_params(params, args)
     exp_name = get_experiment_name(args, params)
     dataset = args.dataset
+    if params.checkpoint_every is not None:
+        params.checkpoint_dir = '{}/{}/checkpoints'.format(OUT_DIR, exp_name)
+        if os.path.exists(params.checkpoint_dir) and not params.resume:
+            shutil.rmtree(params.checkpoint_dir)
+
+    if params.profile and args.profile_trace:
+        params.profile_trace_dir = '{}/{}/traces'.format(OUT_DIR, exp_name)
 
     attack = create_attack(exp_name, dataset, params)
-    median_distance, additional = run_attack(attack, dataset, params)
-    torch.save(additional, open('{}/{}/raw_data.pkl'.format(OUT_DIR, exp_name), 'wb'))
+    # Results are streamed to shards as images finish, raw_data.pkl is assembled from them at the end
+    store = ShardedResultStore('{}/{}/shards'.format(OUT_DIR, exp_name), params.image_dtype, resume=params.resume,
+                               config=store_config(params))
+    median_distance, _ = run_attack(attack, dataset, params, store)
+    store.consolidate('{}/{}/raw_data.pkl'.format(OUT_DIR, exp_name))
     logging.warning('Saved output at "{}"'.format(exp_name))
     logging.warning('Median_distance: {}'.format(median_distance))
     return median_distance
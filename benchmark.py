@@ -0,0 +1,348 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import socket
+import time
+from datetime import datetime
+from functools import partial
+import numpy as np
+import torch
+from adversarial import Adversarial
+from budget import QueryBudget
+from defaultparams import DefaultParams
+from hopskip import HopSkipJump, HopSkipJumpRepeated
+from img_utils import get_device, get_sample, get_shape
+from infomax import bin_search
+from model_factory import get_model
+from model_interface import ModelInterface
+from popskip import PopSkipJump
+from sweep import git_commit
+from tracker import DiaryPage
+from synthetic import make_problem
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-s", "--suites", type=str, default="decision,bin_search,grad,attack",
+                    help="(Optional) Comma-separated suites. supported: decision, bin_search, grad, attack, synthetic, "
+                         "synthetic_grad")
+parser.add_argument("-d", "--datasets", type=str, default="mnist", help="(Optional) Comma-separated: mnist, cifar10")
+parser.add_argument("-o", "--output", type=str, default=None,
+                    help="(Optional) JSON output, benchmarks/benchmark_<date>.json by default")
+parser.add_argument("--seed", type=int, default=0, help="(Optional) Seed set before every timed run")
+parser.add_argument("-rp", "--repeats", type=int, default=5, help="(Optional) Timed runs per benchmark (after a warmup)")
+parser.add_argument("--quick", action='store_true', help="(Optional) Smaller grids and shorter attacks")
+parser.add_argument("-bl", "--baseline", type=str, default=None,
+                    help="(Optional) Earlier JSON output to compare with, regressions are listed at the end")
+parser.add_argument("-tol", "--tolerance", type=float, default=0.2,
+                    help="(Optional) Relative slowdown of the median time reported as a regression")
+
+# Parameters of the noise models, as passed by app.py (crop_size is relative to the image size)
+NOISE_PARAMS = {
+    'deterministic': {},
+    'stochastic': {'flip_prob': 0.05},
+    'bayesian': {'beta': 1.},
+    'dropout': {'drop_rate': 0.5},
+    'smoothing': {'smoothing_noise': 0.01},
+    'cropping': {'crop_margin': 2},
+}
+DECISION_BATCH = 100
+ATTACKS = {
+    # attack: (class, noise, extra params)
+    'hsj': (HopSkipJump, 'deterministic', {}),
+    'hsj_rep': (HopSkipJumpRepeated, 'bayesian', {'hsja_repeat_queries': 5}),
+    'psj': (PopSkipJump, 'bayesian', {}),
+}
+# The synthetic suite also runs PSJ in sequential mode, with small batches so that it can stop between them
+SYNTHETIC_ATTACKS = dict(ATTACKS, psj_seq=(PopSkipJump, 'bayesian', {'sequential_grad': True, 'batch_size': 20}))
+# Noise of the synthetic oracle per attack: (s, eps) of P(adversarial) = eps + (1 - 2 eps) sigmoid(s f(x))
+SYNTHETIC_NOISE = {'hsj': (float('inf'), 0.), 'hsj_rep': (30., 0.05), 'psj': (30., 0.05), 'psj_seq': (30., 0.05)}
+# Gradient estimator options checked by the synthetic_grad suite against the plain estimator: option: extra params
+GRAD_OPTIONS = {'plain': {}, 'regenerated': {'regenerate_directions': True}}
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def measure(fn, repeats, seed, warmup=1):
+    """
+    Runs fn warmup + repeats times, seeding every run the same way
+    :return: (dict of wall-clock statistics in seconds, output of the last run)
+    """
+    for _ in range(warmup):
+        seed_all(seed)
+        fn()
+    times = []
+    out = None
+    for _ in range(repeats):
+        seed_all(seed)
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    return {'time_median': float(np.median(times)), 'time_min': float(min(times)), 'time_mean': float(np.mean(times)),
+            'repeats': repeats}, out
+
+
+def make_model_interface(dataset, noise, device):
+    kwargs = dict(NOISE_PARAMS[noise])
+    crop_size = get_shape(dataset)[0] - kwargs.pop('crop_margin', 0)
+    model = get_model(DefaultParams().model_keys[dataset][0], dataset, noise, device=device, crop_size=crop_size,
+                      **kwargs)
+    return ModelInterface([model], n_classes=10, noise=noise, device=device, flip_prob=kwargs.get('flip_prob', 0.),
+                          smoothing_noise=kwargs.get('smoothing_noise', 0.), crop_size=crop_size, budget=QueryBudget())
+
+
+def attack_pair(dataset, device):
+    """ (image, label, starting point) attacked by the benchmarks: sample 0, started from sample 1 """
+    image, label = get_sample(dataset, 0)
+    start, _ = get_sample(dataset, 1)
+    return torch.as_tensor(image, device=device).float(), int(label), torch.as_tensor(start, device=device).float()
+
+
+def make_params(attack, noise, **kwargs):
+    params = DefaultParams()
+    params.attack = attack
+    params.noise = noise
+    params.distance = 'l2'
+    for name, value in kwargs.items():
+        setattr(params, name, value)
+    return params
+
+
+def bench_decision(dataset, device, repeats, seed, quick):
+    """ ModelInterface.decision throughput per noise model and number of repeated queries """
+    results = []
+    batch = torch.rand(size=[DECISION_BATCH] + list(get_shape(dataset)), generator=torch.Generator().manual_seed(seed))
+    batch = batch.to(device)
+    for noise in NOISE_PARAMS:
+        model_interface = make_model_interface(dataset, noise, device)
+        for num_queries in ([1, 10] if quick else [1, 10, 50]):
+            stats, _ = measure(lambda: model_interface.decision(batch, 0, num_queries), repeats, seed)
+            stats['queries_per_s'] = DECISION_BATCH * num_queries / stats['time_median']
+            results.append({'name': 'decision/{}/{}/q{}'.format(dataset, noise, num_queries),
+                            'params': {'dataset': dataset, 'noise': noise, 'num_queries': num_queries,
+                                       'batch': DECISION_BATCH}, **stats})
+    return results
+
+
+def bench_bin_search(dataset, device, repeats, seed, quick):
+    """
+    infomax.bin_search latency and queries against grid_size and prior_frac, on the PSJ setting (bayesian noise).
+    prior_frac only narrows the search around a previous estimate, which is taken from a first search.
+    """
+    results = []
+    model_interface = make_model_interface(dataset, 'bayesian', device)
+    image, label, start = attack_pair(dataset, device)
+    d = image.numel()
+    for grid_size in ([100] if quick else [50, 100, 200]):
+        kwargs = dict(model_interface=model_interface, d=d, grid_size=grid_size, device=device,
+                      delta=math.sqrt(d) / grid_size, label=label, queries=5, plot=False)
+        seed_all(seed)
+        output, _ = bin_search(image, start, **kwargs)
+        prev_t, prev_s, prev_e = output['ttse_max'][-1]
+        for prior_frac in ([1., .1] if quick else [1., .5, .1]):
+            def run():
+                calls = model_interface.model_calls
+                bin_search(image, start, prev_t=prev_t, prev_s=prev_s, prev_e=prev_e, prior_frac=prior_frac, **kwargs)
+                return model_interface.model_calls - calls
+            stats, model_calls = measure(run, repeats, seed)
+            stats['model_calls'] = model_calls
+            results.append({'name': 'bin_search/{}/g{}/pf{}'.format(dataset, grid_size, prior_frac),
+                            'params': {'dataset': dataset, 'grid_size': grid_size, 'prior_frac': prior_frac}, **stats})
+    return results
+
+
+def bench_grad(dataset, device, repeats, seed, quick):
+    """ HSJ gradient estimation throughput (random directions per second) against batch_size """
+    results = []
+    model_interface = make_model_interface(dataset, 'deterministic', device)
+    image, label, start = attack_pair(dataset, device)
+    num_evals = 500 if quick else 2000
+    for batch_size in ([64, 256] if quick else [16, 64, 256, 1024]):
+        attack = HopSkipJump(model_interface, get_shape(dataset), device, make_params('hsj', 'deterministic',
+                                                                                     batch_size=batch_size))
+        attack.reset_variables(Adversarial(image=image, label=label, targeted_label=None, device=device))
+        sample = (image + start) / 2
+        delta = 0.01 * math.sqrt(image.numel())
+        stats, _ = measure(lambda: attack._gradient_estimator(sample, num_evals, delta), repeats, seed)
+        stats['directions_per_s'] = num_evals / stats['time_median']
+        results.append({'name': 'grad/{}/b{}'.format(dataset, batch_size),
+                        'params': {'dataset': dataset, 'batch_size': batch_size, 'num_evals': num_evals}, **stats})
+    return results
+
+
+def bench_attack(dataset, device, repeats, seed, quick):
+    """ Wall-clock, model calls and final distance of whole attacks of one image """
+    results = []
+    image, label, start = attack_pair(dataset, device)
+    iterations = 3 if quick else 8
+    for name, (attack_cls, noise, extra) in ATTACKS.items():
+        model_interface = make_model_interface(dataset, noise, device)
+        attack = attack_cls(model_interface, get_shape(dataset), device, make_params(name, noise, **extra))
+
+        def run():
+            model_interface.model_calls = 0
+            median, raw = attack.attack([image], [label], [start], [None], iterations=iterations)
+            return float(median), model_interface.model_calls, len(raw[0].iterations)
+        # Attacks are long enough to be timed without warmup, and at most twice
+        stats, (distance, model_calls, num_iterations) = measure(run, min(repeats, 2), seed, warmup=0)
+        stats.update({'model_calls': model_calls, 'distance': distance, 'iterations': num_iterations})
+        results.append({'name': 'attack/{}/{}'.format(dataset, name),
+                        'params': {'dataset': dataset, 'attack': name, 'noise': noise, 'iterations': iterations,
+                                   **extra}, **stats})
+    return results
+
+
+def bench_synthetic(device, repeats, seed, quick):
+    """
+    Whole attacks of the synthetic oracle (synthetic.py) against the dimension d and the shape of the boundary. The
+    oracle costs next to nothing, so the wall-clock is the overhead of the attack itself, and the l2 distance of the last
+    boundary point is compared with the optimal one, known analytically.
+    """
+    results = []
+    iterations = 3 if quick else 8
+    for d in ([100, 1000] if quick else [100, 1000, 10000]):
+        for boundary in (['linear'] if quick else ['linear', 'curved']):
+            for name, (attack_cls, noise, extra) in SYNTHETIC_ATTACKS.items():
+                s, eps = SYNTHETIC_NOISE[name]
+                model, image, label, start = make_problem(d, boundary, s, eps, noise=noise, seed=seed, device=device)
+                model_interface = ModelInterface([model], n_classes=2, noise=noise, device=device, budget=QueryBudget())
+                attack = attack_cls(model_interface, (d,), device, make_params(name, noise, **extra))
+
+                def run():
+                    model_interface.model_calls = 0
+                    _, raw = attack.attack([image], [label], [start], [None], iterations=iterations)
+                    pages = raw[0].iterations
+                    distance = float(torch.norm(pages[-1].bin_search - image))
+                    grad_calls = sum(page.calls.approx_grad - page.calls.start for page in pages)
+                    return distance, model_interface.model_calls, grad_calls, len(pages)
+                stats, (distance, model_calls, grad_calls, num_iterations) = measure(run, min(repeats, 2), seed,
+                                                                                     warmup=0)
+                optimal = model.model.optimal_distance()
+                stats.update({'model_calls': model_calls, 'grad_calls': grad_calls, 'distance': distance,
+                              'optimal_distance': optimal,
+                              'distance_ratio': distance / optimal, 'iterations': num_iterations,
+                              'time_per_call': stats['time_median'] / model_calls})
+                results.append({'name': 'synthetic/{}/d{}/{}'.format(boundary, d, name),
+                                'params': {'d': d, 'boundary': boundary, 'attack': name, 'noise': noise, 's': s,
+                                           'eps': eps, 'iterations': iterations, **extra}, **stats})
+    return results
+
+
+def synthetic_grad_cosines(d, name, extra, device, seed, trials):
+    """
+    :return: (cosines between the gradient estimate and the true normal w of a linear synthetic boundary, mean model
+             calls of an estimate), over `trials` boundary points found by the attack's own first binary search
+    """
+    attack_cls, noise, attack_extra = SYNTHETIC_ATTACKS[name]
+    s, eps = SYNTHETIC_NOISE[name]
+    cosines, calls = [], []
+    for trial in range(trials):
+        model, image, label, start = make_problem(d, 'linear', s, eps, noise=noise, seed=seed + trial, device=device)
+        model_interface = ModelInterface([model], n_classes=2, noise=noise, device=device, budget=QueryBudget())
+        attack = attack_cls(model_interface, (d,), device, make_params(name, noise, **attack_extra, **extra))
+        attack.reset_variables(Adversarial(image=image, label=label, targeted_label=None, device=device))
+        seed_all(seed + trial)
+        boundary, dist_post_update, estimates = attack.bin_search_step(image, start)
+        delta = attack.select_delta(dist_post_update, 1)
+        model_interface.model_calls = 0
+        grad = attack.gradient_approximation_step(boundary, attack.initial_num_evals, delta, dist_post_update,
+                                                  estimates, DiaryPage())
+        cosines.append(float(torch.dot(grad.flatten(), model.model.w) / torch.norm(grad)))
+        calls.append(model_interface.model_calls)
+    return cosines, float(np.mean(calls))
+
+
+def bench_synthetic_grad(device, repeats, seed, quick):
+    """
+    Quality check of the gradient estimator options on the synthetic oracle: mean cosine between the estimate and the
+    true gradient next to the plain estimator's. An option that lowers the cosine by more than two standard errors is
+    logged as a warning.
+    """
+    results = []
+    trials = 5 if quick else 20
+    for d in ([100, 1000] if quick else [100, 1000, 10000]):
+        for name in ['hsj', 'psj']:
+            plain = None
+            for option, extra in GRAD_OPTIONS.items():
+                stats, (cosines, calls) = measure(lambda: synthetic_grad_cosines(d, name, extra, device, seed, trials),
+                                                  1, seed, warmup=0)
+                cos_mean, cos_sem = float(np.mean(cosines)), float(np.std(cosines) / math.sqrt(trials))
+                plain = (cos_mean, cos_sem) if plain is None else plain
+                stats.update({'cos': cos_mean, 'cos_sem': cos_sem, 'cos_gain': cos_mean - plain[0],
+                              'model_calls': calls})
+                if cos_mean < plain[0] - 2 * math.hypot(cos_sem, plain[1]):
+                    logging.warning('synthetic_grad: %s lowers the cosine of %s at d=%d: %.3f < %.3f',
+                                    option, name, d, cos_mean, plain[0])
+                results.append({'name': 'synthetic_grad/d{}/{}/{}'.format(d, name, option),
+                                'params': {'d': d, 'attack': name, 'option': option, 'trials': trials, **extra},
+                                **stats})
+    return results
+
+
+SUITES = {'decision': bench_decision, 'bin_search': bench_bin_search, 'grad': bench_grad, 'attack': bench_attack}
+# Suites that do not depend on the dataset, run once whatever --datasets
+MODEL_FREE_SUITES = {'synthetic': bench_synthetic, 'synthetic_grad': bench_synthetic_grad}
+
+
+def environment():
+    return {'date': datetime.now().isoformat(), 'host': socket.gethostname(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'torch': torch.__version__, 'num_threads': torch.get_num_threads(),
+            'device': str(get_device()), 'git_commit': git_commit()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of (name, message) of the benchmarks slower than baseline by more than tolerance, or whose model
+             calls changed (calls are deterministic under the fixed seed, so any change is a behaviour change)
+    """
+    previous = {entry['name']: entry for entry in baseline['results']}
+    regressions = []
+    for entry in results:
+        base = previous.get(entry['name'])
+        if base is None:
+            continue
+        ratio = entry['time_median'] / base['time_median']
+        if ratio > 1 + tolerance:
+            regressions.append((entry['name'], 'time x{:.2f}'.format(ratio)))
+        if 'model_calls' in entry and entry['model_calls'] != base.get('model_calls'):
+            regressions.append((entry['name'], 'model calls {} -> {}'.format(base.get('model_calls'),
+                                                                           entry['model_calls'])))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    results = []
+    suites = args.suites.split(',')
+    runs = [(suite, MODEL_FREE_SUITES[suite]) for suite in suites if suite in MODEL_FREE_SUITES]
+    runs += [(suite, partial(SUITES[suite], dataset)) for dataset in args.datasets.split(',') for suite in suites
+             if suite not in MODEL_FREE_SUITES]
+    for suite, bench in runs:
+        for entry in bench(device, args.repeats, args.seed, args.quick):
+            entry['suite'] = suite
+            print('{:40s} {:10.4f}s'.format(entry['name'], entry['time_median']))
+            results.append(entry)
+    dump = {'environment': environment(), 'seed': args.seed, 'quick': args.quick, 'results': results}
+    output = args.output or 'benchmarks/benchmark_{}.json'.format(datetime.now().strftime("%b%d_%H%M%S"))
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(dump, f, indent=1)
+    print('Saved {}'.format(output))
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, message in regressions:
+            print('REGRESSION {}: {}'.format(name, message))
+        print('{} regressions against {}'.format(len(regressions), args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,13 +14,13 @@ from foolbox import PyTorchModel, accuracy, samples
 from foolbox.attacks import BoundaryAttack, L2BrendelBethgeAttack, L2PGD, L2CarliniWagnerAttack, L2DeepFoolAttack
 from img_utils import get_samples, get_samples_for_cropping
 from model_factory import get_model
-from tracker import Diary, DiaryPage
+from tracker import Diary, DiaryPage, load_diaries
 from foolbox.criteria import Misclassification
 
 
 def read_dump(path):
     filepath = 'thesis/{}/raw_data.pkl'.format(path)
-    raw = torch.load(open(filepath, 'rb'), map_location='cpu')
+    raw = load_diaries(filepath, map_location='cpu')
     return raw
 
 
@@ -167,8 +167,9 @@ def main() -> None:
     # raw = read_dump('whitebox_hsj_true_grad')
     raw = read_dump('blackbox_hsj')
     calls = 0
-    BD_hsj = np.zeros((n_samples, len(raw[0].iterations)))
-    VD_hsj = np.zeros((n_samples, len(raw[0].iterations)))
+    num_iterations = max(len(raw[i].iterations) for i in range(n_samples))
+    BD_hsj = np.zeros((n_samples, num_iterations))
+    VD_hsj = np.zeros((n_samples, num_iterations))
     for i in tqdm(range(n_samples)):
         diary: Diary = raw[i]
         label = diary.true_label
@@ -179,6 +180,9 @@ def main() -> None:
             x_tt = project(x_star, x_t.numpy(), label, theta, det_model)
             BD_hsj[i, j] = np.linalg.norm(x_tt - x_star) / np.sqrt(d)
             VD_hsj[i, j] = np.linalg.norm(x_t - x_star) / np.sqrt(d)
+        # An early-stopped image keeps its last distances for the iterations it did not run
+        BD_hsj[i, len(diary.iterations):] = BD_hsj[i, len(diary.iterations) - 1]
+        VD_hsj[i, len(diary.iterations):] = VD_hsj[i, len(diary.iterations) - 1]
         calls += page.calls.bin_search
     metric = VD_hsj
     metric = np.min(metric, axis=1)
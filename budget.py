@@ -0,0 +1,67 @@
+class BudgetExhausted(Exception):
+    pass
+
+
+class QueryBudget(object):
+    """
+        Query budget shared out between the phases of an attack.
+        ModelInterface charges every model call to the current phase before spending it, and raises BudgetExhausted
+        when a call does not fit in the budget. Phases that can adapt their number of queries (e.g. gradient
+        estimation) should ask remaining() first.
+        :param total: maximum number of model calls per image (None for unlimited)
+        :param shares: optional dict {phase: fraction of total} limiting individual phases
+        :param run_total: maximum number of model calls over all images of a run (None for unlimited)
+    """
+    PHASES = ('initialization', 'bin_search', 'approx_grad', 'step_search', 'other')
+
+    def __init__(self, total=None, shares=None, run_total=None):
+        self.total = total
+        self.shares = shares if shares is not None else {}
+        for phase in self.shares:
+            if phase not in self.PHASES:
+                raise RuntimeError(f'Unknown budget phase: {phase}')
+        self.run_total = run_total
+        self.run_spent = 0
+        self.phase = 'other'
+        self.spent = {phase: 0 for phase in self.PHASES}
+
+    def start_image(self):
+        self.phase = 'other'
+        self.spent = {phase: 0 for phase in self.PHASES}
+
+    def set_phase(self, phase):
+        if phase not in self.PHASES:
+            raise RuntimeError(f'Unknown budget phase: {phase}')
+        self.phase = phase
+
+    def remaining(self, phase=None):
+        """ Number of queries the given (default: current) phase may still spend """
+        phase = self.phase if phase is None else phase
+        limits = [float('Inf')]
+        if self.total is not None:
+            limits.append(self.total - sum(self.spent.values()))
+            if phase in self.shares:
+                limits.append(int(self.shares[phase] * self.total) - self.spent[phase])
+        if self.run_total is not None:
+            limits.append(self.run_total - self.run_spent)
+        return max(min(limits), 0)
+
+    def run_exhausted(self):
+        return self.run_total is not None and self.run_spent >= self.run_total
+
+    def spend(self, n):
+        if n > self.remaining():
+            raise BudgetExhausted(f'{self.phase} asked for {n} queries, {self.remaining()} left')
+        self.spent[self.phase] += n
+        self.run_spent += n
+
+    def report(self):
+        return {'total': self.total, 'spent': dict(self.spent)}
+
+    def state_dict(self):
+        return {'phase': self.phase, 'spent': dict(self.spent), 'run_spent': self.run_spent}
+
+    def load_state_dict(self, state):
+        self.phase = state['phase']
+        self.spent = dict(state['spent'])
+        self.run_spent = state['run_spent']
@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import os
+import torch
+from torch.fx.experimental.optimization import fuse
+
+BACKENDS = ('eager', 'fold_bn', 'torchscript', 'compile')
+# Backends whose modules have no autograd path (frozen constants): gradients have to be taken on the eager model
+NO_GRAD_BACKENDS = ('torchscript',)
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'compiled')
+
+
+def weights_fingerprint(model):
+    """ Hash of the parameters and buffers of a model, used to invalidate compiled artifacts of other weights """
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def fold_batchnorm(model):
+    """
+    Folds every eval-mode BatchNorm that directly follows a convolution into the convolution's weights.
+    In DenseNet this covers conv0/norm0 and conv1/norm2 of every dense layer. The pre-activation BatchNorms sit
+    behind a ReLU and are kept.
+    """
+    return fuse(model.eval(), inplace=False)
+
+
+def torchscript(model, input_shape, cache_path=None):
+    """
+    Traced, frozen and inference-optimised TorchScript module.
+    The frozen trace is cached at cache_path. optimize_for_inference is re-applied after loading because its output
+    (mkldnn-specific graph) cannot be serialised.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        frozen = torch.jit.load(cache_path, map_location='cpu')
+    else:
+        with torch.no_grad():
+            frozen = torch.jit.freeze(torch.jit.trace(model.eval(), torch.randn(input_shape)))
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = cache_path + '.tmp'
+            torch.jit.save(frozen, tmp_path)
+            os.replace(tmp_path, cache_path)
+    return torch.jit.optimize_for_inference(frozen)
+
+
+def compiled(model, cache_dir=None):
+    """ torch.compile-d module. Inductor keeps its compiled kernels in cache_dir, so only the first run compiles """
+    if cache_dir is not None:
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    return torch.compile(model.eval())
+
+
+def check_backend(reference, optimized, inputs, atol=1e-3, rtol=1e-3):
+    """ True if the logits of both models agree on inputs (model inputs, i.e. already normalised images) """
+    with torch.no_grad():
+        expected = reference(inputs)
+        actual = optimized(inputs)
+    if torch.allclose(actual, expected, atol=atol, rtol=rtol):
+        return True
+    logging.warning('Backend logits differ from eager by up to {}'.format(float((actual - expected).abs().max())))
+    return False
+
+
+def optimize_model(model, backend='eager', check_inputs=None, input_shape=(1, 3, 32, 32), cache_dir=CACHE_DIR):
+    """
+    :param model: eager module in eval mode
+    :param backend: one of BACKENDS
+    :param check_inputs: model inputs (e.g. normalised dataset images) on which the backend must match eager. Without
+                         them the backend cannot be validated and the eager model is returned
+    :return: optimised module, or the eager model if the backend fails the correctness check
+    """
+    if backend not in BACKENDS:
+        raise RuntimeError(f'Unknown inference backend: {backend}')
+    if backend == 'eager':
+        return model
+    if check_inputs is None:
+        logging.warning('No images to validate inference backend {} on, using eager'.format(backend))
+        return model
+    key = '{}_{}_{}_{}'.format(type(model).__name__, backend, torch.__version__, weights_fingerprint(model)[:16])
+    if backend == 'fold_bn':
+        optimized = fold_batchnorm(model)
+    elif backend == 'torchscript':
+        optimized = torchscript(model, input_shape, os.path.join(cache_dir, key + '.pt'))
+    else:
+        optimized = compiled(model, os.path.join(cache_dir, 'inductor'))
+    if not check_backend(model, optimized, check_inputs):
+        logging.warning('Inference backend {} failed the correctness check, using eager'.format(backend))
+        if backend == 'torchscript':
+            os.remove(os.path.join(cache_dir, key + '.pt'))
+        return model
+    return optimized
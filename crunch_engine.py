@@ -0,0 +1,166 @@
+import math
+import torch
+from scipy import stats
+
+
+def compute_distance(x1, x2, distance_metric):
+    """ Row-wise distance, normalised by the dimension for l2 """
+    d = x1[0].numel()
+    if distance_metric == 'l2':
+        return torch.norm((x1 - x2).flatten(1), dim=1) / math.sqrt(d)
+    return torch.max(torch.abs(x1 - x2).flatten(1), dim=1)[0]
+
+
+class SmoothedClassifier(object):
+    """
+        Majority vote of a noisy model over many noisy draws of every point, evaluated for a batch of points at once.
+        Votes are drawn in rounds of `round_size` per point still undecided. A point stops drawing as soon as
+            - its Clopper-Pearson interval (confidence 1 - alpha) on the fraction of votes for its label excludes 0.5, or
+            - the votes left until max_samples can no longer change the majority.
+        Points whose vote stays undecided get the majority of max_samples votes, i.e. the plain smoothed decision.
+        With alpha=None only the second rule applies and the decisions are distributed exactly as with max_samples
+        votes per point.
+    """
+    def __init__(self, model_noisy, max_samples=50, round_size=10, alpha=1e-3, batch_size=1024):
+        self.model_noisy = model_noisy
+        self.max_samples = max_samples
+        self.round_size = round_size
+        self.alpha = alpha
+        self.batch_size = batch_size
+        # Votes drawn and points decided so far, the full vote costs max_samples per point
+        self.num_samples = 0
+        self.num_points = 0
+
+    def confidence_interval(self, correct, n):
+        """ Clopper-Pearson interval of the fraction of correct votes """
+        correct, n = correct.cpu().numpy(), n.cpu().numpy()
+        low = stats.beta.ppf(self.alpha / 2, correct, n - correct + 1)
+        high = stats.beta.ppf(1 - self.alpha / 2, correct + 1, n - correct)
+        low[correct == 0] = 0.
+        high[correct == n] = 1.
+        return torch.tensor(low), torch.tensor(high)
+
+    def votes(self, x, labels, samples):
+        """ Number of the samples draws of every point that return its label """
+        correct = torch.zeros(len(x), dtype=torch.long)
+        chunk = max(self.batch_size // samples, 1)
+        for start, end in [(start, min(start + chunk, len(x))) for start in range(0, len(x), chunk)]:
+            preds = self.model_noisy.ask_model_repeated(x[start:end], samples)
+            correct[start:end] = torch.sum(preds == labels[start:end, None].to(preds.device), dim=1).cpu()
+        self.num_samples += len(x) * samples
+        return correct
+
+    def predict_correct(self, x, labels):
+        """ :return: boolean tensor, True where the smoothed decision of x is its label """
+        self.num_points += len(x)
+        correct = torch.zeros(len(x), dtype=torch.long)
+        n = torch.zeros(len(x), dtype=torch.long)
+        undecided = torch.ones(len(x), dtype=torch.bool)
+        threshold = self.max_samples / 2.
+        while undecided.any():
+            rows = torch.nonzero(undecided).flatten()
+            samples = min(self.round_size, self.max_samples - int(n[rows[0]]))
+            correct[rows] += self.votes(x[rows.to(x.device)], labels[rows.to(labels.device)], samples)
+            n[rows] += samples
+            # Majority already decided whatever the remaining votes
+            decided = (correct[rows] >= threshold) | (correct[rows] + self.max_samples - n[rows] < threshold)
+            decided |= n[rows] >= self.max_samples
+            if self.alpha is not None:
+                low, high = self.confidence_interval(correct[rows], n[rows])
+                decided |= (low > 0.5) | (high < 0.5)
+            undecided[rows[decided]] = False
+        return (correct.float() / n.float() >= 0.5).to(x.device)
+
+
+class BoundaryProjector(object):
+    """
+        Batched version of the boundary projections of crunch_experiments.py.
+        All the points to project advance in lockstep: every round of the extrapolation and of the bisection is a
+        single (chunked) forward pass over all the points still in that round, instead of one forward pass per point.
+        :param model: model whose argmax decides the plain projections
+        :param model_noisy: model sampled by the smoothed projections
+        :param distance_metric: 'l2' or 'linf'
+        :param theta_det: bisection threshold, on the interpolation coefficient
+        :param batch_size: maximum number of images per forward pass
+        :param smoothing_alpha: error rate of the early stopped smoothed decisions (None for the full vote)
+    """
+    def __init__(self, model, model_noisy, distance_metric, theta_det, batch_size=1024, smoothing_samples=50,
+                 smoothing_alpha=1e-3):
+        self.model = model
+        self.smoothed = SmoothedClassifier(model_noisy, smoothing_samples, alpha=smoothing_alpha, batch_size=batch_size)
+        self.distance_metric = distance_metric
+        self.theta_det = theta_det
+        self.batch_size = batch_size
+
+    def _chunks(self, n, size):
+        return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+    def is_adversarial(self, x, labels, smoothing=False):
+        """
+        :return: boolean tensor, True where the decision of x differs from its label.
+                 With smoothing, the decision is the label if at least half of the noisy predictions return it.
+        """
+        if smoothing:
+            return ~self.smoothed.predict_correct(x, labels)
+        out = torch.zeros(len(x), dtype=torch.bool, device=x.device)
+        for start, end in self._chunks(len(x), self.batch_size):
+            out[start:end] = torch.argmax(self.model.get_probs(x[start:end]), dim=1) != labels[start:end]
+        return out
+
+    def interpolation(self, x_star, x_t, alpha):
+        """ Row-wise interpolation, alpha has one (float64) coefficient per row """
+        shape = [-1] + [1] * (x_star.dim() - 1)
+        if self.distance_metric == 'l2':
+            return (1 - alpha).to(x_star.dtype).view(shape) * x_star + alpha.to(x_star.dtype).view(shape) * x_t
+        dist_linf = torch.abs(x_star - x_t).flatten(1).max(dim=1)[0]
+        radius = (alpha.to(x_star.dtype) * dist_linf).view(shape)
+        min_limit = x_star - radius
+        max_limit = x_star + radius
+        x_mid = torch.where(x_t > max_limit, max_limit, x_t)
+        return torch.where(x_mid < min_limit, min_limit, x_mid)
+
+    def compute_distance(self, x1, x2):
+        return compute_distance(x1, x2, self.distance_metric)
+
+    def search_boundary(self, x_star, x_t, labels, smoothing=False):
+        """ Bisection between x_star (same label) and x_t (adversarial) of all rows at once """
+        low = torch.zeros(len(x_t), dtype=torch.float64, device=x_t.device)
+        high = torch.ones_like(low)
+        # Every row halves the same interval, so all rows need the same number of rounds
+        while len(x_t) > 0 and float(high[0] - low[0]) > self.theta_det:
+            mid = (high + low) / 2.0
+            correct = ~self.is_adversarial(self.interpolation(x_star, x_t, mid), labels, smoothing)
+            low = torch.where(correct, mid, low)
+            high = torch.where(correct, high, mid)
+        return self.interpolation(x_star, x_t, high)
+
+    def project(self, x_star, x_t, labels, smoothing=False):
+        """
+        Projects every x_t on the decision boundary along the line from x_star.
+        Points that are not adversarial are first pushed away from x_star, doubling the step until the decision flips
+        (or the point saturates), and the boundary is then searched between x_t and that point.
+        """
+        starts, ends = x_star.clone(), x_t.clone()
+        searched = self.is_adversarial(x_t, labels, smoothing)
+        active = ~searched
+        c = torch.full((len(x_t),), 0.25, dtype=torch.float64, device=x_t.device)
+        shape = [-1] + [1] * (x_t.dim() - 1)
+        diff = x_t - x_star
+        directions = diff / torch.norm(diff.flatten(1), dim=1).view(shape)
+        while active.any():
+            rows = torch.nonzero(active).flatten()
+            x_tt = torch.clamp(x_t[rows] + c[rows].to(x_t.dtype).view(shape) * directions[rows], 0, 1)
+            saturated = torch.logical_or(x_tt == 1, x_tt == 0).flatten(1).all(dim=1) | (c[rows] > 2 ** 20)
+            ends[rows[saturated]] = x_tt[saturated]
+            active[rows[saturated]] = False
+            rows, x_tt = rows[~saturated], x_tt[~saturated]
+            flipped = self.is_adversarial(x_tt, labels[rows], smoothing)
+            found = rows[flipped]
+            starts[found] = x_t[found]
+            ends[found] = x_tt[flipped]
+            searched[found] = True
+            active[found] = False
+            c[rows[~flipped]] *= 2
+        rows = torch.nonzero(searched).flatten()
+        ends[rows] = self.search_boundary(starts[rows], ends[rows], labels[rows], smoothing)
+        return ends
@@ -1,199 +1,245 @@
-import sys
+import argparse
+import hashlib
+import logging
+import math
+import os
 import torch
-from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 from model_factory import get_model
 from img_utils import get_device
-import math
-from tracker import Diary, DiaryPage
+from tracker import Diary, DiaryPage, RunTracker, load_diaries
+from crunch_engine import BoundaryProjector, compute_distance
+from metrics_store import MetricsStore
+from sweep import read_metadata
 
 OUT_DIR = 'thesis'
-exp_name = sys.argv[1]
-dataset = sys.argv[2]
-only_last = (len(sys.argv) > 3 and sys.argv[3] == 'last')
-flip_prob = float(exp_name.split('_')[-3])
-noise = exp_name.split('_')[-5]
-beta = float(exp_name.split('_')[-6])
-distance_metric = str(exp_name.split('_')[-8])
-dr = float(exp_name.split('_')[-10])
-cs = int(exp_name.split('_')[-12])
-sn = float(exp_name.split('_')[-14])
-device = get_device()
 NUM_ITERATIONS = 32
-NUM_IMAGES = int(exp_name.split('_')[-1])
-eps = torch.linspace(0, 10, 100)
-if dataset == 'cifar10':
-    d = 32*32*3
-    model = get_model(key='cifar10', dataset=dataset, beta=beta)
-    model_noisy = get_model(key='cifar10', dataset=dataset, noise=noise,
-                            smoothing_noise=0.01, crop_size=26, drop_rate=0.5)
-    actual_model = get_model(key='cifar10', dataset=dataset, noise=noise, flip_prob=0, beta=beta,
-                             smoothing_noise=sn, crop_size=cs, drop_rate=dr)
-else:
-    d = 28*28
-    model = get_model(key='mnist_noman', dataset=dataset, beta=beta)
-    model_noisy = get_model(key='mnist_noman', dataset=dataset, noise=noise,
-                            smoothing_noise=0.01, crop_size=26, drop_rate=0.5)
-    actual_model = get_model(key='mnist_noman', dataset=dataset, noise=noise, flip_prob=0, beta=beta,
-                             smoothing_noise=sn, crop_size=cs, drop_rate=dr)
-if distance_metric == 'l2':
-    theta_det = 1 / (d * math.sqrt(d))
-elif distance_metric == 'linf':
-    theta_det = 1 / (d * d)
-
-
-def read_dump(path):
-    filepath = f'{OUT_DIR}/{path}/raw_data.pkl'
-    raw = torch.load(open(filepath, 'rb'), map_location=device)
-    return raw
-
-
-raw = read_dump(exp_name)
-model.model = model.model.to(device)
-model_noisy.model = model_noisy.model.to(device)
-actual_model.model = actual_model.model.to(device)
-
-
-def interpolation(x_star, x_t, alpha):
-    if distance_metric == 'l2':
-        x_mid = (1 - alpha) * x_star + alpha * x_t
-    elif distance_metric == 'linf':
-        dist_linf = torch.max(torch.abs(x_star - x_t))
-        min_limit = x_star - alpha * dist_linf
-        max_limit = x_star + alpha * dist_linf
-        x_mid = torch.where(x_t > max_limit, max_limit, x_t)
-        x_mid = torch.where(x_mid < min_limit, min_limit, x_mid)
-    return x_mid
-
-
-def smoothing_output(x, true_label, samples=50):
-    dim = [samples] + [1] * x.dim()
-    x = x.unsqueeze(dim=0).repeat(*(dim))
-    pred = model_noisy.ask_model(x)
-    correct_pred = torch.sum(pred == true_label).float()
-    p = correct_pred / samples
-    if p >= 0.5:
-        return true_label
-    else:
-        return (true_label + 1) % 10
-
-
-def search_boundary(x_star, x_t, theta_det, true_label, smoothing=False):
-    high, low = 1, 0
-    while high - low > theta_det:
-        mid = (high + low) / 2.0
-        x_mid = interpolation(x_star, x_t, mid)
-        if smoothing:
-            pred = smoothing_output(x_mid, true_label)
-        else:
-            pred = torch.argmax(model.get_probs(x_mid[None])[0])
-        if pred == true_label:
-            low = mid
-        else:
-            high = mid
-    out = interpolation(x_star, x_t, high)
-    return out
-
-
-def compute_distance(x1, x2):
-    if distance_metric == "l2":
-        return torch.norm(x1 - x2) / math.sqrt(d)
-    elif distance_metric == "linf":
-        return torch.max(torch.abs(x1 - x2))
-
-
-def project(x_star, x_t, label, theta_det, smoothing=False):
-    if smoothing:
-        pred = smoothing_output(x_t, label)
-    else:
-        pred = torch.argmax(model.get_probs(x_t[None])[0])
-    if pred == label:
-        c = 0.25
-        while True:
-            x_tt = x_t + c * (x_t - x_star) / torch.norm(x_t - x_star)
-            x_tt = torch.clamp(x_tt, 0, 1)
-            if torch.all(torch.logical_or(x_tt == 1, x_tt == 0)).item() or c > 2**20:
-                break
-            if smoothing:
-                pred = smoothing_output(x_tt, label)
-            else:
-                pred = torch.argmax(model.get_probs(x_tt[None])[0])
-            if pred != label:
-                x_tt = search_boundary(x_t, x_tt, theta_det, label, smoothing)
-                break
-            c += c
-    else:
-        x_tt = search_boundary(x_star, x_t, theta_det, label, smoothing)
-    return x_tt
-
-
-D = torch.zeros(size=(NUM_ITERATIONS + 1, NUM_IMAGES), device=device)
-D_SMOOTH = torch.zeros_like(D, device=device)
-D_VANILLA = torch.zeros_like(D, device=device)
-D_OUT = torch.zeros_like(D, device=device)
-D_G = torch.zeros_like(D, device=device)
-MC = torch.zeros_like(D, device=device)
-AA = torch.zeros(size=(len(eps), NUM_ITERATIONS + 1, NUM_IMAGES), device=device)
-
-for iteration in tqdm(range(NUM_ITERATIONS)):
-    if only_last and iteration < NUM_ITERATIONS - 1:
-        continue
-    for image in range(NUM_IMAGES):
+CACHE_FILE = 'crunch_cache.pt'
+CRUNCH_VERSION = 1  # Bump whenever the projections change, it invalidates every cached cell
+
+parser = argparse.ArgumentParser()
+parser.add_argument("exp_names", type=str, help="Experiment name, or several names separated by commas")
+parser.add_argument("dataset", type=str)
+parser.add_argument("mode", type=str, nargs='?', default=None, help="'last' to only crunch the last iteration")
+parser.add_argument("-w", "--workers", type=int, default=1, help="Number of experiments crunched in parallel")
+parser.add_argument("--no_cache", action='store_true', help="Recompute every cell, ignoring the crunch cache")
+
+
+def experiment_config(exp_name):
+    """ Parameters of an experiment, from the config.json written by sweep.py or else parsed from its name """
+    metadata = read_metadata(exp_name, OUT_DIR)
+    if metadata is not None:
+        config = metadata['config']
+        return {
+            'flip_prob': float(config['flip_prob']),
+            'noise': config['noise'],
+            'beta': float(config['beta']),
+            'distance_metric': str(config['distance']).lower(),
+            'dr': float(config['drop_rate']),
+            'cs': int(config['crop_size']),
+            'sn': float(config['smoothing_noise']),
+            'num_images': int(config['num_samples']),
+        }
+    parts = exp_name.split('_')
+    return {
+        'flip_prob': float(parts[-3]),
+        'noise': parts[-5],
+        'beta': float(parts[-6]),
+        'distance_metric': str(parts[-8]),
+        'dr': float(parts[-10]),
+        'cs': int(parts[-12]),
+        'sn': float(parts[-14]),
+        'num_images': int(parts[-1]),
+    }
+
+
+def crunch_params(exp_name, dataset):
+    """ Everything the projected distances depend on besides the dump itself """
+    config = experiment_config(exp_name)
+    d = 32*32*3 if dataset == 'cifar10' else 28*28
+    if config['distance_metric'] == 'l2':
+        theta_det = 1 / (d * math.sqrt(d))
+    elif config['distance_metric'] == 'linf':
+        theta_det = 1 / (d * d)
+    return {'version': CRUNCH_VERSION, 'dataset': dataset, 'noise': config['noise'], 'beta': config['beta'],
+            'distance_metric': config['distance_metric'], 'theta_det': theta_det,
+            'smoothing_noise': 0.01, 'crop_size': 26, 'drop_rate': 0.5, 'smoothing_samples': 50,
+            'smoothing_alpha': 1e-3}
+
+
+def cell_key(params_digest, x_star, x_t, label):
+    """ Content hash of a (image, iteration) cell: identical points of any dump share their cached results """
+    digest = hashlib.sha1(params_digest)
+    for tensor in (x_star, x_t):
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    digest.update(str(int(label)).encode())
+    return digest.hexdigest()
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    return torch.load(path)
+
+
+def save_cache(cache, path):
+    tmp_path = path + '.tmp'
+    torch.save(cache, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def crunch(exp_name, dataset, only_last=False, use_cache=True):
+    """
+    Crunches raw_data.pkl of an experiment into crunched.pkl.
+    The projected distances of every (image, iteration) cell are cached in crunch_cache.pt under the content hash of
+    the cell and the crunch parameters, so re-crunching an experiment that got more images or iterations only
+    projects the new cells.
+    Cells without a boundary point are NaN: images a run budget never reached, and images whose budget ran out
+    before the initial projection (no cell at all) or before the first iteration (only iteration 0).
+    """
+    device = get_device()
+    params = crunch_params(exp_name, dataset)
+    params_digest = repr(sorted(params.items())).encode()
+    config = experiment_config(exp_name)
+    num_images = config['num_images']
+    raw = load_diaries(f'{OUT_DIR}/{exp_name}/raw_data.pkl', map_location=device)
+    cache_path = f'{OUT_DIR}/{exp_name}/{CACHE_FILE}'
+    cache = load_cache(cache_path) if use_cache else {}
+
+    D = torch.zeros(size=(NUM_ITERATIONS + 1, num_images), device=device)
+    D_SMOOTH = torch.zeros_like(D, device=device)
+    D_VANILLA = torch.zeros_like(D, device=device)
+    D_OUT = torch.zeros_like(D, device=device)
+    D_G = torch.zeros_like(D, device=device)
+    MC = torch.zeros_like(D, device=device)
+    AA = torch.zeros(size=(100, NUM_ITERATIONS + 1, num_images), device=device)
+    missing_cells = torch.zeros(size=(NUM_ITERATIONS + 1, num_images), dtype=torch.bool, device=device)
+
+    # Row r of the batch is cell (rows_t[r], rows_i[r]) of D
+    iterations = [NUM_ITERATIONS - 1] if only_last else list(range(NUM_ITERATIONS))
+    rows_t, rows_i, x_stars, x_ts, labels, x_gs, calls = [], [], [], [], [], [], []
+    # A run budget can stop the attack before num_images images
+    missing_cells[:, len(raw):] = True
+    for image in range(min(num_images, len(raw))):
         diary: Diary = raw[image]
-        x_star = diary.original
-        label = diary.true_label
-        if iteration == 0:
-            x_0 = diary.initial_projection
-            x_00 = project(x_star, x_0, label, theta_det)
-            x_00_smooth = project(x_star, x_0, label, theta_det, smoothing=True)
-            D[0, image] = compute_distance(x_star, x_00)
-            D_SMOOTH[0, image] = compute_distance(x_star, x_00_smooth)
-            D_VANILLA[0, image] = compute_distance(x_star, x_0)
-            D_OUT[0, image] = -1
-            MC[0, image] = diary.calls_initial_bin_search
-
-        page: DiaryPage = diary.iterations[iteration]
-        calls = page.calls.bin_search
-        x_t = page.bin_search
-        x_tt = project(x_star, x_t, label, theta_det)
-        x_tt_smooth = project(x_star, x_t, label, theta_det, smoothing=True)
-
-        D[iteration + 1, image] = compute_distance(x_star, x_tt)
-        D_SMOOTH[iteration + 1, image] = compute_distance(x_star, x_tt_smooth)
-        D_VANILLA[iteration + 1, image] = compute_distance(x_star, x_t)
-        D_G[iteration+1, image] = compute_distance(x_star, page.approx_grad)
-        if exp_name.startswith('psj'):
-            D_OUT[iteration + 1, image] = D[iteration, image]
-        else:
-            D_OUT[iteration + 1, image] = page.distance
-        MC[iteration + 1, image] = calls
-
-        # try:
-        #     sample_size = 1000
-        #     for j in range(len(eps)):
-        #         x_adv = x_star + eps[j] * (x_tt - x_star) / torch.norm(x_tt - x_star)
-        #         correct_pred = 0
-        #         for _ in range(10):
-        #             if dataset == 'mnist':
-        #                 batch = x_adv.repeat(sample_size//10, 1, 1)
-        #             elif dataset == 'cifar10':
-        #                 batch = x_adv.repeat(sample_size//10, 1, 1, 1)
-        #             else:
-        #                 raise RuntimeError
-        #             preds = actual_model.ask_model(batch)
-        #             correct_pred = correct_pred + torch.sum(preds == label)
-        #         AA[j, iteration + 1, image] = correct_pred / sample_size
-        # except:
-        #     print ("Skipping Image: ", image)
-        #     pass
-
-
-dump = {
-    'border_distance': D,
-    'border_distance_smooth': D_SMOOTH,
-    'vanilla_distance': D_VANILLA,
-    'distance_approxgrad': D_G,
-    'attack_out_distance': D_OUT,
-    'model_calls': MC,
-    'adv_acc': AA,
-}
-torch.save(dump, open(f'{OUT_DIR}/{exp_name}/crunched.pkl', 'wb'))
+        if diary.initial_projection is None:
+            missing_cells[:, image] = True
+            continue
+        if 0 in iterations:
+            rows_t.append(0)
+            rows_i.append(image)
+            x_stars.append(diary.original)
+            x_ts.append(diary.initial_projection)
+            labels.append(int(diary.true_label))
+            calls.append(diary.calls_initial_bin_search)
+        if len(diary.iterations) == 0:
+            missing_cells[1:, image] = True
+            continue
+        for iteration in iterations:
+            # Attacks that stopped early keep their last state for the remaining iterations
+            page: DiaryPage = diary.iterations[min(iteration, len(diary.iterations) - 1)]
+            rows_t.append(iteration + 1)
+            rows_i.append(image)
+            x_stars.append(diary.original)
+            x_ts.append(page.bin_search)
+            labels.append(int(diary.true_label))
+            x_gs.append(page.approx_grad)
+            calls.append(page.calls.bin_search)
+            if not exp_name.startswith('psj'):
+                D_OUT[iteration + 1, image] = page.distance
+
+    if len(x_ts) == 0:
+        raise RuntimeError(f'{exp_name}: no image has a boundary point to crunch')
+    keys = [cell_key(params_digest, x_star, x_t, label) for x_star, x_t, label in zip(x_stars, x_ts, labels)]
+    rows_t, rows_i = torch.tensor(rows_t, device=device), torch.tensor(rows_i, device=device)
+    x_stars, x_ts = torch.stack(x_stars).to(device), torch.stack(x_ts).to(device)
+    x_gs = torch.stack(x_gs).to(device) if len(x_gs) > 0 else x_ts[:0]
+    labels = torch.tensor(labels, device=device)
+
+    # Cells with the same content (e.g. the repeated last page of an early stopped attack) are only projected once
+    missing = {}
+    for r, key in enumerate(keys):
+        if key not in cache and key not in missing:
+            missing[key] = r
+    print('{}: {} cells, {} to project'.format(exp_name, len(keys), len(missing)))
+    if len(missing) > 0:
+        model, model_noisy = get_models(dataset, params, device)
+        projector = BoundaryProjector(model, model_noisy, params['distance_metric'], params['theta_det'],
+                                      smoothing_samples=params['smoothing_samples'],
+                                      smoothing_alpha=params['smoothing_alpha'])
+        rows = torch.tensor(list(missing.values()), device=device)
+        x_tt = projector.project(x_stars[rows], x_ts[rows], labels[rows])
+        x_tt_smooth = projector.project(x_stars[rows], x_ts[rows], labels[rows], smoothing=True)
+        distances = projector.compute_distance(x_stars[rows], x_tt).tolist()
+        distances_smooth = projector.compute_distance(x_stars[rows], x_tt_smooth).tolist()
+        logging.info('Smoothed decisions: {} votes for {} points ({:.1f} per point)'.format(
+            projector.smoothed.num_samples, projector.smoothed.num_points,
+            projector.smoothed.num_samples / max(projector.smoothed.num_points, 1)))
+        for j, key in enumerate(missing):
+            cache[key] = (distances[j], distances_smooth[j])
+        if use_cache:
+            save_cache(cache, cache_path)
+
+    D[rows_t, rows_i] = torch.tensor([cache[key][0] for key in keys], device=device)
+    D_SMOOTH[rows_t, rows_i] = torch.tensor([cache[key][1] for key in keys], device=device)
+    D_VANILLA[rows_t, rows_i] = compute_distance(x_stars, x_ts, params['distance_metric'])
+    MC[rows_t, rows_i] = torch.tensor(calls, dtype=MC.dtype, device=device)
+    steps = rows_t > 0
+    D_G[rows_t[steps], rows_i[steps]] = compute_distance(x_stars[steps], x_gs, params['distance_metric'])
+    if 0 in iterations:
+        D_OUT[0] = -1
+    if exp_name.startswith('psj'):
+        D_OUT[rows_t[steps], rows_i[steps]] = D[rows_t[steps] - 1, rows_i[steps]]
+    for metric in (D, D_SMOOTH, D_VANILLA, D_G, D_OUT, MC):
+        metric[missing_cells] = float('nan')
+    AA[:, missing_cells] = float('nan')
+
+    dump = {
+        'border_distance': D,
+        'border_distance_smooth': D_SMOOTH,
+        'vanilla_distance': D_VANILLA,
+        'distance_approxgrad': D_G,
+        'attack_out_distance': D_OUT,
+        'model_calls': MC,
+        'adv_acc': AA,
+    }
+    torch.save(dump, open(f'{OUT_DIR}/{exp_name}/crunched.pkl', 'wb'))
+    # Scalar columns for the plotting scripts
+    metrics = MetricsStore(OUT_DIR)
+    metrics.add_crunched(exp_name, dump)
+    metrics.add_raw(exp_name, RunTracker.from_diaries(raw, image_fields=()))
+    return exp_name
+
+
+def get_models(dataset, params, device):
+    key = 'cifar10' if dataset == 'cifar10' else 'mnist_noman'
+    model = get_model(key=key, dataset=dataset, beta=params['beta'])
+    model_noisy = get_model(key=key, dataset=dataset, noise=params['noise'], smoothing_noise=params['smoothing_noise'],
+                            crop_size=params['crop_size'], drop_rate=params['drop_rate'])
+    model.model = model.model.to(device)
+    model_noisy.model = model_noisy.model.to(device)
+    return model, model_noisy
+
+
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def main():
+    args = parser.parse_args()
+    exp_names = args.exp_names.split(',')
+    only_last = args.mode == 'last'
+    if args.workers <= 1 or len(exp_names) == 1:
+        for exp_name in exp_names:
+            crunch(exp_name, args.dataset, only_last, not args.no_cache)
+        return
+    # Every worker gets its share of the cores for intra-op parallelism
+    num_threads = max(1, torch.get_num_threads() // args.workers)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(num_threads,)) as pool:
+        futures = [pool.submit(crunch, exp_name, args.dataset, only_last, not args.no_cache) for exp_name in exp_names]
+        for future in futures:
+            print('Crunched {}'.format(future.result()))
+
+
+if __name__ == '__main__':
+    main()
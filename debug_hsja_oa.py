@@ -2,7 +2,7 @@ import pickle
 import numpy as np
 import matplotlib.pylab as plt
 from model_factory import get_model
-from tracker import Diary
+from tracker import Diary, load_diaries
 
 NUM_ITERATIONS = 32
 NUM_IMAGES = 100
@@ -22,11 +22,11 @@ ALPHA = 0.4
 
 model = get_model(key='mnist_noman', dataset='mnist')
 
-import torch
+
 def read_dump(path):
     filepath = 'adv/{}/raw_data.pkl'.format(path)
     if path in exp_names:
-        raw = torch.load(open(filepath, 'rb'), map_location='cpu')
+        raw = load_diaries(filepath, map_location='cpu')
     else:
         raw = pickle.load(open(filepath, 'rb'))
     return raw
@@ -66,7 +66,7 @@ for i, raw in enumerate(raws):
                 cn+=1
                 continue
             x_star = diary.original
-            x_t = diary.iterations[iteration].bin_search.numpy()
+            x_t = diary.iterations[min(iteration, len(diary.iterations) - 1)].bin_search.numpy()
             label = diary.true_label
             distance = np.linalg.norm(x_star - x_t) ** 2 / 784 / 1 ** 2
             probs = model.get_probs([x_t])
@@ -9,12 +9,31 @@ class DefaultParams:
     def __init__(self):
         self.attack = 'popskip'
         self.targeted = False
+        self.all_targets = False  # Targeted sweep: attack every image towards all other labels, sharing queries
         self.dataset = 'mnist'
         self.model_keys: dict = {'mnist': ['mnist_noman'], 'cifar10': ['cifar10']}
         self.model_keys_filepath = None
         # self.model_keys_filepath = 'data/model_dumps/filtered_models.txt'
         # self.model_keys_filepath = 'training/data/model_dumps/filtered_models_1each.txt'
+        self.vectorize_ensemble = False  # Stack same-architecture models so that each sample picks its own model
+        self.inference_backend = 'eager'  # cifar10 model: 'eager', 'fold_bn', 'torchscript' or 'compile'
+        self.quantize = None  # None, 'dynamic' or 'static' int8 quantization of the models (CPU only)
         self.num_iterations = 32
+        self.image_dtype = 'float32'  # Storage of images in raw_data.pkl: 'float32', 'float16' or 'uint8'
+        self.resume = False  # Skip the images already in the result shards of the experiment
+        self.checkpoint_every = None  # Checkpoint the attack of an image every this many iterations (None disables)
+        self.checkpoint_dir = None  # Set by app.py to the checkpoints directory of the experiment
+        self.profile = False  # Record per-phase wall time, forward time, batch sizes and memory in the diary pages
+        self.profile_trace_dir = None  # Also save a torch.profiler trace of every image there (set by app.py)
+        # Early termination of an attack (None disables a criterion)
+        self.stop_window = None  # Stop when distance improved by less than stop_rel_improvement over this many iterations
+        self.stop_rel_improvement = 0.01
+        self.max_model_calls = None  # Stop once an image has used this many model calls
+        self.target_distance = None  # Stop once the distance (same units as DiaryPage.distance) reaches this value
+        # Hard query budget enforced by ModelInterface (None for unlimited)
+        self.query_budget = None  # Per image
+        self.query_budget_shares = None  # e.g. {'bin_search': 0.3, 'approx_grad': 0.6}, as fractions of query_budget
+        self.run_query_budget = None  # Over all images of a run
         self.internal_dtype = torch.float32
         self.bounds = (0, 1)
         self.gamma = 1.0
@@ -26,7 +45,9 @@ class DefaultParams:
         self.initial_num_evals = 100  # B_0 (i.e. num of queries for first iteration of original HSJA)
         self.max_num_evals = 50000  # Maximum queries allowed in Approximate Gradient Step
         self.eval_factor = 1  # times the number of queries in approx gradient step
-        # self.stepsize_search = "geometric_progression"  # Deprecating this
+        self.stepsize_search = "fixed"  # HSJ: 'fixed' (dist / sqrt(t)) or 'geometric' (batched HSJA progression)
+        self.stepsize_ladder = 10  # K: rungs dist/sqrt(t) * 2^-k for k=0..K are evaluated in one call
+        self.stepsize_early_exit = False  # Query the first rung alone before evaluating the rest of the ladder
         self.distance = "linf"  # Distance metric
         self.batch_size = 256
 
@@ -53,9 +74,19 @@ class DefaultParams:
 
         # Specific to Approximate Gradient
         self.grad_queries = 1
+        self.regenerate_directions = False  # Regenerate random directions from counter-based seeds to save memory
+        self.regen_chunk_size = 64  # Number of directions alive at once when regenerate_directions is True
+        self.sampling_basis = 'full'  # Subspace of random directions: 'full', 'dct', 'resize' or 'custom'
+        self.subspace_ratio = 0.25  # Fraction of each side (height, width) kept by 'dct' and 'resize' bases
+        self.basis_path = None  # Path to a [k, d] tensor with orthonormal rows, used by the 'custom' basis
+        self.sequential_grad = False  # PSJ: stop gradient sampling once the estimate reaches the infomax target cosine
+        self.sequential_z = 1.0  # Number of standard deviations subtracted in the split-half convergence test
 
         self.theta_fac = -1
 
+        # Specific to Binary Search
+        self.search_arity = 2  # k-ary search: k-1 points per round in one call. Larger k = fewer, bigger rounds
+
         # Specific to Experiment mode
         self.experiment_mode = True
         self.num_samples = 3
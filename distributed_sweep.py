@@ -0,0 +1,319 @@
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch.distributed as dist
+from result_store import ShardedResultStore
+from sweep import OUT_DIR, app_parser, config_to_argv, core_slots, git_commit, plan_sweep, read_metadata, run_pinned, \
+    write_metadata
+
+logging.root.setLevel(logging.WARNING)
+parser = argparse.ArgumentParser()
+parser.add_argument("role", type=str, help="coordinator (one, holds the result stores) or worker (one or more per node)")
+parser.add_argument("grid", type=str, nargs='?', default=None, help="Coordinator: JSON sweep file, see sweep.py")
+parser.add_argument("-ma", "--master_addr", type=str, default='127.0.0.1', help="Address of the coordinator")
+parser.add_argument("-mp", "--master_port", type=int, default=29500, help="Port of the coordinator")
+parser.add_argument("-ipu", "--images_per_unit", type=int, default=5,
+                    help="Coordinator: number of images of a config attacked by one work unit")
+parser.add_argument("-lw", "--local_workers", type=int, default=0,
+                    help="Coordinator: also start this many worker processes on this machine")
+parser.add_argument("-wt", "--worker_timeout", type=float, default=120.,
+                    help="Coordinator: seconds without heartbeat after which a worker is dead and its unit reassigned")
+parser.add_argument("-mat", "--max_attempts", type=int, default=3,
+                    help="Coordinator: attempts of a unit before its experiment is marked as failed")
+parser.add_argument("--no_crunch", action='store_true', help="Coordinator: do not crunch the experiments once done")
+parser.add_argument("-w", "--workers", type=int, default=1, help="Worker: number of units run in parallel on this node")
+parser.add_argument("-cpr", "--cores_per_run", type=int, default=None,
+                    help="Worker: (Optional) cores pinned to every unit, all available cores are shared out by default")
+parser.add_argument("-hi", "--heartbeat_interval", type=float, default=5., help="Worker: seconds between heartbeats")
+
+POLL_INTERVAL = 0.5
+STORE_TIMEOUT = datetime.timedelta(seconds=300)
+
+
+def connect(addr, port, is_master=False):
+    """ Key-value store of torch.distributed over TCP, served by the coordinator """
+    return dist.TCPStore(addr, port, None, is_master, timeout=STORE_TIMEOUT, wait_for_workers=False)
+
+
+def unit_exp_name(unit):
+    """ Units write their own run under the experiment, e.g. <exp>/units/images_0_5 """
+    return '{}/units/images_{}_{}'.format(unit['exp_name'], unit['start'], unit['end'])
+
+
+def global_key(key, start):
+    """ Key of a unit result in the experiment store: image indices of a unit start at 0 """
+    parts = key.split(':')
+    return ':'.join([str(int(parts[0]) + start)] + parts[1:])
+
+
+def run_unit(unit, parser, cores, out_dir=OUT_DIR):
+    """
+    Attacks the images [start, end) of a config with app.py
+    :return: result sent back to the coordinator, with the exported shards of the unit when it succeeded
+    """
+    exp_name = unit_exp_name(unit)
+    config = dict(unit['config'], exp_name=exp_name, samples_from=unit['start'], num_samples=unit['end'] - unit['start'])
+    # Later attempts continue from the shards and checkpoints an earlier attempt left (if it ran on this file system)
+    argv = config_to_argv(config, parser) + (['--resume'] if unit['attempt'] > 1 else [])
+    os.makedirs(os.path.join(out_dir, exp_name), exist_ok=True)
+    code = run_pinned([sys.executable, 'app.py'] + argv, cores, os.path.join(out_dir, exp_name, 'log.txt'))
+    result = {'unit': unit['id'], 'attempt': unit['attempt'], 'return_code': code, 'shards': {}}
+    if code == 0:
+        store = ShardedResultStore(os.path.join(out_dir, exp_name, 'shards'), resume=True)
+        result['shards'] = {key: store.export_shard(key) for key in store.keys()}
+    return result
+
+
+def worker_loop(addr, port, cores, ids, out_dir=OUT_DIR):
+    """
+    One worker: asks the coordinator for a unit, runs it, sends back its result, and so on until told to stop.
+    Keys of the store used by worker w: ready/<w> (number of units asked for), assign/<w>/<n> (n-th unit),
+    results/<w> (number of results sent), result/<w>/<n> (n-th result).
+    """
+    store = connect(addr, port)
+    parser = app_parser()
+    w = store.add('workers', 1) - 1
+    store.set('worker/{}'.format(w), '{}:{} cores {}'.format(socket.gethostname(), os.getpid(), cores))
+    ids.append(w)
+    num_results = 0
+    while True:
+        n = store.add('ready/{}'.format(w), 1)
+        key = 'assign/{}/{}'.format(w, n)
+        while not store.check([key]) and not store.check(['shutdown']):
+            time.sleep(POLL_INTERVAL)
+        if not store.check([key]):
+            return
+        unit = json.loads(store.get(key))
+        logging.warning('Worker {} running {} (attempt {})'.format(w, unit_exp_name(unit), unit['attempt']))
+        try:
+            result = run_unit(unit, parser, cores, out_dir)
+        except Exception as e:
+            logging.exception('Worker {} failed on {}'.format(w, unit_exp_name(unit)))
+            result = {'unit': unit['id'], 'attempt': unit['attempt'], 'return_code': repr(e), 'shards': {}}
+        num_results += 1
+        # The result is in the store before the counter moves, so the coordinator never reads a missing result
+        store.set('result/{}/{}'.format(w, num_results), pickle.dumps(result))
+        store.add('results/{}'.format(w), 1)
+
+
+def run_worker(addr, port, workers=1, cores_per_run=None, heartbeat_interval=5.):
+    """ Runs `workers` workers in this process, each pinned to its own cores, with a common heartbeat """
+    ids = []
+    threads = [threading.Thread(target=worker_loop, args=(addr, port, cores, ids))
+               for cores in core_slots(workers, cores_per_run)]
+    for thread in threads:
+        thread.start()
+
+    def heartbeat():
+        store = connect(addr, port)
+        while any(thread.is_alive() for thread in threads):
+            for w in list(ids):
+                store.add('heartbeat/{}'.format(w), 1)
+            time.sleep(heartbeat_interval)
+    threading.Thread(target=heartbeat, daemon=True).start()
+    for thread in threads:
+        thread.join()
+
+
+class SweepCoordinator(object):
+    """
+        Splits every config of a sweep into units of images_per_unit images and hands them out to the workers that
+        connect to its store. The coordinator is the only process writing the experiment outputs: the shards sent back
+        by the workers go into thesis/<exp>/shards, and once all the units of an experiment are in it is consolidated
+        into raw_data.pkl and crunched. Progress is kept in thesis/<exp>/config.json (see sweep.py), so a restarted
+        coordinator skips the experiments and units already done.
+        A worker whose heartbeat stops for worker_timeout seconds is dead and its unit goes back to the queue, as does
+        the unit of a worker whose run failed. A unit failing max_attempts times fails its experiment.
+    """
+    def __init__(self, store, spec, images_per_unit=5, worker_timeout=120., max_attempts=3, crunch=True,
+                 out_dir=OUT_DIR):
+        self.store = store
+        self.parser = app_parser()
+        self.images_per_unit = images_per_unit
+        self.worker_timeout = worker_timeout
+        self.max_attempts = max_attempts
+        self.crunch = crunch
+        self.out_dir = out_dir
+        self.units = {}
+        self.pending = collections.deque()
+        self.done_units = set()
+        self.experiments = {}
+        self.workers = {}
+        self.running = {}
+        self.crunch_pool = ThreadPoolExecutor(max_workers=1)
+        self.crunch_jobs = []
+        for exp_name, config, done in plan_sweep(spec, self.parser, crunch, out_dir):
+            if not done:
+                self.add_experiment(exp_name, config)
+
+    def add_experiment(self, exp_name, config):
+        previous = read_metadata(exp_name, self.out_dir)
+        resume = previous is not None and previous.get('config') == config
+        metadata = {'exp_name': exp_name, 'config': config, 'status': 'running', 'crunched': False,
+                    'host': socket.gethostname(), 'git_commit': git_commit(), 'started': time.time(),
+                    'units_done': previous.get('units_done', []) if resume else []}
+        exp = {'config': config, 'metadata': metadata, 'units_left': set(),
+               'store': ShardedResultStore(os.path.join(self.out_dir, exp_name, 'shards'), resume=resume,
+                                           config=config)}
+        self.experiments[exp_name] = exp
+        write_metadata(exp_name, metadata, self.out_dir)
+        if resume and previous.get('status') == 'done':
+            # Only the crunch is missing
+            metadata['status'] = 'done'
+            self.finish_experiment(exp_name)
+            return
+        done = [tuple(images) for images in metadata['units_done']]
+        num_samples = int(config['num_samples'])
+        for start in range(0, num_samples, self.images_per_unit):
+            end = min(start + self.images_per_unit, num_samples)
+            if (start, end) in done:
+                continue
+            unit = {'id': len(self.units), 'exp_name': exp_name, 'config': config, 'start': start, 'end': end,
+                    'attempt': 1}
+            self.units[unit['id']] = unit
+            exp['units_left'].add(unit['id'])
+            self.pending.append(unit['id'])
+        if len(exp['units_left']) == 0:
+            self.finish_experiment(exp_name)
+
+    def finish_experiment(self, exp_name):
+        exp = self.experiments[exp_name]
+        metadata = exp['metadata']
+        if metadata['status'] == 'running':
+            exp['store'].consolidate(os.path.join(self.out_dir, exp_name, 'raw_data.pkl'))
+            metadata['status'] = 'done'
+        metadata['finished'] = time.time()
+        write_metadata(exp_name, metadata, self.out_dir)
+        logging.warning('{}: {}'.format(exp_name, metadata['status']))
+        if metadata['status'] == 'done' and self.crunch:
+            self.crunch_jobs.append(self.crunch_pool.submit(self.crunch_experiment, exp_name))
+
+    def crunch_experiment(self, exp_name):
+        exp = self.experiments[exp_name]
+        code = run_pinned([sys.executable, 'crunch_experiments.py', exp_name, exp['config']['dataset']],
+                          core_slots(1)[0], os.path.join(self.out_dir, exp_name, 'log.txt'))
+        exp['metadata']['crunched'] = code == 0
+        write_metadata(exp_name, exp['metadata'], self.out_dir)
+
+    def retry(self, unit_id, reason):
+        unit = self.units[unit_id]
+        exp = self.experiments[unit['exp_name']]
+        logging.warning('{} failed ({}) on attempt {}'.format(unit_exp_name(unit), reason, unit['attempt']))
+        if unit['attempt'] >= self.max_attempts:
+            exp['metadata']['status'] = 'failed'
+            exp['metadata'].setdefault('units_failed', []).append([unit['start'], unit['end']])
+            self.complete_unit(unit_id)
+            return
+        unit['attempt'] += 1
+        self.pending.appendleft(unit_id)
+
+    def complete_unit(self, unit_id):
+        unit = self.units[unit_id]
+        exp = self.experiments[unit['exp_name']]
+        self.done_units.add(unit_id)
+        exp['units_left'].discard(unit_id)
+        write_metadata(unit['exp_name'], exp['metadata'], self.out_dir)
+        if len(exp['units_left']) == 0:
+            self.finish_experiment(unit['exp_name'])
+
+    def handle_result(self, w, result):
+        unit_id = result['unit']
+        if self.running.get(w) == unit_id:
+            del self.running[w]
+        if unit_id in self.done_units:
+            # Late result of a unit that was reassigned and done by another worker meanwhile
+            return
+        unit = self.units[unit_id]
+        if result['return_code'] != 0:
+            if result['attempt'] == unit['attempt']:
+                self.retry(unit_id, 'return code {}'.format(result['return_code']))
+            return
+        exp = self.experiments[unit['exp_name']]
+        for key, (data, entry) in result['shards'].items():
+            key = global_key(key, unit['start'])
+            if key not in exp['store']:
+                exp['store'].import_shard(key, data, entry)
+        exp['metadata']['units_done'].append([unit['start'], unit['end']])
+        if unit_id in self.pending:
+            self.pending.remove(unit_id)
+        self.complete_unit(unit_id)
+
+    def poll(self):
+        """ One round: new workers, results, dead workers and assignments """
+        now = time.time()
+        for w in range(len(self.workers), self.store.add('workers', 0)):
+            self.workers[w] = {'heartbeat': -1, 'seen': now, 'alive': True, 'assigned': 0, 'results': 0,
+                               'name': self.store.get('worker/{}'.format(w)).decode()}
+            logging.warning('Worker {} joined: {}'.format(w, self.workers[w]['name']))
+        # Workers send their result before asking for a new unit, so reading the requests first never misses a result
+        ready = {w: self.store.add('ready/{}'.format(w), 0) for w, worker in self.workers.items() if worker['alive']}
+        for w, worker in self.workers.items():
+            num_results = self.store.add('results/{}'.format(w), 0)
+            while worker['results'] < num_results:
+                worker['results'] += 1
+                key = 'result/{}/{}'.format(w, worker['results'])
+                self.handle_result(w, pickle.loads(self.store.get(key)))
+                self.store.delete_key(key)
+        for w, worker in self.workers.items():
+            if not worker['alive']:
+                continue
+            heartbeat = self.store.add('heartbeat/{}'.format(w), 0)
+            if heartbeat != worker['heartbeat']:
+                worker['heartbeat'], worker['seen'] = heartbeat, now
+            elif now - worker['seen'] > self.worker_timeout:
+                worker['alive'] = False
+                logging.warning('Worker {} ({}) is dead'.format(w, worker['name']))
+                if w in self.running:
+                    self.retry(self.running.pop(w), 'worker {} died'.format(w))
+        for w, worker in self.workers.items():
+            if worker['alive'] and w not in self.running and ready[w] > worker['assigned'] and len(self.pending) > 0:
+                unit_id = self.pending.popleft()
+                worker['assigned'] += 1
+                self.store.set('assign/{}/{}'.format(w, worker['assigned']), json.dumps(self.units[unit_id]))
+                self.running[w] = unit_id
+
+    def run(self):
+        while len(self.done_units) < len(self.units):
+            self.poll()
+            time.sleep(POLL_INTERVAL)
+        for job in self.crunch_jobs:
+            job.result()
+        self.crunch_pool.shutdown()
+        self.store.set('shutdown', '1')
+        return [exp['metadata'] for exp in self.experiments.values()]
+
+
+def main():
+    args = parser.parse_args()
+    if args.role == 'worker':
+        run_worker(args.master_addr, args.master_port, args.workers, args.cores_per_run, args.heartbeat_interval)
+        return
+    with open(args.grid, 'r') as f:
+        spec = json.load(f)
+    store = connect(args.master_addr, args.master_port, is_master=True)
+    local_workers = [subprocess.Popen([sys.executable, __file__, 'worker', '-ma', args.master_addr, '-mp',
+                                       str(args.master_port), '-hi', str(args.heartbeat_interval)])
+                     for _ in range(args.local_workers)]
+    coordinator = SweepCoordinator(store, spec, args.images_per_unit, args.worker_timeout, args.max_attempts,
+                                   not args.no_crunch)
+    results = coordinator.run()
+    for process in local_workers:
+        process.wait()
+    # Workers still waiting for a unit see the shutdown key before the store goes away
+    time.sleep(2 * max(POLL_INTERVAL, 1.))
+    failed = [m['exp_name'] for m in results if m['status'] != 'done']
+    logging.warning('{} experiments, {} failed {}'.format(len(results), len(failed), failed if failed else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import copy
+import logging
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+
+class StackedEnsemble(nn.Module):
+    """
+        Runs M models of the same architecture as one vectorised module.
+        Every sample of a batch is routed to a model drawn uniformly at random. Samples are bucketed per model
+        (padded to the largest bucket) and all the buckets go through a single vmap-ed forward pass over the stacked
+        parameters of the models.
+    """
+    def __init__(self, modules):
+        super().__init__()
+        self.num_models = len(modules)
+        params, buffers = stack_module_state(modules)
+        # Stacked tensors are kept as buffers so that .to(device) moves them along with the module
+        self.param_names = list(params.keys())
+        self.buffer_names = list(buffers.keys())
+        for name, tensor in list(params.items()) + list(buffers.items()):
+            self.register_buffer(self._key(name), tensor.detach())
+        # Stateless copy of the architecture, only used for its forward function
+        self.base = [copy.deepcopy(modules[0]).to('meta')]
+        self.model_ids = None  # model used by every sample of the last forward pass
+
+    @staticmethod
+    def _key(name):
+        return 'stacked__' + name.replace('.', '__')
+
+    def _stacked(self, names):
+        return {name: getattr(self, self._key(name)) for name in names}
+
+    def forward(self, x, model_ids=None):
+        if model_ids is None:
+            model_ids = torch.randint(self.num_models, size=(len(x),), device=x.device)
+        self.model_ids = model_ids
+        counts = torch.bincount(model_ids, minlength=self.num_models)
+        n_max = int(counts.max())
+        # Position of every sample inside its model's bucket
+        order = torch.argsort(model_ids, stable=True)
+        starts = torch.cumsum(counts, dim=0) - counts
+        slots = torch.empty_like(model_ids)
+        slots[order] = torch.arange(len(x), device=x.device) - starts[model_ids[order]]
+        buckets = x.new_zeros([self.num_models, n_max] + list(x.shape[1:]))
+        buckets[model_ids, slots] = x
+
+        base = self.base[0]
+
+        def run(params, buffers, inputs):
+            return functional_call(base, (params, buffers), (inputs,))
+
+        outs = vmap(run, randomness='different')(self._stacked(self.param_names), self._stacked(self.buffer_names),
+                                                 buckets)
+        return outs[model_ids, slots]
+
+
+def stack_models(models):
+    """
+    Replaces a list of Model wrappers by a single wrapper around a StackedEnsemble.
+    Models can only be stacked if they share the wrapper class and the architecture; otherwise they are returned as is.
+    :return: list of Model wrappers
+    """
+    if len(models) < 2:
+        return models
+    # Wrapper classes are defined inside get_model(), so they are compared by name
+    architectures = {(type(m).__qualname__, type(m.model)) for m in models}
+    if len(architectures) > 1 or models[0].model is None:
+        logging.warning('Models have different architectures, they will not be vectorised')
+        return models
+    modules = [m.model for m in models]
+    # e.g. dropout noise only puts some layers in train mode. The stacked copy keeps the modes of the first model.
+    if len({tuple(sub.training for sub in m.modules()) for m in modules}) > 1:
+        logging.warning('Models are in different train/eval modes, they will not be vectorised')
+        return models
+    stacked = copy.copy(models[0])
+    stacked.model = StackedEnsemble(modules)
+    return [stacked]
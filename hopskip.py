@@ -11,12 +11,16 @@ class HopSkipJump(Attack):
         Implements Original HSJA.
         When repeat_queries=1, it is same as vanilla HSJA.
     """
+    MAX_STEPSIZE_RUNGS = 64  # Give up halving the step-size after 2^-64
 
     def __init__(self, model_interface, data_shape, device=None, params: DefaultParams = None):
         super().__init__(model_interface, data_shape, device, params)
         self.grad_queries = 1  # Original HSJA does not perform multiple queries
         self.repeat_queries = 1
         self.eval_factor = params.eval_factor
+        self.stepsize_search = params.stepsize_search
+        self.stepsize_ladder = params.stepsize_ladder
+        self.stepsize_early_exit = params.stepsize_early_exit
 
     def bin_search_step(self, original, perturbed, page=None, estimates=None, step=None):
         perturbed, dist_post_update = self.binary_search_batch(original, perturbed[None])
@@ -61,17 +65,18 @@ class HopSkipJump(Attack):
                 thresholds /= self.d
 
         lows = torch.zeros(len(perturbed_inputs), device=self.device)
+        # Every input is searched at k-1 points per round, all in one decision call
+        repeated_inputs = perturbed_inputs.repeat_interleave(self.search_arity - 1, dim=0)
 
         # Call recursive function.
         while torch.max((highs - lows) / thresholds) > 1:
             # projection to mids.
-            mids = (highs + lows) / 2.0
-            mid_inputs = self.project(unperturbed, perturbed_inputs, mids)
+            mids = self.kary_search_points(lows, highs)
+            mid_inputs = self.project(unperturbed, repeated_inputs, mids.flatten())
 
             # Update highs and lows based on model decisions.
             decisions = self.decision_by_polling(mid_inputs)
-            lows = torch.where(decisions == 0, mids, lows)
-            highs = torch.where(decisions == 1, mids, highs)
+            lows, highs = self.kary_search_update(lows, highs, mids, decisions.view(mids.shape))
 
         out_inputs = self.project(unperturbed, perturbed_inputs, highs)
 
@@ -88,20 +93,32 @@ class HopSkipJump(Attack):
         """ Geometric progression to search for stepsize.
           Keep decreasing stepsize by half until reaching
           the desired side of the boundary.
+          With stepsize_search='geometric', the whole ladder dist/sqrt(t) * 2^-k, k=0..K is evaluated in a single
+          decision call and the largest successful step is returned. If no rung succeeds, the next K+1 rungs are tried.
         """
         epsilon = dist / math.sqrt(current_iteration)
-        # count = 1
-        # while True:
-        #     if count % 200 == 0:
-        #         logging.warning("Decreased epsilon {} times".format(count))
-        #     updated = torch.clamp(x + epsilon * update, self.clip_min, self.clip_max)
-        #     success = (self.decision_by_repetition(updated[None]))[0]
-        #     if success:
-        #         break
-        #     else:
-        #         epsilon = epsilon / 2.0  # pragma: no cover
-        #         count += 1
-        return epsilon
+        if self.stepsize_search == 'fixed':
+            return epsilon
+        if self.stepsize_early_exit:
+            updated = torch.clamp(x + epsilon * update, self.clip_min, self.clip_max)
+            if self.decision_by_polling(updated[None])[0] == 1:
+                return epsilon
+            first_rung = 1
+        else:
+            first_rung = 0
+        num_rungs = self.stepsize_ladder + 1
+        while first_rung < self.MAX_STEPSIZE_RUNGS:
+            rungs = torch.arange(first_rung, first_rung + num_rungs, device=self.device)
+            epsilons = epsilon * 2.0 ** (-rungs.float())
+            eps_shape = [len(epsilons)] + [1] * len(self.shape)
+            updated = torch.clamp(x + epsilons.view(eps_shape) * update, self.clip_min, self.clip_max)
+            decisions = self.decision_by_polling(updated)
+            success = torch.nonzero(decisions == 1)
+            if len(success) > 0:
+                return epsilons[success[0, 0]]
+            logging.warning("No successful step-size in rungs {} to {}".format(first_rung, first_rung + num_rungs - 1))
+            first_rung += num_rungs
+        return epsilon * 2.0 ** (-first_rung)
 
     def _gradient_estimator(self, sample, num_evals, delta):
         """
@@ -109,7 +126,18 @@ class HopSkipJump(Attack):
             Result is accumulated by doing polling
         """
         # Generate random vectors.
-        num_rvs = int(num_evals)
+        num_rvs = self.affordable_directions(int(num_evals), self.repeat_queries)
+        if self.regenerate_directions:
+            sum_directions, num_rvs = self._regenerated_sum_directions(sample, num_rvs, delta,
+                                                                       self.decision_by_polling, 1)
+        else:
+            sum_directions = self._sampled_sum_directions(sample, num_rvs, delta)
+        # Get the gradient direction.
+        gradf = sum_directions / num_rvs
+        gradf = gradf / torch.norm(gradf)
+        return gradf, sum_directions, num_rvs
+
+    def _sampled_sum_directions(self, sample, num_rvs, delta):
         sum_directions = torch.zeros(self.shape, device=self.device)
         num_batchs = int(math.ceil(num_rvs * 1.0 / self.batch_size))
         for j in range(num_batchs):
@@ -128,10 +156,7 @@ class HopSkipJump(Attack):
             else:
                 vals = fval - torch.mean(fval)
             sum_directions = sum_directions + torch.sum(vals * rv, dim=0)
-        # Get the gradient direction.
-        gradf = sum_directions / num_rvs
-        gradf = gradf / torch.norm(gradf)
-        return gradf, sum_directions, num_rvs
+        return sum_directions
 
     def decision_by_polling(self, perturbed):
         if self.targeted:
@@ -146,7 +171,7 @@ class HopSkipJump(Attack):
                 distance = self.a.calculate_distance(perturbed[i], self.bounds)
                 if self.a.distance > distance:
                     self.a.distance = distance
-                    self.a.perturbed = perturbed[i]
+                    self.a.perturbed = perturbed[i].clone()  # perturbed may be a reused buffer
         return decisions
 
 
@@ -185,12 +210,14 @@ class HopSkipJumpTrueGradient(HopSkipJump):
         Implements HSJ with access to true gradients of the underlying classifier
     """
     def gradient_approximation_step(self, perturbed, num_evals_det, delta, dist_post_update, estimates, page):
-        self.model_interface.model_calls += 1
+        self.model_interface.charge(1)
         grad = self.model_interface.get_grads(perturbed[None], self.a.true_label)[0]
         return grad / torch.norm(grad)
 
 
 class HopSkipJumpAllGradient(HopSkipJump):
+    CHECKPOINT_ATTRIBUTES = HopSkipJump.CHECKPOINT_ATTRIBUTES + ('sum_directions', 'num_directions')
+
     def __init__(self, model_interface, data_shape, device=None, params: DefaultParams = None):
         super().__init__(model_interface, data_shape, device, params)
         self.sum_directions = torch.zeros(self.shape, device=self.device)
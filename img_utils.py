@@ -58,12 +58,27 @@ def find_adversarial_images(dataset, labels):
     return starts, targeted_labels
 
 
-def get_samples_for_cropping(dataset, model, n_samples=100, conf=0.75):
+def _read_samples_cache(data_path):
     import os
-    data_path = f'data/images_{dataset}_{n_samples}.pkl'
     if not os.path.exists(data_path):
-        print("Image pickle not found")
-        np.random.seed(42)
+        return None
+    return torch.load(open(data_path, 'rb'), weights_only=False)
+
+
+def get_samples_for_cropping(dataset, model, n_samples=100, conf=0.75, seed=42):
+    """
+    Test images that the cropping model classifies correctly on more than a fraction conf of 100 random crops.
+    The candidates are explored in a fixed order and the crops are drawn from a seeded generator, so the selection of n
+    images is the prefix of the selection of any larger number: runs over a sub-range of the images (e.g. the units of
+    a distributed sweep) get exactly the images of the full run.
+    The largest selection made so far is cached per dataset and conf in data/images_<dataset>_c<conf>.pkl, written to
+    a temporary file and renamed so that concurrent runs never read a partial file.
+    """
+    import os
+    data_path = f'data/images_{dataset}_c{conf}.pkl'
+    dump = _read_samples_cache(data_path)
+    if dump is None or len(dump['labels']) < n_samples:
+        print("Image pickle not found" if dump is None else "Image pickle too small, extending the selection")
         if dataset == 'mnist':
             test_data = datasets.MNIST(root="data", train=False, download=True, transform=None)
             samples = test_data.data
@@ -74,31 +89,39 @@ def get_samples_for_cropping(dataset, model, n_samples=100, conf=0.75):
             targets = test_data.targets
         else:
             raise RuntimeError('Unknown Dataset: {}'.format(dataset))
-        candidates = np.random.choice(len(test_data), len(test_data), replace=False)
+        candidates = np.random.RandomState(seed).choice(len(test_data), len(test_data), replace=False)
         indices = []
         i = 0
-        while len(indices) != n_samples:
-            if i % 4 == 0:
-                print(i, 'explored', len(indices), 'found')
-            if dataset == 'mnist':
-                batch = samples[candidates[i]][None].repeat(100, 1, 1) / 255.0
-            elif dataset == 'cifar10':
-                batch = torch.tensor(samples[candidates[i]][None])
-                batch = batch.repeat(100, 1, 1, 1) / 255.0
-            else:
-                raise RuntimeError
-            pred = model.ask_model(batch)
-            p = torch.sum(pred == targets[candidates[i]]) / 100.
-            if p > conf:
-                indices.append(candidates[i])
-            i += 1
+        # The crops of the model are drawn from the global generator, seeded here without disturbing the caller
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            while len(indices) != n_samples:
+                if i % 4 == 0:
+                    print(i, 'explored', len(indices), 'found')
+                if dataset == 'mnist':
+                    batch = samples[candidates[i]][None].repeat(100, 1, 1) / 255.0
+                elif dataset == 'cifar10':
+                    batch = torch.tensor(samples[candidates[i]][None])
+                    batch = batch.repeat(100, 1, 1, 1) / 255.0
+                else:
+                    raise RuntimeError
+                pred = model.ask_model(batch)
+                p = torch.sum(pred == targets[candidates[i]]) / 100.
+                if p > conf:
+                    indices.append(candidates[i])
+                i += 1
         targets = np.array(targets)
         images = samples[indices] / 255.0
         labels = targets[indices]
-        dump = {'images': images, 'labels': labels}
+        dump = {'images': images, 'labels': labels, 'indices': indices, 'conf': conf, 'seed': seed}
         print("Images indices: ", indices)
-        torch.save(dump, open(data_path, 'wb'))
-    dump = torch.load(open(data_path, 'rb'))
+        # Another run may have cached a larger selection meanwhile, which has the same prefix
+        cached = _read_samples_cache(data_path)
+        if cached is None or len(cached['labels']) < len(labels):
+            tmp_path = '{}.{}.tmp'.format(data_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                torch.save(dump, f)
+            os.replace(tmp_path, data_path)
     images, labels = dump['images'], dump['labels']
     return images[:n_samples], labels[:n_samples]
 
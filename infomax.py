@@ -219,7 +219,10 @@ def plot_acquisition(k, xx, a_x, pts_x, ttss, output, acq_func):
     plt.show()
 
 
-def get_bernoulli_probs(xx, unperturbed, perturbed, model_interface, label, dist_metric='l2', targeted=False):
+def interpolate(xx, unperturbed, perturbed, dist_metric='l2'):
+    """
+        Points queried by bin_search at locations xx (xx=0 -> perturbed, xx=1 -> unperturbed)
+    """
     dims = [-1] + [1] * unperturbed.ndim
     xx = xx.view(dims)
     if dist_metric == 'l2':
@@ -232,6 +235,12 @@ def get_bernoulli_probs(xx, unperturbed, perturbed, model_interface, label, dist
         batch = torch.where(batch < min_limit, min_limit, batch)
     else:
         raise RuntimeError(f'Unknown Distance Metric: {dist_metric}')
+    return batch
+
+
+def get_bernoulli_probs(xx, unperturbed, perturbed, model_interface, label, dist_metric='l2', targeted=False):
+    batch = interpolate(xx, unperturbed, perturbed, dist_metric)
+    xx = xx.view([-1] + [1] * unperturbed.ndim)
     if model_interface.noise in ["deterministic", "dropout"]:
         probs = model_interface.get_probs_(batch)
         pred = probs.argmax(dim=1)
@@ -326,7 +335,7 @@ def bin_search(
                     E[n|z], E[n|t,s,z]
     '''
 
-    t_start = time.time()
+    t_start = time.perf_counter()
 
     if eps_ is not None:
         raise DeprecationWarning
@@ -444,7 +453,7 @@ def bin_search(
         if verbose:
             print(string)
 
-    start = time.time()
+    start = time.perf_counter()
 
     # Compute likelihood P(y|t,x)
     Y, T, X, S, E = torch.meshgrid(yy, tt, xx, ss, ee)
@@ -482,7 +491,7 @@ def bin_search(
         'nn_tmap_tru': [],
         # 'n_opt': n_opt,
     }
-    tt_preprocessing = time.time() - t_start
+    tt_preprocessing = time.perf_counter() - t_start
     (tt_compute_probs, tt_setting_stats, tt_acq_func,
      tt_max_acquisition, tt_posterior) = 0.0, 0.0, 0.0, 0.0, 0.0
 
@@ -500,7 +509,7 @@ def bin_search(
         # if k == krepeat - 1:
         #     stop_next = True
 
-        t_start = time.time()
+        t_start = time.perf_counter()
 
         queries = min(k // 2 + 1, max_queries)
 
@@ -512,8 +521,8 @@ def bin_search(
         pts_x = ptse_x.sum(axis=4, keepdim=True)
         pt_x = pts_x.sum(axis=3, keepdim=True)
         n_z = (ptse_x.reshape(Nt, Ns, Ne, 1) * n_tsez).sum(axis=(0, 1, 2))  # E[n | z]
-        tt_compute_probs += (time.time() - t_start)
-        t_start = time.time()
+        tt_compute_probs += (time.perf_counter() - t_start)
+        t_start = time.perf_counter()
 
 
         # Compute new stats for logs and stopping criterium
@@ -532,10 +541,10 @@ def bin_search(
         # n_zbest_tru = n_tsz[it_true, is_true, iz_best].item()  # get_n_from_cos(s_, z_best-t_, target_cos, delta, d)
         # n_ztmax_tru = n_tsz[it_true, is_true, iz_best].item()  # get_n_from_cos(s_, z_tmax-t_, target_cos, delta, d)
         # n_ztmap_tru = n_tsz[it_true, is_true, iz_tmax].item()  # get_n_from_cos(s_, z_tmap-t_, target_cos, delta, d)
-        tt_setting_stats += time.time() - t_start
+        tt_setting_stats += time.perf_counter() - t_start
 
 
-        t_start = time.time()
+        t_start = time.perf_counter()
         # Compute acquisition function a(x), x = next sample loc
         if acq_func == 'I(y,t,s,e)':
             # Compute mutual information I(y, (t, s, e) | {(xi,yi) : i})
@@ -620,8 +629,8 @@ def bin_search(
             raise ValueError
 
         # Maximize acquisition function over sampling loc x
-        tt_acq_func += time.time() - t_start
-        t_start = time.time()
+        tt_acq_func += time.perf_counter() - t_start
+        t_start = time.perf_counter()
         a_max = torch.max(a_x)
         a_min_to_sample = .9 * a_max if queries > 1 else a_max
         jj_top = torch.where(a_x >= a_min_to_sample)[0]
@@ -647,8 +656,8 @@ def bin_search(
                 # print(f'step:{k}, lambda:{xj_}, response:{y_}')
             yj = torch.tensor(yj, device=device)
         # yj, memory = get_model_output(xj, unperturbed, perturbed, decision_function, memory)
-        tt_max_acquisition += time.time() - t_start
-        t_start = time.time()
+        tt_max_acquisition += time.perf_counter() - t_start
+        t_start = time.perf_counter()
 
         # Update logs
         # vprint(f'E[n]_lim = {n_opt:.2e}\t E[n] = {n_z[j_amax]:.2e}')
@@ -683,11 +692,16 @@ def bin_search(
         # New prior = previous posterior
         ptse = ptse_xyj
         ptse_x = ptse  # (t, s, e) independent of sampling point x
-        tt_posterior += time.time() - t_start
+        tt_posterior += time.perf_counter() - t_start
 
-    end = time.time()
+    end = time.perf_counter()
     vprint(f'Time to finish: {end - start:.2f} s')
     # print(tt_compute_probs, tt_setting_stats, tt_acq_func, tt_max_acquisition, tt_posterior)
+    if getattr(model_interface, 'profiler', None) is not None:
+        for name, value in (('preprocessing', tt_preprocessing), ('compute_probs', tt_compute_probs),
+                            ('setting_stats', tt_setting_stats), ('acq_func', tt_acq_func),
+                            ('max_acquisition', tt_max_acquisition), ('posterior', tt_posterior)):
+            model_interface.profiler.add('infomax.' + name, value)
     if stop_next is False:
         return output, stopping_criteria.check(output, terminated=True)[1]
     else:
@@ -1,12 +1,13 @@
 import os
 import torch
+from tracker import RunTracker, load_diaries
 
 OUT_DIR = 'aistats'
 
 
 def read_dump(path):
     filepath = f'{OUT_DIR}/{path}/raw_data.pkl'
-    raw = torch.load(open(filepath, 'rb'), map_location='cpu')
+    raw = load_diaries(filepath)
     return raw
 
 
@@ -17,4 +18,4 @@ for beta in [1, 5, 10]:
     out_path = f'{OUT_DIR}/psj_b_{beta}_bayesian_ns_5'
     if not os.path.exists(out_path):
         os.makedirs(out_path)
-    torch.save(merged_dump, open('{}/raw_data.pkl'.format(out_path), 'wb'))
+    RunTracker.from_diaries(merged_dump).save('{}/raw_data.pkl'.format(out_path))
@@ -0,0 +1,168 @@
+import json
+import os
+import numpy as np
+import torch
+from tracker import PROFILE_PREFIXES, RunTracker, load_tracker
+
+OUT_DIR = 'thesis'
+# Prefix of the metrics read from each crunch output
+CRUNCHED_FILES = {'': 'crunched.pkl', 'aa.': 'crunched_aa.pkl', 'aaa.': 'crunched_aaa.pkl'}
+RAW_FILE = 'raw_data.pkl'
+RAW_PREFIX = 'raw.'
+
+
+class MetricsStore(object):
+    """
+        Scalar metrics of the experiments, stored as one .npy column per (experiment, metric) under
+        <out_dir>/metrics/<experiment>/ and read back memory-mapped, so plotting never unpickles image tensors.
+        - Crunched metrics keep their names and shapes, e.g. 'border_distance' [iterations + 1, images]. The metrics
+          of crunched_aa.pkl and crunched_aaa.pkl are prefixed with 'aa.' and 'aaa.'.
+        - Raw metrics are the scalar columns of raw_data.pkl prefixed with 'raw.', e.g. 'raw.calls.bin_search'.
+          Page metrics have shape [iterations, images] (NaN after an attack stopped), diary metrics [images].
+        index.json of an experiment lists its metrics and the size and mtime of the files they were read from; columns
+        of a file that changed since are read again on the next query.
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, out_dir=OUT_DIR, path=None):
+        self.out_dir = out_dir
+        self.path = path if path is not None else os.path.join(out_dir, 'metrics')
+
+    def _exp_dir(self, exp_name):
+        return os.path.join(self.path, exp_name)
+
+    def _read_index(self, exp_name):
+        index_path = os.path.join(self._exp_dir(exp_name), self.INDEX)
+        if not os.path.exists(index_path):
+            return {'version': 1, 'metrics': {}, 'sources': {}, 'extras': None}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _write_index(self, exp_name, index):
+        index_path = os.path.join(self._exp_dir(exp_name), self.INDEX)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(index_path + '.tmp', index_path)
+
+    @staticmethod
+    def _stamp(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _save_column(self, exp_name, metric, values):
+        path = os.path.join(self._exp_dir(exp_name), metric + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, values)
+        os.replace(path + '.tmp', path)
+
+    def _add(self, exp_name, columns, source=None, extras=None):
+        """ :param columns: dict {metric: array-like} """
+        os.makedirs(self._exp_dir(exp_name), exist_ok=True)
+        index = self._read_index(exp_name)
+        for metric, values in columns.items():
+            values = values.detach().cpu().numpy() if torch.is_tensor(values) else np.asarray(values)
+            self._save_column(exp_name, metric, values)
+            index['metrics'][metric] = {'shape': list(values.shape), 'dtype': str(values.dtype), 'source': source}
+        if source is not None:
+            path = os.path.join(self.out_dir, exp_name, source)
+            index['sources'][source] = self._stamp(path) if os.path.exists(path) else None
+        if extras is not None:
+            index['extras'] = extras
+        self._write_index(exp_name, index)
+
+    def add_crunched(self, exp_name, dump, prefix='', source='crunched.pkl'):
+        """ Stores the tensors of a crunch output (dict {metric: tensor}) """
+        self._add(exp_name, {prefix + metric: values for metric, values in dump.items() if torch.is_tensor(values)},
+                  source)
+
+    def add_raw(self, exp_name, tracker: RunTracker, source=RAW_FILE):
+        """ Stores the scalar columns of a run, page columns transposed to [iterations, images] """
+        columns = {RAW_PREFIX + 'num_iterations': tracker.num_iterations[:tracker.size]}
+        for name in tracker.scalars:
+            column = tracker.column(name)
+            columns[RAW_PREFIX + name] = column.t() if column.dim() == 2 else column
+        self._add(exp_name, columns, source, extras=tracker.extras[:tracker.size])
+
+    def _stale_sources(self, exp_name):
+        index = self._read_index(exp_name)
+        stale = []
+        for file in list(CRUNCHED_FILES.values()) + [RAW_FILE]:
+            path = os.path.join(self.out_dir, exp_name, file)
+            if os.path.exists(path) and index['sources'].get(file) != self._stamp(path):
+                stale.append(file)
+        return stale
+
+    def ingest(self, exp_name, force=False):
+        """
+        Reads the crunch outputs and raw_data.pkl of an experiment that are new or changed since they were stored
+        :return: list of the files read
+        """
+        if force:
+            stale = [file for file in list(CRUNCHED_FILES.values()) + [RAW_FILE]
+                     if os.path.exists(os.path.join(self.out_dir, exp_name, file))]
+        else:
+            stale = self._stale_sources(exp_name)
+        for prefix, file in CRUNCHED_FILES.items():
+            if file in stale:
+                dump = torch.load(open(os.path.join(self.out_dir, exp_name, file), 'rb'), map_location='cpu')
+                self.add_crunched(exp_name, dump, prefix, file)
+        if RAW_FILE in stale:
+            self.add_raw(exp_name, load_tracker(os.path.join(self.out_dir, exp_name, RAW_FILE)))
+        return stale
+
+    def metrics(self, exp_name):
+        self.ingest(exp_name)
+        return sorted(self._read_index(exp_name)['metrics'])
+
+    def load(self, exp_name, metric, ingest=True):
+        """ :return: read-only memory-mapped array of the metric """
+        if ingest:
+            self.ingest(exp_name)
+        if metric not in self._read_index(exp_name)['metrics']:
+            raise KeyError(f'No metric {metric} for experiment {exp_name}')
+        return np.load(os.path.join(self._exp_dir(exp_name), metric + '.npy'), mmap_mode='r')
+
+    def query(self, exp_name, metric, iterations=None, images=None, percentile=None):
+        """
+        :param iterations: (start, stop) range of the iteration axis, for metrics that have one
+        :param images: indices (or slice) of the images to keep
+        :param percentile: a percentile or list of percentiles taken over the images (NaN ignored)
+        :return: numpy array, e.g. query(exp, 'border_distance', percentile=50) is the median distance per iteration
+        """
+        values = self.load(exp_name, metric)
+        if images is not None:
+            values = values[..., images]
+        if iterations is not None and values.ndim >= 2:
+            values = values[..., slice(*iterations), :]
+        if percentile is not None:
+            return np.nanpercentile(values, percentile, axis=-1)
+        return np.array(values)
+
+    def experiment(self, exp_name, prefix=''):
+        """
+        :return: dict {metric: tensor} of the metrics with the given prefix (prefix removed), i.e. what torch.load
+                 returns for the corresponding crunched file but without the image tensors of raw_data.pkl
+        """
+        self.ingest(exp_name)
+        return {metric[len(prefix):]: torch.from_numpy(np.array(self.load(exp_name, metric, ingest=False)))
+                for metric in self._read_index(exp_name)['metrics']
+                if metric.startswith(prefix) and (prefix != '' or '.' not in metric)}
+
+    def diaries(self, exp_name):
+        """ Diaries of the run rebuilt from the raw columns: every scalar field, no images """
+        self.ingest(exp_name)
+        index = self._read_index(exp_name)
+        if index['extras'] is None:
+            raise KeyError(f'No raw metrics for experiment {exp_name}')
+        num_iterations = torch.from_numpy(np.array(self.load(exp_name, RAW_PREFIX + 'num_iterations', False)))
+        tracker = RunTracker(len(num_iterations), max(int(num_iterations.max()), 1) if len(num_iterations) else 1,
+                             (), image_fields=())
+        for metric in index['metrics']:
+            name = metric[len(RAW_PREFIX):]
+            if metric.startswith(RAW_PREFIX) and (name in tracker.scalars or name.startswith(PROFILE_PREFIXES)):
+                column = torch.from_numpy(np.array(self.load(exp_name, metric, False)))
+                tracker.scalars[name] = column.t() if column.dim() == 2 else column
+        tracker.num_iterations = num_iterations
+        tracker.extras = index['extras']
+        tracker.size = len(num_iterations)
+        return tracker.diaries()
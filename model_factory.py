@@ -1,17 +1,28 @@
+import copy
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import numpy as np
 import torch
 from torchvision import transforms
 import torch.nn.functional as F
 from cifar10_models import *
+from cifar10_models.backends import optimize_model, NO_GRAD_BACKENDS
 from pytorchmodels import MNIST_Net, CWMNISTNetwork
 from torchvision import transforms
 from img_utils import show_image
 from mnist_models.mnist_arch import Net0, Net1, Net2, Net3
+from quantization import quantize_model, calibration_images
 
 
 class Model:
     def __init__(self, model, noise=None, n_classes=10, flip_prob=0.25, beta=1.0, device=None, smoothing_noise=0.,
-                 crop_size=None):
-        self.model = model
+                 crop_size=None, loader=None):
+        self._model = model
+        self.loader = loader  # loads the module on first access when model is None (see get_model(lazy=True))
         self.noise = noise
         self.n_classes = n_classes
         self.flip_prob = flip_prob
@@ -19,6 +30,17 @@ class Model:
         self.device = device
         self.smoothing_noise = smoothing_noise
         self.crop_size = crop_size
+        self.grad_loader = None  # loads an eager module for get_grads when model has no autograd path (see get_model)
+
+    @property
+    def model(self):
+        if self._model is None and self.loader is not None:
+            self._model = self.loader()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
 
     def predict(self, images):
         images = images.permute(0, 3, 1, 2)
@@ -73,6 +95,29 @@ class Model:
         else:
             raise RuntimeError(f'Unknown Noise type: {self.noise}')
 
+    def ask_model_repeated(self, images, samples):
+        """
+        Same as ask_model on every image repeated samples times, as a tensor of shape [len(images), samples].
+        The noises that only act on the logits (bayesian, stochastic) sample all the answers of an image from a single
+        forward pass; the others run ask_model on the repeated batch.
+        """
+        if self.noise == 'deterministic':
+            return self.ask_model(images)[:, None].repeat(1, samples)
+        if self.noise == 'bayesian':
+            logits = self.predict(images)
+            logits = logits - torch.max(logits, dim=1, keepdim=True)[0]
+            probs = torch.exp(self.beta * logits)
+            probs = probs / torch.sum(probs, dim=1, keepdim=True)
+            probs[probs < 1e-4] = 0
+            return torch.multinomial(probs, samples, replacement=True)
+        if self.noise == 'stochastic':
+            pred = torch.argmax(self.predict(images), dim=1)[:, None].repeat(1, samples)
+            rand = torch.randint(self.n_classes, size=pred.shape)
+            flip = torch.rand(pred.shape) < self.flip_prob
+            pred[flip] = rand[flip]
+            return pred
+        return self.ask_model(images.repeat_interleave(samples, dim=0)).view(len(images), samples)
+
     def get_probs(self, images):
         if type(images) != torch.Tensor:
             images = torch.tensor(images, dtype=torch.float32)
@@ -95,7 +140,8 @@ class Model:
                                                                  [0.2023, 0.1994, 0.2010])])
             images_ = torch.stack([transform(i) for i in images_])
         t_images = torch.tensor(images_, requires_grad=True, device=self.device)
-        t_outs = self.model(t_images)
+        model = self.grad_loader() if self.grad_loader is not None else self.model
+        t_outs = model(t_images)
         grad = torch.zeros(t_images.shape)
         for i in range(len(images)):
             _grad_true = torch.autograd.grad(t_outs[i, true_label], t_images, create_graph=True)[0]
@@ -108,8 +154,138 @@ class Model:
         return grad.detach()
 
 
+class ModelRegistry:
+    """
+        In-process cache of loaded torch modules, keyed by model key and by the part of the noise config that changes
+        the module itself (dropout). Model wrappers are cheap and are still built per get_model() call, so that
+        wrappers with different noise settings can share the same weights.
+        Modules can be loaded ahead of time on a thread pool with prefetch().
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.modules = {}  # cache key -> Future of torch module
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def _future(self, cache_key, build, executor=None):
+        with self.lock:
+            future = self.modules.get(cache_key)
+            if future is not None:
+                return future
+            future = Future()
+            self.modules[cache_key] = future
+        if executor is None:
+            self._run(cache_key, future, build)
+        else:
+            executor.submit(self._run, cache_key, future, build)
+        return future
+
+    def _run(self, cache_key, future, build):
+        try:
+            future.set_result(build())
+        except BaseException as e:
+            # Failed loads are not cached
+            with self.lock:
+                self.modules.pop(cache_key, None)
+            future.set_exception(e)
+
+    def get(self, cache_key, build):
+        return self._future(cache_key, build).result()
+
+    def prefetch(self, cache_key, build):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._future(cache_key, build, self.pool)
+
+    def clear(self):
+        with self.lock:
+            self.modules = {}
+
+
+registry = ModelRegistry()
+
+
+def load_state_dict(path):
+    """
+        Memory-maps zip-format checkpoints: weights are paged in on first use and shared by all the processes that
+        load the same file. Legacy (non-zip) checkpoints cannot be memory-mapped and are read normally.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        return torch.load(path, map_location='cpu')
+
+
+def backend_check_inputs(n_samples=16):
+    """
+    Normalised cifar10 test images, and attack-like points between them, on which a compiled backend must match eager.
+    None if the test set cannot be read. The global random states are left untouched.
+    """
+    np_state = np.random.get_state()
+    try:
+        with torch.random.fork_rng(devices=[]):
+            images = calibration_images('cifar10', n_samples, n_samples)
+    except Exception as e:
+        logging.warning('Cannot read cifar10 images to validate the inference backend ({})'.format(e))
+        return None
+    finally:
+        np.random.set_state(np_state)
+    transform = transforms.Normalize([0.4914, 0.4822, 0.4465], [0.2023, 0.1994, 0.2010])
+    return transform(images.permute(0, 3, 1, 2))
+
+
+def _load_module(key, noise=None, drop_rate=0., backend='eager'):
+    def load(module, path):
+        module.load_state_dict(load_state_dict(path), assign=True)
+        return module
+
+    if key == 'mnist_noman':
+        pytorch_model = load(MNIST_Net(), 'mnist_models/mnist_model.pth')
+    elif key == 'mnist_cw':
+        return load(CWMNISTNetwork(), 'mnist_models/cw_mnist_cnn.pt').eval()
+    elif key == 'cifar10':
+        pytorch_model = densenet121(pretrained=False, drop_rate=drop_rate if noise == "dropout" else 0)
+        script_dir = os.path.dirname(sys.modules[densenet121.__module__].__file__)
+        pytorch_model = load(pytorch_model, script_dir + '/state_dicts/densenet121.pt').eval()
+        if backend != 'eager' and noise == "dropout" and drop_rate > 0:
+            # Compiled backends would drop the dropout noise of the dense layers
+            logging.warning('Inference backend {} is not supported with dropout noise, using eager'.format(backend))
+            return pytorch_model
+        return optimize_model(pytorch_model, backend, backend_check_inputs() if backend != 'eager' else None)
+    elif key.startswith('mnist_'):
+        if 'net0' in key:
+            pytorch_model = load(Net0(), f'training/data/model_dumps/{key}_model.pth')
+        elif 'net1' in key:
+            pytorch_model = load(Net1(), f'training/data/model_dumps/{key}_model.pth')
+        elif 'net2' in key:
+            pytorch_model = load(Net2(), f'training/data/model_dumps/{key}_model.pth')
+        elif 'net3' in key:
+            pytorch_model = load(Net3(), f'training/data/model_dumps/{key}_model.pth')
+        else:
+            pytorch_model = load(MNIST_Net(), f'data/model_dumps/{key}_model.pth')
+            # raise RuntimeError('Unknown Key')
+    else:
+        raise RuntimeError(f'Unknown Key: {key}')
+    pytorch_model.eval()
+    if noise == "dropout":
+        pytorch_model.conv2_drop.p = drop_rate
+        pytorch_model.conv2_drop.train()
+    return pytorch_model
+
+
+def _module_cache_key(key, noise=None, drop_rate=0., backend='eager'):
+    dropout = noise == "dropout"
+    return key, dropout, drop_rate if dropout else 0., backend
+
+
 def get_model(key, dataset, noise=None, flip_prob=0.25, beta=1.0, device=None, smoothing_noise=0., crop_size=None,
-              drop_rate=0.):
+              drop_rate=0., lazy=False, backend='eager', quantize=None):
+    """
+    Modules are cached by the registry, so building the same model several times only loads its weights once.
+    With lazy=True, the weights are only loaded when the model is first used.
+    :param backend: inference backend of the cifar10 model (see cifar10_models.backends.BACKENDS)
+    :param quantize: None, 'dynamic' or 'static' int8 quantization (CPU only, see quantization.quantize_model)
+    """
     class MNIST_Model(Model):
         def predict(self, images):
             images = images.unsqueeze(dim=1)
@@ -127,27 +303,6 @@ def get_model(key, dataset, noise=None, flip_prob=0.25, beta=1.0, device=None, s
             # outs = self.model(images.float())
             return outs.detach()
 
-    if key == 'mnist_noman':
-        pytorch_model = MNIST_Net()
-        pytorch_model.load_state_dict(torch.load('mnist_models/mnist_model.pth'))
-        pytorch_model.eval()
-        if noise == "dropout":
-            pytorch_model.conv2_drop.p = drop_rate
-            pytorch_model.conv2_drop.train()
-        return MNIST_Model(pytorch_model, noise, n_classes=10, flip_prob=flip_prob, beta=beta, device=device,
-                           smoothing_noise=smoothing_noise, crop_size=crop_size)
-    if key == 'mnist_cw':
-        pytorch_model = CWMNISTNetwork()
-        pytorch_model.load_state_dict(torch.load('mnist_models/cw_mnist_cnn.pt', map_location='cpu'))
-        pytorch_model.eval()
-        return MNIST_Model(pytorch_model, noise, n_classes=10, flip_prob=flip_prob)
-    if key == 'cifar10':
-        if noise == "dropout":
-            pytorch_model = densenet121(pretrained=True, drop_rate=drop_rate).eval()
-        else:
-            pytorch_model = densenet121(pretrained=True, drop_rate=0).eval()
-        return Model(pytorch_model, noise, n_classes=10, beta=beta, device=device,
-                     smoothing_noise=smoothing_noise, crop_size=crop_size)
     if key == 'human':
         class Human(Model):
             def ask_model(self, images):
@@ -159,41 +314,65 @@ def get_model(key, dataset, noise=None, flip_prob=0.25, beta=1.0, device=None, s
                 return torch.tensor(results)
 
         return Human(model=None)
-    if key.startswith('mnist_'):
-        if 'net0' in key:
-            pytorch_model = Net0()
-            pytorch_model.load_state_dict(torch.load(f'training/data/model_dumps/{key}_model.pth'))
-        elif 'net1' in key:
-            pytorch_model = Net1()
-            pytorch_model.load_state_dict(torch.load(f'training/data/model_dumps/{key}_model.pth'))
-        elif 'net2' in key:
-            pytorch_model = Net2()
-            pytorch_model.load_state_dict(torch.load(f'training/data/model_dumps/{key}_model.pth'))
-        elif 'net3' in key:
-            pytorch_model = Net3()
-            pytorch_model.load_state_dict(torch.load(f'training/data/model_dumps/{key}_model.pth'))
-        else:
-            pytorch_model = MNIST_Net()
-            pytorch_model.load_state_dict(torch.load(f'data/model_dumps/{key}_model.pth'))
-            # raise RuntimeError('Unknown Key')
-        pytorch_model.eval()
+
+    if key != 'cifar10' or quantize is not None:
+        backend = 'eager'
+    cache_key = _module_cache_key(key, noise, drop_rate, backend)
+    build = partial(_load_module, key, noise, drop_rate, backend)
+    if lazy:
+        pytorch_model, loader = None, partial(registry.get, cache_key, build)
+    else:
+        pytorch_model, loader = registry.get(cache_key, build), None
+
+    if key == 'mnist_noman':
+        model = MNIST_Model(pytorch_model, noise, n_classes=10, flip_prob=flip_prob, beta=beta, device=device,
+                            smoothing_noise=smoothing_noise, crop_size=crop_size, loader=loader)
+    elif key == 'mnist_cw':
+        model = MNIST_Model(pytorch_model, noise, n_classes=10, flip_prob=flip_prob, loader=loader)
+    elif key == 'cifar10':
+        model = Model(pytorch_model, noise, n_classes=10, beta=beta, device=device,
+                      smoothing_noise=smoothing_noise, crop_size=crop_size, loader=loader)
+    elif key.startswith('mnist_'):
+        model = MNIST_Multimodel(pytorch_model, noise, n_classes=10, flip_prob=flip_prob, beta=beta, device=device,
+                                 smoothing_noise=smoothing_noise, crop_size=crop_size, loader=loader)
+    else:
+        # Only reached with lazy=True, the eager path already raised in _load_module
+        raise RuntimeError(f'Unknown Key: {key}')
+    if backend in NO_GRAD_BACKENDS:
+        # get_grads (hsj_true_grad) runs on the eager module, only loaded when a gradient is first asked for
+        eager_key = _module_cache_key(key, noise, drop_rate, 'eager')
+        model.grad_loader = partial(registry.get, eager_key, partial(_load_module, key, noise, drop_rate, 'eager'))
+
+    if quantize is not None:
         if noise == "dropout":
-            pytorch_model.conv2_drop.p = drop_rate
-            pytorch_model.conv2_drop.train()
-        return MNIST_Multimodel(pytorch_model, noise, n_classes=10, flip_prob=flip_prob, beta=beta, device=device,
-                           smoothing_noise=smoothing_noise, crop_size=crop_size)
+            logging.warning('Quantization is not supported with dropout noise, using the fp32 model')
+            return model
+        # Calibrated through a copy of the fp32 wrapper, so that its input preprocessing is used
+        build = partial(quantize_model, copy.copy(model), quantize, dataset)
+        cache_key = cache_key + (quantize,)
+        if lazy:
+            model.model, model.loader = None, partial(registry.get, cache_key, build)
+        else:
+            model.model = registry.get(cache_key, build)
+    return model
 
 
 def get_models_from_file(filepath, dataset, noise=None, flip_prob=0.25, beta=1.0, device=None, smoothing_noise=0., crop_size=None,
-              drop_rate=0., n_models=None):
+              drop_rate=0., n_models=None, lazy=False, quantize=None):
+    """
+    The weights of all the models are loaded in parallel on the registry's thread pool
+    """
     f = open(filepath, 'r')
     keys = f.readlines()
     f.close()
     if n_models is not None:
         keys = keys[:n_models]
+    keys = [k.strip() for k in keys]
+    for k in keys:
+        registry.prefetch(_module_cache_key(k, noise, drop_rate), partial(_load_module, k, noise, drop_rate))
     models = []
     for k in keys:
-        k = k.strip()
-        model = get_model(k, dataset, noise, flip_prob, beta, device, smoothing_noise, crop_size, drop_rate)
+        model = get_model(k, dataset, noise, flip_prob, beta, device, smoothing_noise, crop_size, drop_rate, lazy,
+                          quantize=quantize)
         models.append(model)
     return models
@@ -1,6 +1,9 @@
 import random
 import torch
 import torch.nn.functional as F
+from budget import QueryBudget
+from profiler import Profiler
+from ensemble import stack_models
 
 
 class ModelInterface:
@@ -10,10 +13,17 @@ class ModelInterface:
             - tracks model calls
             - implements the logic to pick a model
             - implements the definition of an adversarial example
+            - enforces the query budget
+            - times the forward passes for the profiler (see profiler.Profiler)
+        With vectorize_ensemble=True, models of the same architecture are stacked into a single model that routes
+        every sample to its own randomly chosen model (see ensemble.StackedEnsemble).
     """
     def __init__(self, models, bounds=(0, 1), n_classes=None, slack=0.10, noise='deterministic',
-                 new_adv_def=False, device=None, flip_prob=0.0, smoothing_noise=0., crop_size=None):
-        self.models = models
+                 new_adv_def=False, device=None, flip_prob=0.0, smoothing_noise=0., crop_size=None, budget=None,
+                 vectorize_ensemble=False, profiler=None):
+        self.models = stack_models(models) if vectorize_ensemble else models
+        self.budget = budget if budget is not None else QueryBudget()
+        self.profiler = profiler if profiler is not None else Profiler()
         self.bounds = bounds
         self.n_classes = n_classes
         self.model_calls = 0
@@ -30,18 +40,20 @@ class ModelInterface:
         for model in self.models:
             model.model = model.model.to(self.device)
 
+    def charge(self, n):
+        """ Counts n model calls. Raises BudgetExhausted (before anything is spent) if they exceed the budget """
+        self.budget.spend(n)
+        self.model_calls += n
+
     def sample_bernoulli(self, probs):
-        self.model_calls += probs.numel()
+        self.charge(probs.numel())
         return torch.bernoulli(probs)
 
     def decision(self, batch, label, num_queries=1, targeted=False):
         N = batch.shape[0] * num_queries
-        self.model_calls += batch.shape[0] * num_queries
+        self.charge(batch.shape[0] * num_queries)
         # if N <= 100*1000:
-        if batch.ndim == 3:
-            new_batch = batch.repeat(num_queries, 1, 1)
-        else:
-            new_batch = batch.repeat(num_queries, 1, 1, 1)
+        new_batch = batch.repeat(num_queries, *[1] * (batch.ndim - 1))
         decisions = self._decision(new_batch, label, targeted)
         decisions = decisions.view(-1, len(batch)).transpose(0, 1)
         # elif num_queries <= 100*1000:
@@ -66,30 +78,49 @@ class ModelInterface:
         :param targeted: if targeted is true, label=targeted_label else label=true_label
         :return: decisions of shape = (len(batch), num_queries)
         """
-        if self.noise == 'deterministic':
-            probs = self.get_probs_(images=batch)
-            prediction = probs.argmax(dim=1)
+        if self.noise in ['deterministic', 'dropout', 'smoothing', 'cropping']:
+            prediction = self._predictions(batch)
             if targeted:
                 return (prediction == label) * 1.0
             else:
                 return (prediction != label) * 1.0
-        elif self.noise == 'dropout':
+        elif self.noise == 'stochastic':
+            num_queries = 1  # TODO: this should be removed. num_queries is not supported by this function now
             probs = self.get_probs_(images=batch)
-            prediction = probs.argmax(dim=1)
+            rand_pred = torch.randint(self.n_classes-1, size=(len(batch), num_queries), device=self.device)
+            # TODO: Review this step carefully. I think it is assumed that prediction = label
+            rand_pred[rand_pred == label] = self.n_classes - 1
+            prediction = probs.argmax(dim=1).view(-1, 1).repeat(1, num_queries)
+            indices_to_flip = torch.rand(size=(len(batch), num_queries), device=self.device) < self.flip_prob
+            prediction[indices_to_flip] = rand_pred[indices_to_flip]
             if targeted:
                 return (prediction == label) * 1.0
             else:
                 return (prediction != label) * 1.0
+
+        elif self.noise == 'bayesian':
+            probs = self.get_probs_(images=batch)
+            probs = probs[:, label]
+            # probs = probs.view(-1, 1).repeat(1, num_queries)
+            if targeted:
+                decisions = torch.bernoulli(probs)
+            else:
+                decisions = torch.bernoulli(1 - probs)
+            return decisions
+        else:
+            raise RuntimeError(f'Unknown Noise type: {self.noise}')
+
+    def _predictions(self, batch):
+        """
+        Labels predicted for a batch under the 'deterministic', 'dropout', 'smoothing' and 'cropping' noise models
+        """
+        if self.noise in ['deterministic', 'dropout']:
+            probs = self.get_probs_(images=batch)
         elif self.noise == 'smoothing':
             rv = torch.randn(size=batch.shape, device=self.device)
             batch_ = batch + self.smoothing_noise * rv
             batch_ = torch.clamp(batch_, self.bounds[0], self.bounds[1])
             probs = self.get_probs_(images=batch_)
-            prediction = probs.argmax(dim=1)
-            if targeted:
-                return (prediction == label) * 1.0
-            else:
-                return (prediction != label) * 1.0
         elif self.noise == 'cropping':
             size = batch.shape[1]
             x_start = torch.randint(low=0, high=size+1-self.crop_size, size=(1, len(batch)))[0]
@@ -105,44 +136,59 @@ class ModelInterface:
                 resized = F.interpolate(cropped_batch.unsqueeze(dim=1), size, mode='bilinear')
                 resized = resized.squeeze(dim=1)
             probs = self.get_probs_(images=resized)
-            prediction = probs.argmax(dim=1)
-            if targeted:
-                return (prediction == label) * 1.0
-            else:
-                return (prediction != label) * 1.0
-        elif self.noise == 'stochastic':
-            num_queries = 1  # TODO: this should be removed. num_queries is not supported by this function now
-            probs = self.get_probs_(images=batch)
-            rand_pred = torch.randint(self.n_classes-1, size=(len(batch), num_queries), device=self.device)
-            # TODO: Review this step carefully. I think it is assumed that prediction = label
-            rand_pred[rand_pred == label] = self.n_classes - 1
-            prediction = probs.argmax(dim=1).view(-1, 1).repeat(1, num_queries)
-            indices_to_flip = torch.rand(size=(len(batch), num_queries), device=self.device) < self.flip_prob
-            prediction[indices_to_flip] = rand_pred[indices_to_flip]
-            if targeted:
-                return (prediction == label) * 1.0
-            else:
-                return (prediction != label) * 1.0
+        else:
+            raise RuntimeError(f'Unknown Noise type: {self.noise}')
+        return probs.argmax(dim=1)
+
+    def decision_multi(self, batch, labels, num_queries=1, targeted=False):
+        """
+        Same as decision() but for several labels at once: every query is one forward pass whose output is compared
+        to all the labels, so it is counted once.
+        :param labels: list of True/Targeted labels
+        :return: decisions of shape = (len(batch), num_queries, len(labels))
+        """
+        self.charge(batch.shape[0] * num_queries)
+        new_batch = batch.repeat(num_queries, *[1] * (batch.ndim - 1))
+        decisions = self._multi_decision(new_batch, labels, targeted)
+        return decisions.view(num_queries, len(batch), len(labels)).transpose(0, 1)
 
+    def _multi_decision(self, batch, labels, targeted=False):
+        """
+        Every query samples a single predicted label, which is then compared to all the labels, so that one query
+        cannot succeed for two targets. For each label the decisions follow the same distribution as _decision().
+        :return: decisions of shape = (len(batch), len(labels))
+        """
+        labels = torch.tensor(labels, device=batch.device).view(1, -1)
+        if self.noise in ['deterministic', 'dropout', 'smoothing', 'cropping']:
+            prediction = self._predictions(batch)
+        elif self.noise == 'stochastic':
+            prediction = self.get_probs_(images=batch).argmax(dim=1)
+            # As in _decision, a flipped prediction never takes one of the labels: it is drawn among the other classes
+            others = torch.ones(self.n_classes, dtype=torch.bool, device=prediction.device)
+            others[labels[0]] = False
+            others = torch.nonzero(others).flatten()
+            if len(others) == 0:
+                raise RuntimeError('Stochastic noise needs a class outside of the labels')
+            rand_pred = others[torch.randint(len(others), size=(len(batch),), device=prediction.device)]
+            indices_to_flip = torch.rand(size=(len(batch),), device=prediction.device) < self.flip_prob
+            prediction = torch.where(indices_to_flip, rand_pred, prediction)
         elif self.noise == 'bayesian':
-            probs = self.get_probs_(images=batch)
-            probs = probs[:, label]
-            # probs = probs.view(-1, 1).repeat(1, num_queries)
-            if targeted:
-                decisions = torch.bernoulli(probs)
-            else:
-                decisions = torch.bernoulli(1 - probs)
-            return decisions
+            # One class sampled from the probabilities: P(prediction == label) = probs[:, label] as in _decision
+            prediction = torch.multinomial(self.get_probs_(images=batch), 1).flatten()
         else:
             raise RuntimeError(f'Unknown Noise type: {self.noise}')
+        if targeted:
+            return (prediction.view(-1, 1) == labels) * 1.0
+        else:
+            return (prediction.view(-1, 1) != labels) * 1.0
 
     def decision_with_logits(self, batch, true_label):
         """
         Same as decision() but insteas of decision it returns logit vectors. Used for white-box attacks
         :return: decisions of shape = (len(batch), num_classes)
         """
+        self.charge(batch.shape[0])
         probs = self.get_probs_(images=batch)
-        self.model_calls += batch.shape[0]
         if self.noise == 'deterministic':
             ans = torch.zeros_like(probs)
             ans[torch.arange(len(probs)), probs.argmax(axis=1)] = 1
@@ -163,7 +209,8 @@ class ModelInterface:
             It should not be a part of a decision based attack.
         """
         m_id = random.choice(list(range(len(self.models))))
-        outs = self.models[m_id].get_probs(images)
+        with self.profiler.forward(len(images)):
+            outs = self.models[m_id].get_probs(images)
         # m_ids = torch.randint(low=0, high=len(self.models), size=[len(images)])
         # outs = torch.zeros((len(images), self.n_classes), device=self.device)
         # for i, image in enumerate(images):
@@ -0,0 +1,142 @@
+import logging
+import torch
+from abstract_attack import Attack
+from adversarial import Adversarial
+from hopskip import HopSkipJump
+
+
+class MultiTargetAttack:
+    """
+        Attacks one image towards several target labels.
+        The targets share their queries wherever the attacks would otherwise query the model separately:
+            - Initialization: each random image is queried once and its output is checked against every target
+              still missing a starting point.
+            - First binary search (HSJ attacks only): the searches of all targets advance in lockstep, each round
+              being a single decision call over the points of every target. Each target queries points of its own,
+              so this saves round trips to the model, not forward passes.
+        The remaining iterations are run per target by the wrapped attack.
+        The model calls of the shared phases are stored in diary.shared_calls of every target.
+    """
+    def __init__(self, attack: Attack, max_init_evals=1e4):
+        self.attack = attack
+        self.max_init_evals = max_init_evals
+        self.model_interface = attack.model_interface
+
+    def attack_all(self, images, labels, targets, iterations=64, store=None):
+        """
+        :param targets: list (one per image) of lists of targeted labels
+        :param store: optional ShardedResultStore, written with keys '<image>:<target>' (see Attack.attack)
+        :return: (median distance, list of diaries) with one diary per (image, target) pair
+        """
+        raw_results = []
+        distances = []
+        for i, (image, label) in enumerate(zip(images, labels)):
+            if store is not None:
+                targets_left = [t for t in targets[i] if '{}:{}'.format(i, t) not in store]
+                if len(targets_left) == 0:
+                    continue
+            else:
+                targets_left = targets[i]
+            if self.model_interface.budget.run_exhausted():
+                logging.warning("Run query budget exhausted, skipping remaining {} images".format(len(images) - i))
+                break
+            logging.warning("Attacking Image: {} (targets: {})".format(i, targets_left))
+            for diary, distance in self.attack_one(image, label, targets_left, iterations):
+                if distance is not None:
+                    distances.append(distance)
+                if store is None:
+                    raw_results.append(diary)
+                else:
+                    store.append('{}:{}'.format(i, diary.targeted_label), diary, distance)
+        if store is not None:
+            distances = store.distances()
+        median = torch.median(torch.tensor(distances))
+        return median, raw_results
+
+    def attack_one(self, image, label, targets, iterations=64):
+        """
+        :return: list of (diary, distance) per target. distance is None when no iteration was run.
+        """
+        attack = self.attack
+        assert attack.targeted, 'MultiTargetAttack only runs targeted attacks'
+        advs = [Adversarial(image=image, label=label, targeted_label=t, device=attack.device) for t in targets]
+        # Shared phases use a diary of their own, per-target diaries are created by reset_variables later
+        attack.reset_variables(advs[0])
+        budget = self.model_interface.budget
+        budget.set_phase('initialization')
+        starts = self.initialize_starting_points(targets)
+        projections = {}
+        found = [t for t in targets if t in starts]
+        if len(found) > 0 and isinstance(attack, HopSkipJump):
+            budget.set_phase('bin_search')
+            projections = self.lockstep_binary_search(advs[0].unperturbed, [starts[t] for t in found], found)
+        shared_calls = self.model_interface.model_calls
+
+        results = []
+        for a, target in zip(advs, targets):
+            if target not in starts:
+                logging.warning('No starting point found for target {}'.format(target))
+                continue
+            a.set_starting_point(starts[target], attack.bounds)
+            attack.reset_variables(a)
+            initial_projection = projections.get(target)
+            if initial_projection is not None:
+                a.distance = a.calculate_distance(initial_projection[0], attack.bounds)
+                a.perturbed = initial_projection[0].clone()
+            diary = attack.attack_one(iterations, initial_projection)
+            diary.shared_calls = shared_calls
+            distance = a.distance if len(diary.iterations) > 0 else None
+            results.append((diary, distance))
+        return results
+
+    def initialize_starting_points(self, targets):
+        """
+        :return: dict {target: random image classified as target}, targets without starting point are missing
+        """
+        attack = self.attack
+        starts = {}
+        num_evals = 0
+        while len(starts) < len(targets) and num_evals <= self.max_init_evals:
+            missing = [t for t in targets if t not in starts]
+            random_noise = torch.rand(size=attack.shape) * (attack.clip_max - attack.clip_min) + attack.clip_min
+            decisions = self.model_interface.decision_multi(random_noise[None], missing, attack.sampling_freq,
+                                                            targeted=True)[0]
+            success = decisions.sum(dim=0) * 2.0 >= attack.sampling_freq
+            for t, s in zip(missing, success):
+                if s:
+                    starts[t] = random_noise
+            num_evals += 1
+        return starts
+
+    def lockstep_binary_search(self, unperturbed, perturbed_inputs, targets):
+        """
+        Same search as HopSkipJump.binary_search_batch, but every row is searched towards its own target and all rows
+        are decided by one decision call per round (one round trip, but still one forward pass per row).
+        :return: dict {target: (projection, dist_post_update, None)}, i.e. what bin_search_step returns
+        """
+        attack = self.attack
+        perturbed_inputs = torch.stack(perturbed_inputs).to(unperturbed.device)
+        dists_post_update = torch.tensor([attack.compute_distance(unperturbed, x) for x in perturbed_inputs])
+        if attack.constraint == "linf":
+            highs = dists_post_update.clone()
+            thresholds = dists_post_update * attack.theta_det
+        else:
+            highs = torch.ones(len(perturbed_inputs), device=attack.device)
+            thresholds = attack.theta_det
+        lows = torch.zeros(len(perturbed_inputs), device=attack.device)
+        num_points = attack.search_arity - 1
+        repeated_inputs = perturbed_inputs.repeat_interleave(num_points, dim=0)
+        # Column of the decision matrix holding the decision of each row's own target
+        columns = torch.arange(len(targets)).repeat_interleave(num_points)
+        rows = torch.arange(len(columns))
+
+        while torch.max((highs - lows) / thresholds) > 1:
+            mids = attack.kary_search_points(lows, highs)
+            mid_inputs = attack.project(unperturbed, repeated_inputs, mids.flatten())
+            decisions = self.model_interface.decision_multi(mid_inputs, targets, attack.repeat_queries, targeted=True)
+            decisions = decisions[rows, :, columns].sum(dim=1) / attack.repeat_queries
+            decisions = (decisions > 0.5) * 1
+            lows, highs = attack.kary_search_update(lows, highs, mids, decisions.view(mids.shape))
+
+        out_inputs = attack.project(unperturbed, perturbed_inputs, highs)
+        return {t: (out_inputs[i], dists_post_update[i], None) for i, t in enumerate(targets)}
@@ -6,20 +6,20 @@ import torch
 from matplotlib import rc
 
 from img_utils import get_device
+from metrics_store import MetricsStore
 from exp3_constants import beta_vs_repeats, best_repeat
 
 OUT_DIR = 'aistats'
 PLOTS_DIR = f'{OUT_DIR}/plots_aistats/'
 device = get_device()
+metrics = MetricsStore(OUT_DIR)
 NUM_ITERATIONS = 32
 NUM_IMAGES = 100
 eps = list(range(1, 6))
 
 
 def read_dump(path):
-    filepath = f'{OUT_DIR}/{path}/crunched.pkl'
-    raw = torch.load(open(filepath, 'rb'), map_location=device)
-    return raw
+    return metrics.experiment(path)
 
 
 def estimate_repeat_in_hsj(beta_vs_repeats, dataset):
@@ -43,17 +43,17 @@ def estimate_repeat_in_hsj(beta_vs_repeats, dataset):
                 exp_name = f"{attack}_r_{repeat}_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}"
                 raw = read_dump(exp_name)
                 D = raw['border_distance']
-                dists.append(np.median(D[-1]))
-                dists_low.append(np.percentile(D[-1], 40))
-                dists_high.append(np.percentile(D[-1], 60))
+                dists.append(np.nanmedian(D[-1]))
+                dists_low.append(np.nanpercentile(D[-1], 40))
+                dists_high.append(np.nanpercentile(D[-1], 60))
             plt.plot(repeats, dists, label=labels[j])
             plt.fill_between(repeats, dists_low, dists_high, alpha=0.2)
         raw = read_dump(f"psj_r_1_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}")
         D = raw['border_distance']
         ticks = np.logspace(np.log10(min_tick), np.log10(max_tick))
-        medians = np.array([np.median(D[-1])] * len(ticks))
-        perc40 = np.array([np.percentile(D[-1], 35)] * len(ticks))
-        perc60 = np.array([np.percentile(D[-1], 65)] * len(ticks))
+        medians = np.array([np.nanmedian(D[-1])] * len(ticks))
+        perc40 = np.array([np.nanpercentile(D[-1], 35)] * len(ticks))
+        perc60 = np.array([np.nanpercentile(D[-1], 65)] * len(ticks))
         plt.plot(ticks, medians, label='PSJ')
         plt.fill_between(ticks, perc40, perc60, alpha=0.2)
         plt.plot()
@@ -77,18 +77,18 @@ def psj_vs_hsjr(best_repeat):
         for beta in betas:
             psj_exp_name = f"psj_r_1_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}"
             psj_dump = read_dump(psj_exp_name)
-            psj_calls = np.median(psj_dump['model_calls'][-1])
-            psj_calls_40 = np.percentile(psj_dump['model_calls'][-1], 30)
-            psj_calls_60 = np.percentile(psj_dump['model_calls'][-1], 70)
+            psj_calls = np.nanmedian(psj_dump['model_calls'][-1])
+            psj_calls_40 = np.nanpercentile(psj_dump['model_calls'][-1], 30)
+            psj_calls_60 = np.nanpercentile(psj_dump['model_calls'][-1], 70)
 
             hsj_exp_name = f"{attack}_r_{R[beta][1]}_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}"
             hsj_dump = read_dump(hsj_exp_name)
-            hsj_calls = np.median(hsj_dump['model_calls'][-1])
+            hsj_calls = np.nanmedian(hsj_dump['model_calls'][-1])
 
             hsj_l = read_dump(f"{attack}_r_{R[beta][0]}_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}")
-            hsj_calls_l = np.median(hsj_l['model_calls'][-1])
+            hsj_calls_l = np.nanmedian(hsj_l['model_calls'][-1])
             hsj_u = read_dump(f"{attack}_r_{R[beta][2]}_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}")
-            hsj_calls_u = np.median(hsj_u['model_calls'][-1])
+            hsj_calls_u = np.nanmedian(hsj_u['model_calls'][-1])
 
             ratio = hsj_calls / psj_calls
             ratios.append(ratio)
@@ -127,8 +127,8 @@ def conv_to_hsja():
             else:
                 psj_exp_name = f"{dataset}_psj_r_1_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}"
             psj_dump = read_dump(psj_exp_name)
-            psj_calls = np.median(psj_dump['model_calls'], axis=1)
-            psj_dist = np.median(psj_dump['border_distance'], axis=1)
+            psj_calls = np.nanmedian(psj_dump['model_calls'], axis=1)
+            psj_dist = np.nanmedian(psj_dump['border_distance'], axis=1)
             dist_arr.append(psj_dist)
             calls_arr.append(psj_calls)
 
@@ -139,8 +139,8 @@ def conv_to_hsja():
                 exp_name = f"{dataset}_{attack}_r_1_b_1_deterministic_fp_{flip}_ns_{n_samples}"
 
             exp_dump = read_dump(exp_name)
-            exp_calls = np.median(exp_dump['model_calls'], axis=1)
-            exp_dist = np.median(exp_dump['border_distance'], axis=1)
+            exp_calls = np.nanmedian(exp_dump['model_calls'], axis=1)
+            exp_dist = np.nanmedian(exp_dump['border_distance'], axis=1)
             dist_arr.append(exp_dist)
             calls_arr.append(exp_calls)
 
@@ -200,10 +200,10 @@ def hsj_failure():
                 else:
                     exp_name = f"{dataset}_{attack}_r_{repeat}_b_{beta}_{noise}_fp_{flip}_ns_{n_samples}"
                 raw = read_dump(exp_name)
-                calls = np.median(raw['model_calls'][-1])
-                dist = np.median(raw['border_distance'][-1])
-                dist_40 = np.percentile(raw['border_distance'][-1], 40)
-                dist_60 = np.percentile(raw['border_distance'][-1], 60)
+                calls = np.nanmedian(raw['model_calls'][-1])
+                dist = np.nanmedian(raw['border_distance'][-1])
+                dist_40 = np.nanpercentile(raw['border_distance'][-1], 40)
+                dist_60 = np.nanpercentile(raw['border_distance'][-1], 60)
 
                 # print(f'({flip},{attack})\t', end='')
                 print(f'{calls} {dist} {dist_40} {dist_60}', end='\t')
@@ -213,8 +213,8 @@ def plot_distance():
     plt.figure(figsize=(10, 7))
     exp_name = f"cifar10_psj_r_1_b_1_stochastic_fp_0.10_ns_5"
     raw = read_dump(exp_name)
-    calls = np.median(raw['model_calls'][-1])
-    dist = np.median(raw['border_distance'], axis=1)
+    calls = np.nanmedian(raw['model_calls'][-1])
+    dist = np.nanmedian(raw['border_distance'], axis=1)
     plt.plot(dist, label='PSJ')
     plt.plot()
     plt.legend()
@@ -4,23 +4,23 @@ import torch
 from matplotlib import rc
 
 from img_utils import get_device
+from metrics_store import MetricsStore
 
 OUT_DIR = 'thesis'
 PLOTS_DIR = f'{OUT_DIR}/plots_experiments/'
 device = get_device()
+metrics = MetricsStore(OUT_DIR)
 
 
 def read_dump(path, raw=False, aa=False, aaa=False):
+    """ Metrics are read from the metrics store, raw diaries only hold their scalar fields (no images) """
     if raw:
-        filepath = f'{OUT_DIR}/{path}/raw_data.pkl'
+        return metrics.diaries(path)
     elif aa:
-        filepath = f'{OUT_DIR}/{path}/crunched_aa.pkl'
+        return metrics.experiment(path, prefix='aa.')
     elif aaa:
-        filepath = f'{OUT_DIR}/{path}/crunched_aaa.pkl'
-    else:
-        filepath = f'{OUT_DIR}/{path}/crunched.pkl'
-    raw = torch.load(open(filepath, 'rb'), map_location=device)
-    return raw
+        return metrics.experiment(path, prefix='aaa.')
+    return metrics.experiment(path)
 
 
 noise_level = {'mnist': {
@@ -126,10 +126,10 @@ def grid():
                 if dataset == 'cifar10':
                     D = torch.cat([D[:, :26], D[:, 27:57], D[:, 59:61], D[:, 62:]], dim=1)
                     C = torch.cat([C[:, :26], C[:, 27:57], C[:, 59:61], C[:, 62:]], dim=1)
-                dist = np.median(D, axis=1)
-                calls = np.median(C, axis=1)
-                perc_40 = np.percentile(D, 40, axis=1)
-                perc_60 = np.percentile(D, 60, axis=1)
+                dist = np.nanmedian(D, axis=1)
+                calls = np.nanmedian(C, axis=1)
+                perc_40 = np.nanpercentile(D, 40, axis=1)
+                perc_60 = np.nanpercentile(D, 60, axis=1)
                 if attack == 'hsj':
                     ax0.plot(dist, label=get_label(noise, 'det', attack=attack, dataset=dataset), linestyle='--')
                     ax0.fill_between(range(len(perc_40)), perc_40, perc_60, alpha=0.1)
@@ -158,10 +158,10 @@ def grid():
                 if dataset == 'cifar10':
                     D = torch.cat([D[:, :26], D[:, 27:57], D[:, 59:61], D[:, 62:]], dim=1)
                     C = torch.cat([C[:, :26], C[:, 27:57], C[:, 59:61], C[:, 62:]], dim=1)
-                dist = np.median(D, axis=1)
-                calls = np.median(C, axis=1)
-                perc_40 = np.percentile(D, 40, axis=1)
-                perc_60 = np.percentile(D, 60, axis=1)
+                dist = np.nanmedian(D, axis=1)
+                calls = np.nanmedian(C, axis=1)
+                perc_40 = np.nanpercentile(D, 40, axis=1)
+                perc_60 = np.nanpercentile(D, 60, axis=1)
                 ax0.plot(dist, label=get_label(noise, level))
                 ax0.fill_between(range(len(perc_40)), perc_40, perc_60, alpha=0.1)
                 ax1.plot(calls, dist, label=get_label(noise, level))
@@ -217,9 +217,9 @@ def noise():
                     D = raw[metric]
                     if dataset == 'cifar10':
                         D = torch.cat([D[:, :26], D[:, 27:57], D[:, 59:61], D[:, 62:]], dim=1)
-                    dist = np.median(D, axis=1)
-                    dist_40 = np.percentile(D, 40, axis=1)
-                    dist_60 = np.percentile(D, 60, axis=1)
+                    dist = np.nanmedian(D, axis=1)
+                    dist_40 = np.nanpercentile(D, 40, axis=1)
+                    dist_60 = np.nanpercentile(D, 60, axis=1)
                     border_distance.append(dist[-1])
                     border_distance_40.append(dist_40[-1])
                     border_distance_60.append(dist_60[-1])
@@ -253,9 +253,9 @@ def fig3_2lines(line=None):
         D = raw[metric]
         if dataset == 'cifar10':
             D = torch.cat([D[:, :26], D[:, 27:57], D[:, 59:61], D[:, 62:]], dim=1)
-        dist = np.median(D, axis=1)
-        dist_40 = np.percentile(D, 40, axis=1)
-        dist_60 = np.percentile(D, 60, axis=1)
+        dist = np.nanmedian(D, axis=1)
+        dist_40 = np.nanpercentile(D, 40, axis=1)
+        dist_60 = np.nanpercentile(D, 60, axis=1)
         return dist, dist_40, dist_60
 
     rc('text', usetex=True)
@@ -382,10 +382,10 @@ def fig3_2lines(line=None):
                 if dataset == 'cifar10':
                     D = torch.cat([D[:, :26], D[:, 27:57], D[:, 59:61], D[:, 62:]], dim=1)
                     C = torch.cat([C[:, :26], C[:, 27:57], C[:, 59:61], C[:, 62:]], dim=1)
-                dist = np.median(D, axis=1)
-                calls = np.median(C, axis=1)
-                perc_40 = np.percentile(D, 40, axis=1)
-                perc_60 = np.percentile(D, 60, axis=1)
+                dist = np.nanmedian(D, axis=1)
+                calls = np.nanmedian(C, axis=1)
+                perc_40 = np.nanpercentile(D, 40, axis=1)
+                perc_60 = np.nanpercentile(D, 60, axis=1)
                 if attack == 'hsj':
                     ax0.plot(dist, label=get_label(noise, 'det', attack=attack, dataset=dataset), linestyle='--')
                     ax0.fill_between(range(len(perc_40)), perc_40, perc_60, alpha=0.1)
@@ -414,10 +414,10 @@ def fig3_2lines(line=None):
                 if dataset == 'cifar10':
                     D = torch.cat([D[:, :26], D[:, 27:57], D[:, 59:61], D[:, 62:]], dim=1)
                     C = torch.cat([C[:, :26], C[:, 27:57], C[:, 59:61], C[:, 62:]], dim=1)
-                dist = np.median(D, axis=1)
-                calls = np.median(C, axis=1)
-                perc_40 = np.percentile(D, 40, axis=1)
-                perc_60 = np.percentile(D, 60, axis=1)
+                dist = np.nanmedian(D, axis=1)
+                calls = np.nanmedian(C, axis=1)
+                perc_40 = np.nanpercentile(D, 40, axis=1)
+                perc_60 = np.nanpercentile(D, 60, axis=1)
                 ax0.plot(dist, label=get_label(noise, level))
                 ax0.fill_between(range(len(perc_40)), perc_40, perc_60, alpha=0.1)
                 ax1.plot(calls, dist, label=get_label(noise, level))
@@ -461,7 +461,7 @@ def delta(dataset='cifar10'):
         D = raw[metric]
         if dataset == 'cifar10':
             D = torch.cat([D[:, :57], D[:, 58:]], dim=1)
-        dist = np.median(D, axis=1)
+        dist = np.nanmedian(D, axis=1)
         # perc_40 = np.percentile(raw[metric], 40, axis=1)
         # perc_60 = np.percentile(raw[metric], 60, axis=1)
         beta = tf * 1.0 / tfs[dataset][0]
@@ -538,27 +538,27 @@ def hsj_vs_psj():
                 exp_name = f'{dataset}_psj_r_1_sn_{sn}_cs_{cs}_dr_{dr}_dm_l2_b_{b}_{noise}_fp_0.00_ns_{n_images}'
                 raw = read_dump(exp_name)
                 data = raw['border_distance'][-1, :]
-                dist = np.median(data)
-                dist_40 = np.percentile(data, 40)
-                dist_60 = np.percentile(data, 60)
+                dist = np.nanmedian(data)
+                dist_40 = np.nanpercentile(data, 40)
+                dist_60 = np.nanpercentile(data, 60)
                 h, h_40, h_60 = [], [], []
                 repsd, hd, hd_40, hd_60 = [], [], [], []
                 for rep in reps:
                     exp_name = f'{dataset}_hsj_rep_r_{rep}_sn_{sn}_cs_{cs}_dr_{dr}_dm_l2_b_{b}_{noise}_fp_0.00_ns_{n_images}'
                     raw = read_dump(exp_name)
                     data = raw['border_distance'][-1, :]
-                    h.append(np.median(data))
-                    h_40.append(np.percentile(data, 40))
-                    h_60.append(np.percentile(data, 60))
+                    h.append(np.nanmedian(data))
+                    h_40.append(np.nanpercentile(data, 40))
+                    h_60.append(np.nanpercentile(data, 60))
 
                     exp_name = f'{dataset}_hsj_rep_del_r_{rep}_sn_{sn}_cs_{cs}_dr_{dr}_dm_l2_b_{b}_{noise}_fp_0.00_ns_{n_images}'
                     try:
                         raw = read_dump(exp_name)
                         data = raw['border_distance'][-1, :]
                         repsd.append(rep)
-                        hd.append(np.median(data))
-                        hd_40.append(np.percentile(data, 40))
-                        hd_60.append(np.percentile(data, 60))
+                        hd.append(np.nanmedian(data))
+                        hd_40.append(np.nanpercentile(data, 40))
+                        hd_60.append(np.nanpercentile(data, 60))
                     except:
                         pass
                 plt.figure()
@@ -596,9 +596,9 @@ def fig5():
             y_delta, y_delta_40, y_delta_60 = [], [], []
             exp_name = f'{dataset}_psj_r_1_sn_0.01_cs_26_dr_0.5_dm_l2_b_1_deterministic_fp_0.00_ns_{n_images}'
             raw = read_dump(exp_name)
-            x = np.median(raw['model_calls'][-1, :])
-            x_40 = np.percentile(raw['model_calls'][-1, :], 40)
-            x_60 = np.percentile(raw['model_calls'][-1, :], 60)
+            x = np.nanmedian(raw['model_calls'][-1, :])
+            x_40 = np.nanpercentile(raw['model_calls'][-1, :], 40)
+            x_60 = np.nanpercentile(raw['model_calls'][-1, :], 60)
             exp_name = f'{dataset}_hsj_rep_r_1_sn_0.01_cs_26_dr_0.5_dm_l2_b_1_deterministic_fp_0.00_ns_{n_images}'
             raw = read_dump(exp_name)
             calls = raw['model_calls'][-1, :]
@@ -606,12 +606,12 @@ def fig5():
             raw = read_dump(exp_name)
             calls_delta = raw['model_calls'][-1, :]
             z.append(0)
-            y.append(np.median(calls) / x)
-            y_40.append(np.median(calls) / x_60)
-            y_60.append(np.median(calls) / x_40)
-            y_delta.append(np.median(calls_delta) / x)
-            y_delta_40.append(np.median(calls_delta) / x_60)
-            y_delta_60.append(np.median(calls_delta) / x_40)
+            y.append(np.nanmedian(calls) / x)
+            y_40.append(np.nanmedian(calls) / x_60)
+            y_60.append(np.nanmedian(calls) / x_40)
+            y_delta.append(np.nanmedian(calls_delta) / x)
+            y_delta_40.append(np.nanmedian(calls_delta) / x_60)
+            y_delta_60.append(np.nanmedian(calls_delta) / x_40)
 
             b, sn, cs, dr = 1, 0.01, 26, 0.5
             noise_levels = sorted(data[dataset][noise].keys())
@@ -628,9 +628,9 @@ def fig5():
                     dr = noise_level
                 exp_name = f'{dataset}_psj_r_1_sn_{sn}_cs_{cs}_dr_{dr}_dm_l2_b_{b}_{noise}_fp_0.00_ns_{n_images}'
                 raw = read_dump(exp_name)
-                x = np.median(raw['model_calls'][-1, :])
-                x_40 = np.percentile(raw['model_calls'][-1, :], 40)
-                x_60 = np.percentile(raw['model_calls'][-1, :], 60)
+                x = np.nanmedian(raw['model_calls'][-1, :])
+                x_40 = np.nanpercentile(raw['model_calls'][-1, :], 40)
+                x_60 = np.nanpercentile(raw['model_calls'][-1, :], 60)
                 rep = data[dataset][noise][noise_level][0]
                 exp_name = f'{dataset}_hsj_rep_r_{rep}_sn_{sn}_cs_{cs}_dr_{dr}_dm_l2_b_{b}_{noise}_fp_0.00_ns_{n_images}'
                 raw = read_dump(exp_name)
@@ -641,12 +641,12 @@ def fig5():
                 calls_delta = raw['model_calls'][-1, :]
 
                 z.append(1.0 / noise_level)
-                y.append(np.median(calls) / x)
-                y_40.append(np.percentile(calls, 50) / x_60)
-                y_60.append(np.percentile(calls, 50) / x_40)
-                y_delta.append(np.median(calls_delta) / x)
-                y_delta_40.append(np.percentile(calls_delta, 50) / x_60)
-                y_delta_60.append(np.percentile(calls_delta, 50) / x_40)
+                y.append(np.nanmedian(calls) / x)
+                y_40.append(np.nanpercentile(calls, 50) / x_60)
+                y_60.append(np.nanpercentile(calls, 50) / x_40)
+                y_delta.append(np.nanmedian(calls_delta) / x)
+                y_delta_40.append(np.nanpercentile(calls_delta, 50) / x_60)
+                y_delta_60.append(np.nanpercentile(calls_delta, 50) / x_40)
 
             plt.plot(z, y, label='HSJr', marker='^')
             plt.fill_between(z, y_40, y_60, alpha=0.2)
@@ -821,8 +821,8 @@ def grad_evals(dataset='cifar10'):
         if dataset == 'cifar10':
             D = torch.cat([D[:, :57], D[:, 58:]], dim=1)
             C = torch.cat([C[:, :57], C[:, 58:]], dim=1)
-        dist = np.median(D, axis=1)
-        calls = np.median(C, axis=1)
+        dist = np.nanmedian(D, axis=1)
+        calls = np.nanmedian(C, axis=1)
         # perc_40 = np.percentile(raw[metric], 40, axis=1)
         # perc_60 = np.percentile(raw[metric], 60, axis=1)
         ax0.plot(dist, label=f'factor={ef}')
@@ -832,7 +832,7 @@ def grad_evals(dataset='cifar10'):
     D = raw[metric]
     if dataset == 'cifar10':
         D = torch.cat([D[:, :57], D[:, 58:]], dim=1)
-    dist = np.median(D, axis=1)
+    dist = np.nanmedian(D, axis=1)
     # perc_40 = np.percentile(raw[metric], 40, axis=1)
     # perc_60 = np.percentile(raw[metric], 60, axis=1)
     ax0.plot(dist, label=f'true grad')
@@ -880,19 +880,20 @@ def acceleration_prereq():
                 raw = read_dump(exp_name, raw=True)
                 raw_crunched = read_dump(exp_name)
                 C = np.zeros((n_images, n_iterations + 1))
-                dist = np.median(raw_crunched['border_distance'], axis=1)
+                dist = np.nanmedian(raw_crunched['border_distance'], axis=1)
                 T = np.zeros((n_images, n_iterations + 1))
                 for image in range(n_images):
                     diary = raw[image]
                     epoch = diary.epoch_start
                     C[image, 0] = diary.calls_initial_bin_search
                     T[image, 0] = diary.epoch_initial_bin_search - epoch
+                    # Cumulative times and calls of attacks that stopped early stay at their last value
                     for i in range(n_iterations):
-                        page = diary.iterations[i]
+                        page = diary.iterations[min(i, len(diary.iterations) - 1)]
                         C[image, i+1] = page.calls.bin_search
                         T[image, i+1] = page.time.bin_search - epoch
-                calls = np.median(C, axis=0)
-                timings = np.median(T, axis=0)
+                calls = np.nanmedian(C, axis=0)
+                timings = np.nanmedian(T, axis=0)
                 if pf == '1.0':
                     label = f'{noise}'
                 else:
@@ -948,17 +949,18 @@ def acceleration():
                     exp_name = f'{dataset}_psj_pf_{pf}_q_{q}_r_1_sn_{sn}_cs_{cs}_dr_{dr}_dm_l2_b_{b}_{noise}_fp_0.00_ns_{n_images}'
                 raw = read_dump(exp_name, raw=True)
                 raw_crunched = read_dump(exp_name)
-                dist = np.median(raw_crunched['border_distance'], axis=1)
-                calls = np.median(raw_crunched['model_calls'], axis=1)
+                dist = np.nanmedian(raw_crunched['border_distance'], axis=1)
+                calls = np.nanmedian(raw_crunched['model_calls'], axis=1)
                 T = np.zeros((n_images, n_iterations + 1))
                 for image in range(n_images):
                     diary = raw[image]
                     epoch = diary.epoch_start
                     T[image, 0] = diary.epoch_initial_bin_search - epoch
+                    # Cumulative times and calls of attacks that stopped early stay at their last value
                     for i in range(n_iterations):
-                        page = diary.iterations[i]
+                        page = diary.iterations[min(i, len(diary.iterations) - 1)]
                         T[image, i+1] = page.time.bin_search - epoch
-                timings = np.median(T, axis=0)
+                timings = np.nanmedian(T, axis=0)
                 ax2.plot(timings, dist, label=labels[pp], color=colors[pp])
                 ax1.plot(calls, dist, label=labels[pp], color=colors[pp])
                 ax0.plot(dist, label=labels[pp], color=colors[pp])
@@ -1033,16 +1035,17 @@ def queries_vs_time():
                     epoch = diary.epoch_start
                     T_binsearch[image, 0] = diary.epoch_initial_bin_search - epoch
                     C_binsearch[image, 0] = diary.calls_initial_bin_search
+                    # Cumulative times and calls of attacks that stopped early stay at their last value
                     for i in range(n_iterations):
-                        page = diary.iterations[i]
+                        page = diary.iterations[min(i, len(diary.iterations) - 1)]
                         T_grad[image, i] = page.time.approx_grad - epoch
                         T_binsearch[image, i+1] = page.time.bin_search - epoch
                         C_grad[image, i] = page.calls.approx_grad
                         C_binsearch[image, i+1] = page.calls.bin_search
-                timings_grad = np.median(T_grad, axis=0)
-                timings_bin = np.median(T_binsearch, axis=0)
-                calls_grad = np.median(C_grad, axis=0)
-                calls_bin = np.median(C_binsearch, axis=0)
+                timings_grad = np.nanmedian(T_grad, axis=0)
+                timings_bin = np.nanmedian(T_binsearch, axis=0)
+                calls_grad = np.nanmedian(C_grad, axis=0)
+                calls_bin = np.nanmedian(C_binsearch, axis=0)
 
                 ax0.plot([0, timings_bin[0]], [0, calls_bin[0]], color='pink')
                 for i in range(n_iterations):
@@ -1105,16 +1108,17 @@ def queries_vs_time_appendix():
                 epoch = diary.epoch_start
                 T_binsearch[image, 0] = diary.epoch_initial_bin_search - epoch
                 C_binsearch[image, 0] = diary.calls_initial_bin_search
+                # Cumulative times and calls of attacks that stopped early stay at their last value
                 for i in range(n_iterations):
-                    page = diary.iterations[i]
+                    page = diary.iterations[min(i, len(diary.iterations) - 1)]
                     T_grad[image, i] = page.time.approx_grad - epoch
                     T_binsearch[image, i+1] = page.time.bin_search - epoch
                     C_grad[image, i] = page.calls.approx_grad
                     C_binsearch[image, i+1] = page.calls.bin_search
-            timings_grad = np.median(T_grad, axis=0)
-            timings_bin = np.median(T_binsearch, axis=0)
-            calls_grad = np.median(C_grad, axis=0)
-            calls_bin = np.median(C_binsearch, axis=0)
+            timings_grad = np.nanmedian(T_grad, axis=0)
+            timings_bin = np.nanmedian(T_binsearch, axis=0)
+            calls_grad = np.nanmedian(C_grad, axis=0)
+            calls_bin = np.nanmedian(C_binsearch, axis=0)
 
             overall_calls = calls_bin[-1]
             ax0.plot([0, timings_bin[0]], [0, calls_bin[0]/overall_calls], color=colors[nn])
@@ -1176,16 +1180,17 @@ def queries_vs_time_dot():
                 epoch = diary.epoch_start
                 T_binsearch[image, 0] = diary.epoch_initial_bin_search - epoch
                 C_binsearch[image, 0] = diary.calls_initial_bin_search
-                for i in range(n_iterations):
+                # Attacks that stopped early spend nothing in the remaining iterations
+                for i in range(min(n_iterations, len(diary.iterations))):
                     page = diary.iterations[i]
                     T_grad[image, i] = page.time.approx_grad - page.time.start
                     T_binsearch[image, i+1] = page.time.bin_search - page.time.approx_grad
                     C_grad[image, i] = page.calls.approx_grad - page.calls.start
                     C_binsearch[image, i+1] = page.calls.bin_search - page.calls.approx_grad
-            timings_grad = np.median(T_grad, axis=0)
-            timings_bin = np.median(T_binsearch, axis=0)
-            calls_grad = np.median(C_grad, axis=0)
-            calls_bin = np.median(C_binsearch, axis=0)
+            timings_grad = np.nanmedian(T_grad, axis=0)
+            timings_bin = np.nanmedian(T_binsearch, axis=0)
+            calls_grad = np.nanmedian(C_grad, axis=0)
+            calls_bin = np.nanmedian(C_binsearch, axis=0)
 
             ax0.scatter(timings_bin.sum(), calls_bin.sum(), marker='^', s=50, color=colors[nn], label=f'bin step - {noise_names[dataset][nn]}')
             ax0.scatter(timings_grad.sum(), calls_grad.sum(), marker='o', s=50, color=colors[nn], label=f'grad step - {noise_names[dataset][nn]}')
@@ -1252,17 +1257,18 @@ def pie_chart():
                     epoch = diary.epoch_start
                     T_binsearch[image, 0] = diary.epoch_initial_bin_search - epoch
                     C_binsearch[image, 0] = diary.calls_initial_bin_search
-                    for i in range(n_iterations):
+                    # Attacks that stopped early spend nothing in the remaining iterations
+                    for i in range(min(n_iterations, len(diary.iterations))):
                         page = diary.iterations[i]
                         T_grad[image, i] = page.time.approx_grad - page.time.start
                         T_binsearch[image, i+1] = page.time.bin_search - page.time.approx_grad
                         C_grad[image, i] = page.calls.approx_grad - page.calls.start
                         C_binsearch[image, i+1] = page.calls.bin_search - page.calls.approx_grad
-                timings_grad = np.median(T_grad, axis=0)
-                timings_bin = np.median(T_binsearch, axis=0)
+                timings_grad = np.nanmedian(T_grad, axis=0)
+                timings_bin = np.nanmedian(T_binsearch, axis=0)
                 t_grad, t_bin = timings_grad.sum(), timings_bin.sum()
-                calls_grad = np.median(C_grad, axis=0)
-                calls_bin = np.median(C_binsearch, axis=0)
+                calls_grad = np.nanmedian(C_grad, axis=0)
+                calls_bin = np.nanmedian(C_binsearch, axis=0)
                 c_grad, c_bin = calls_grad.sum(), calls_bin.sum()
 
                 # grads.append(t_grad)
@@ -1,7 +1,8 @@
 import matplotlib.pylab as plt
 import numpy as np
 import torch
-from tracker import DiaryPage, Diary
+from tracker import DiaryPage, Diary, load_diaries
+from metrics_store import MetricsStore
 from model_factory import get_models_from_file
 from matplotlib import rc
 import math
@@ -11,20 +12,19 @@ from img_utils import get_device
 OUT_DIR = 'thesis'
 PLOTS_DIR = f'{OUT_DIR}/plots_multimodel/'
 device = get_device()
+metrics = MetricsStore(OUT_DIR)
 d = 28*28
 
 
 def read_dump(path, raw=False, aa=False, aaa=False):
+    """ Crunched metrics come from the metrics store, raw diaries are loaded with their images """
     if raw:
-        filepath = f'{OUT_DIR}/{path}/raw_data.pkl'
+        return load_diaries(f'{OUT_DIR}/{path}/raw_data.pkl', map_location=device)
     elif aa:
-        filepath = f'{OUT_DIR}/{path}/crunched_aa.pkl'
+        return metrics.experiment(path, prefix='aa.')
     elif aaa:
-        filepath = f'{OUT_DIR}/{path}/crunched_aaa.pkl'
-    else:
-        filepath = f'{OUT_DIR}/{path}/crunched.pkl'
-    raw = torch.load(open(filepath, 'rb'), map_location=device)
-    return raw
+        return metrics.experiment(path, prefix='aaa.')
+    return metrics.experiment(path)
 
 
 def interpolation(x_star, x_t, alpha):
@@ -94,7 +94,7 @@ def plot_distance():
         exp_name = f'psj_models_{n_models}'
         raw = read_dump(exp_name, raw=True)
         NUM_IMAGES = len(raw)
-        NUM_ITERATIONS = len(raw[0].iterations)
+        NUM_ITERATIONS = max(len(diary.iterations) for diary in raw)
         D = torch.zeros(size=(NUM_ITERATIONS+1, NUM_IMAGES))
         for image in tqdm(range(NUM_IMAGES)):
             diary: Diary = raw[image]
@@ -102,7 +102,7 @@ def plot_distance():
             label = diary.true_label
             D[0, image] = torch.norm(diary.initial_projection - x_star) / math.sqrt(d)
             for iteration in range(NUM_ITERATIONS):
-                page: DiaryPage = diary.iterations[iteration]
+                page: DiaryPage = diary.iterations[min(iteration, len(diary.iterations) - 1)]
                 x_t = page.bin_search
                 x_tt = project(x_star, x_t, label, 1.0 / 28*28*28, models)
                 D[iteration+1, image] = torch.norm(x_tt - x_star) / math.sqrt(d)
@@ -153,7 +153,7 @@ def plot_distance_arch():
         exp_name = f'psj_models_{n_models}_each'
         raw = read_dump(exp_name, raw=True)
         NUM_IMAGES = len(raw)
-        NUM_ITERATIONS = len(raw[0].iterations)
+        NUM_ITERATIONS = max(len(diary.iterations) for diary in raw)
         D = torch.zeros(size=(NUM_ITERATIONS+1, NUM_IMAGES))
         for image in tqdm(range(NUM_IMAGES)):
             diary: Diary = raw[image]
@@ -161,7 +161,7 @@ def plot_distance_arch():
             label = diary.true_label
             D[0, image] = torch.norm(diary.initial_projection - x_star) / math.sqrt(d)
             for iteration in range(NUM_ITERATIONS):
-                page: DiaryPage = diary.iterations[iteration]
+                page: DiaryPage = diary.iterations[min(iteration, len(diary.iterations) - 1)]
                 x_t = page.bin_search
                 x_tt = project(x_star, x_t, label, 1.0 / 28*28*28, models)
                 D[iteration+1, image] = torch.norm(x_tt - x_star) / math.sqrt(d)
@@ -229,7 +229,7 @@ def plot_sigmoids():
                 ims = diary.init_infomax
                 s, t, e = ims.s, ims.tmap, ims.e
             else:
-                page: DiaryPage = diary.iterations[iteration]
+                page: DiaryPage = diary.iterations[min(iteration, len(diary.iterations) - 1)]
                 x_hat = page.opposite
                 ims = page.info_max_stats
                 s, t, e = ims.s, ims.tmap, ims.e
@@ -298,7 +298,7 @@ def plot_sigmoids_arch():
                 ims = diary.init_infomax
                 s, t, e = ims.s, ims.tmap, ims.e
             else:
-                page: DiaryPage = diary.iterations[iteration]
+                page: DiaryPage = diary.iterations[min(iteration, len(diary.iterations) - 1)]
                 x_hat = page.opposite
                 ims = page.info_max_stats
                 s, t, e = ims.s, ims.tmap, ims.e
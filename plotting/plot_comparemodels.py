@@ -1,7 +1,6 @@
-import torch
 import numpy as np
 import matplotlib.pylab as plt
-from tracker import Diary
+from tracker import Diary, load_diaries
 from model_factory import get_model
 
 dumps = ['gpu', 'gpu_pf', 'gpu_pf_q', 'gpu_pf_q_gq']
@@ -12,7 +11,7 @@ image_path = 'adv/del_later.pdf'
 
 def read_dump(name):
     filepath = 'adv/{}/raw_data.pkl'.format(name)
-    return torch.load(open(filepath, 'rb'), map_location='cpu')
+    return load_diaries(filepath, map_location='cpu')
 
 
 raws = [read_dump(s) for s in dumps]
@@ -26,7 +25,7 @@ for r, raw in enumerate(raws):
     for iteration in range(NUM_ITERATIONS):
         for image in range(n_imgs):
             diary: Diary = raw[image]
-            x_t = diary.iterations[iteration].bin_search.numpy()
+            x_t = diary.iterations[min(iteration, len(diary.iterations) - 1)].bin_search.numpy()
             x_star = diary.original.numpy()
             label = diary.true_label
             p_t = model.get_probs([x_t])[0][label]
@@ -7,7 +7,7 @@ from matplotlib import rc, rcParams
 from tqdm import tqdm
 from model_factory import get_model
 from img_utils import get_device
-from tracker import Diary
+from tracker import Diary, load_diaries
 
 OUT_DIR = 'aistats'
 device = get_device()
@@ -18,7 +18,7 @@ eps = list(range(1, 6))
 
 def read_dump(path):
     filepath = f'{OUT_DIR}/{path}/raw_data.pkl'
-    raw = torch.load(open(filepath, 'rb'), map_location=device)
+    raw = load_diaries(filepath, map_location=device)
     # raw = torch.load(open(filepath, 'rb'))
     return raw
 
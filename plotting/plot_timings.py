@@ -1,89 +1,97 @@
-import pickle
-import torch
+import sys
 import numpy as np
 import matplotlib.pylab as plt
-from model_factory import get_model
-from tracker import Diary
+from metrics_store import MetricsStore
 
-NUM_ITERATIONS = 32
-NUM_IMAGES = 100
-# TARGET_IMAGE = 4
-NOISE = 'bayesian'
-exp_name = 'eval_exp_wo_step_50'
-# lis = ['infomax_5_32_opp', 'infomax_5_32_evals','infomax_5_32_opp_evals']
-# lis = ['gpu_cpu', 'gpu', 'gpu_exp', 'gpu_approxgrad', 'gpu_bernoulli', 'gpu_cj', 'gpu_queries_20']
-# titles = ['CPU', 'GPU', 'GPU (in batches)', 'Approximate Gradient on GPU now',
-#           'Bernoulli instead of model calls inside bin_search',
-#           'CJ Optimization (Interval)', 'CJ Optimization (Queries=5)']
-lis = ['gpu', 'gpu_pf', 'gpu_pf_q', 'gpu_pf_q_gq']
-titles = ['PF=1.0, Q=1, GQ=1', 'PF=0.1, Q=1, GQ=1', 'PF=0.1, Q=5, GQ=1', 'PF=0.1, Q=5, GQ=5']
-# lis = lis[-2:]
-# titles = titles[-2:]
-image_path = 'adv/timings.pdf'
+# Usage: python -m plotting.plot_timings <exp_name> [<exp_name> ...]
+# Experiments run with --profile show model forward time against attack logic time per phase, the infomax internals of
+# the binary search and the mean forward batch size. Older runs only have the phase boundaries of DiaryPage.time.
+OUT_DIR = 'thesis'
+PHASES = ['approx_grad', 'step_search', 'opposite', 'bin_search']
+# Boundaries of the phases in DiaryPage.time, used when an experiment was not profiled
+PHASE_BOUNDS = {'approx_grad': ('start', 'approx_grad'), 'step_search': ('approx_grad', 'step_search'),
+                'opposite': ('step_search', 'opposite'), 'bin_search': ('opposite', 'bin_search')}
+INFOMAX = ['preprocessing', 'compute_probs', 'setting_stats', 'acq_func', 'max_acquisition', 'posterior']
+COLORS = {'approx_grad': 'tab:blue', 'step_search': 'tab:orange', 'opposite': 'tab:green', 'bin_search': 'tab:red'}
+exp_names = sys.argv[1:]
+image_path = f'{OUT_DIR}/timings.pdf'
 
-model = get_model(key='mnist_noman', dataset='mnist')
+metrics = MetricsStore(OUT_DIR)
 
 
-def read_dump(path):
-    filepath = 'adv/{}/raw_data.pkl'.format(path)
-    try:
-        raw = torch.load(open(filepath, 'rb'), map_location='cpu')
-    except:
-        raw = pickle.load(open(filepath, 'rb'))
-    return raw
+def per_iteration(exp_name, metric):
+    """ Mean over the images of a page metric, per iteration (0 where missing) """
+    if 'raw.' + metric not in available[exp_name]:
+        return None
+    values = metrics.query(exp_name, 'raw.' + metric)
+    counts = np.sum(~np.isnan(values), axis=1)
+    return np.nan_to_num(np.nansum(values, axis=1) / np.maximum(counts, 1))
 
 
-# raws = [read_dump(exp_name)]
-raws = [read_dump(s) for s in lis]
+def phase_times(exp_name, phase):
+    """ :return: (wall, forward) seconds per iteration, forward is None for experiments run without --profile """
+    wall = per_iteration(exp_name, f'profile.{phase}.wall')
+    if wall is not None:
+        forward = per_iteration(exp_name, f'profile.{phase}.forward')
+        return wall, forward if forward is not None else np.zeros_like(wall)
+    start, end = PHASE_BOUNDS[phase]
+    return per_iteration(exp_name, f'time.{end}') - per_iteration(exp_name, f'time.{start}'), None
 
-fig = plt.figure(figsize=(20, 5 * len(lis)))
-for i, raw in enumerate(raws):
-    t_approx_grad, t_step_search, t_bin_search, t_total = 0, 0, 0, 0
-    t_num_evals = 0
-    for iteration in range(NUM_ITERATIONS):
-        for image in range(NUM_IMAGES):
-            diary: Diary = raw[image]
-            if len(diary.iterations) is 0:
-                continue
-            epoch = diary.epoch_start
-            init_search = diary.epoch_initial_bin_search - epoch
-            details = raw[image].iterations[iteration].time
-            start = details.start
-            # num_evals = details[iteration]['num_evals']
-            approx_grad = details.approx_grad
-            step_search = details.step_search
-            bin_search = details.bin_search
-            end = details.end
 
-            # t_num_evals += num_evals - start
-            # t_approx_grad += approx_grad - num_evals
-            t_approx_grad += approx_grad - start
-            t_step_search += step_search - approx_grad
-            t_bin_search += bin_search - step_search
-            t_total += end - start
-    t_approx_grad /= NUM_IMAGES
-    t_bin_search /= NUM_IMAGES
-    t_total /= NUM_IMAGES
-    labels = ['Approx Grad', 'Binary Search']
-    values = [t_approx_grad, t_bin_search]
-    print(values, t_total)
-    plt.subplot(len(raws) / 2 + 1, 2, i + 1)
-    plt.pie(values, labels=labels)
-    # plt.text(-2, 1.1, "Num Evals: {} secs".format(np.round(t_num_evals, 1)))
-    plt.text(-2, 0.9, "Approx Grad: {} secs/image".format(np.round(t_approx_grad, 1)))
-    # plt.text(-2, 0.9, "Step Search: {} secs".format(np.round(t_step_search, 1)))
-    plt.text(-2, 0.8, "Binary Search: {} secs/image".format(np.round(t_bin_search, 1)))
-    plt.text(-2, 0.7, "Total: {} secs/image".format(np.round(t_total, 1)))
-    plt.title(titles[i])
-    # plt.bar(['Approx Grad'], [t_approx_grad])
-    # plt.bar(['Step Search'], [t_step_search])
-    # plt.bar(['Binary Search'], [t_bin_search])
-    # plt.bar(['Total'], [t_total])
-    # ax1.plot(range(1, NUM_ITERATIONS+2), total_bin_calls, label='Total', color='grey')
-plt.suptitle(f"Timing Analysis for {NUM_IMAGES} images\n"
-             f"PF: prior fraction in infomax\n"
-             f"Q: queries per point in infomax\n"
-             f"GQ: queries per point in approx. gradient")
-# plt.ylabel('Time (in seconds)')
+available = {exp_name: set(metrics.metrics(exp_name)) for exp_name in exp_names}
+fig, axes = plt.subplots(len(exp_names), 3, figsize=(21, 5 * len(exp_names)), squeeze=False)
+for row, exp_name in enumerate(exp_names):
+    ax_iter, ax_total, ax_batch = axes[row]
+    profiled = 'raw.profile.approx_grad.wall' in available[exp_name]
+    bottom, totals = None, {}
+    for phase in PHASES:
+        wall, forward = phase_times(exp_name, phase)
+        x = np.arange(1, len(wall) + 1)
+        bottom = np.zeros_like(wall) if bottom is None else bottom
+        if forward is None:
+            ax_iter.bar(x, wall, bottom=bottom, color=COLORS[phase], label=phase)
+            totals[phase] = (0., wall.sum())
+        else:
+            ax_iter.bar(x, forward, bottom=bottom, color=COLORS[phase], label=f'{phase} (forward)')
+            ax_iter.bar(x, wall - forward, bottom=bottom + forward, color=COLORS[phase], alpha=0.4,
+                        label=f'{phase} (logic)')
+            totals[phase] = (forward.sum(), (wall - forward).sum())
+        bottom = bottom + wall
+    ax_iter.set_xlabel('Iteration')
+    ax_iter.set_ylabel('Seconds per image')
+    ax_iter.set_title(exp_name)
+    ax_iter.legend(fontsize=7)
+
+    # Totals per phase, split into forward and logic, followed by the infomax internals of the binary search
+    names = PHASES[:]
+    forward_totals = [totals[phase][0] for phase in PHASES]
+    logic_totals = [totals[phase][1] for phase in PHASES]
+    for name in INFOMAX:
+        values = per_iteration(exp_name, f'profile.infomax.{name}')
+        if values is not None:
+            names.append(f'infomax.{name}')
+            forward_totals.append(0.)
+            logic_totals.append(values.sum())
+    ax_total.barh(names, forward_totals, color='tab:gray', label='forward')
+    ax_total.barh(names, logic_totals, left=forward_totals, color='tab:purple', alpha=0.5, label='logic')
+    ax_total.invert_yaxis()
+    ax_total.set_xlabel('Seconds per image (all iterations)')
+    ax_total.set_title('Where the time goes' + ('' if profiled else ' (not profiled: phase boundaries only)'))
+    ax_total.legend(fontsize=7)
+
+    # Mean batch size of the forward passes
+    for phase in PHASES:
+        samples = per_iteration(exp_name, f'profile.{phase}.samples')
+        forwards = per_iteration(exp_name, f'profile.{phase}.forwards')
+        if samples is not None and forwards is not None:
+            ax_batch.plot(np.arange(1, len(samples) + 1), samples / np.maximum(forwards, 1), color=COLORS[phase],
+                          label=phase)
+    ax_batch.set_xlabel('Iteration')
+    ax_batch.set_ylabel('Mean forward batch size')
+    if profiled:
+        ax_batch.set_yscale('log')
+        ax_batch.legend(fontsize=7)
+
+plt.tight_layout()
 plt.savefig(image_path)
-pass
+print('Saved {}'.format(image_path))
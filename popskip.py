@@ -9,6 +9,8 @@ from tracker import InfoMaxStats
 
 
 class PopSkipJump(Attack):
+    CHECKPOINT_ATTRIBUTES = Attack.CHECKPOINT_ATTRIBUTES + ('target_cos',)
+
     def __init__(self, model_interface, data_shape, device=None, params: DefaultParams = None):
         super().__init__(model_interface, data_shape, device, params)
         self.theta_prob = 1. / self.grid_size # Theta for Info-max procedure
@@ -19,6 +21,7 @@ class PopSkipJump(Attack):
             self.delta_det_unit = self.theta_det * self.d
             self.delta_prob_unit = self.d / self.grid_size  # PSJA's delta in unit scale
         self.stop_criteria = params.infomax_stop_criteria
+        self.target_cos = None  # Target cosine of the last infomax search, used by the sequential gradient estimator
 
     def bin_search_step(self, original, perturbed, page=None, estimates=None, step=None):
         if self.targeted:
@@ -42,7 +45,8 @@ class PopSkipJump(Attack):
         page.num_eval_prob = num_evals_prob
         num_evals_prob = int(min(num_evals_prob, self.max_num_evals))
         page.time.num_evals = time.time()
-        return self._gradient_estimator(perturbed, num_evals_prob, delta_prob)
+        target_cos = self.target_cos if self.sequential_grad else None
+        return self._gradient_estimator(perturbed, num_evals_prob, delta_prob, target_cos)
 
     def make_gradient_step(self, epsilon, perturbed, update):
         if self.constraint == 'l2':
@@ -90,21 +94,21 @@ class PopSkipJump(Attack):
         # TODO: Replace Binary Search with a closed form solution (if it exists)
         if estimates is None:
             s, eps = 100., 1e-4
-            n1 = get_n_from_cos(target_cos, s=s, theta=0, delta=self.delta_prob_unit, d=self.d, eps=eps)
+            n1 = get_n_from_cos(target_cos, s=s, theta=0, delta=self.delta_prob_unit, d=self.d_eff, eps=eps)
         else:
             s, eps = estimates['s'], estimates['e']
-            n1 = get_n_from_cos(target_cos, s=s, theta=0, delta=self.delta_prob_unit, d=self.d, eps=eps)
+            n1 = get_n_from_cos(target_cos, s=s, theta=0, delta=self.delta_prob_unit, d=self.d_eff, eps=eps)
         low, high = 0, self.theta_det
         theta = self.theta_det
-        n2 = get_n_from_cos(target_cos, s=s, theta=theta, delta=self.delta_prob_unit, d=self.d, eps=eps)
+        n2 = get_n_from_cos(target_cos, s=s, theta=theta, delta=self.delta_prob_unit, d=self.d_eff, eps=eps)
         while (n2-n1) < 1:
             theta *= 2
-            n2 = get_n_from_cos(target_cos, s=s, theta=theta, delta=self.delta_prob_unit, d=self.d, eps=eps)
+            n2 = get_n_from_cos(target_cos, s=s, theta=theta, delta=self.delta_prob_unit, d=self.d_eff, eps=eps)
             low, high = theta/2, theta
 
         while high - low >= self.theta_det:
             mid = (low + high) / 2
-            n2 = get_n_from_cos(target_cos, s=s, theta=mid, delta=self.delta_prob_unit, d=self.d, eps=eps)
+            n2 = get_n_from_cos(target_cos, s=s, theta=mid, delta=self.delta_prob_unit, d=self.d_eff, eps=eps)
             if (n2 - n1) < 1:
                 low = mid
             else:
@@ -127,16 +131,17 @@ class PopSkipJump(Attack):
         dists = []
         smaps, tmaps, emaps, ns = [], [], [], []
         if estimates is None:
-            target_cos = get_cos_from_n(self.initial_num_evals, theta=self.theta_det, delta=self.delta_det_unit, d=self.d)
+            target_cos = get_cos_from_n(self.initial_num_evals, theta=self.theta_det, delta=self.delta_det_unit, d=self.d_eff)
         else:
             num_evals_det = int(min([self.initial_num_evals * math.sqrt(step+1), self.max_num_evals]))
-            target_cos = get_cos_from_n(num_evals_det, theta=self.theta_det, delta=self.delta_det_unit, d=self.d)
+            target_cos = get_cos_from_n(num_evals_det, theta=self.theta_det, delta=self.delta_det_unit, d=self.d_eff)
+        self.target_cos = target_cos
         # theta_prob_dynamic = self.get_theta_prob(target_cos, estimates)
         # grid_size_dynamic = min(self.grid_size, int(1 / theta_prob_dynamic) + 1)
         grid_size_dynamic = self.grid_size
         for perturbed_input in perturbed_inputs:
             output, n = bin_search(
-                unperturbed, perturbed_input, self.model_interface, d=self.d,
+                unperturbed, perturbed_input, self.model_interface, d=self.d_eff,
                 grid_size=grid_size_dynamic, device=self.device, delta=self.delta_prob_unit,
                 label=label, targeted=self.targeted, prev_t=self.prev_t, prev_s=self.prev_s,
                 prev_e=self.prev_e, prior_frac=prior_frac, target_cos=target_cos,
@@ -148,7 +153,7 @@ class PopSkipJump(Attack):
                 num_retries += 1
                 print(f'Got t_map == 1, Retrying {num_retries}...')
                 output, n = bin_search(
-                    unperturbed, perturbed_input, self.model_interface, d=self.d,
+                    unperturbed, perturbed_input, self.model_interface, d=self.d_eff,
                     grid_size=grid_size_dynamic, device=self.device, delta=self.delta_prob_unit,
                     label=label, targeted=self.targeted, prev_t=self.prev_t, prev_s=self.prev_s,
                     prev_e=self.prev_e, prior_frac=prior_frac, target_cos=target_cos,
@@ -210,17 +215,15 @@ class PopSkipJumpTrueLogits(PopSkipJump):
             threshold = self.theta_det
         low = torch.zeros(1, device=self.device)
         while high - low > threshold:
-            mid = (high + low) / 2.0
-            mid_input = self.project(original, perturbed, mid)
-            prob = self.model_interface.decision_with_logits(mid_input, self.a.true_label)[0]
-            if prob[self.a.true_label] < 0.5:
-                high = mid
-            else:
-                low = mid
+            mids = self.kary_search_points(low, high)
+            mid_inputs = self.project(original, perturbed, mids[0])
+            probs = self.model_interface.decision_with_logits(mid_inputs, self.a.true_label)
+            decisions = (probs[:, self.a.true_label] < 0.5) * 1
+            low, high = self.kary_search_update(low, high, mids, decisions.view(mids.shape))
         out_input = self.project(original, perturbed, high)[0]
         return out_input, dists_post_update, None
 
     def gradient_approximation_step(self, perturbed, num_evals_det, delta, dist_post_update, estimates, page):
-        self.model_interface.model_calls += 1
+        self.model_interface.charge(1)
         grad = self.model_interface.get_grads(perturbed[None], self.a.true_label)[0][0]
         return grad / torch.norm(grad)
@@ -115,14 +115,14 @@ class PopSkipJumpHuman(Attack):
         dists = []
         smaps, tmaps, emaps, ns = [], [], [], []
         if estimates is None:
-            target_cos = get_cos_from_n(self.initial_num_evals, theta=self.theta_det, delta=self.delta_det_unit, d=self.d)
+            target_cos = get_cos_from_n(self.initial_num_evals, theta=self.theta_det, delta=self.delta_det_unit, d=self.d_eff)
         else:
             num_evals_det = int(min([self.initial_num_evals * math.sqrt(step+1), self.max_num_evals]))
-            target_cos = get_cos_from_n(num_evals_det, theta=self.theta_det, delta=self.delta_det_unit, d=self.d)
+            target_cos = get_cos_from_n(num_evals_det, theta=self.theta_det, delta=self.delta_det_unit, d=self.d_eff)
         grid_size_dynamic = self.grid_size
         for perturbed_input in perturbed_inputs:
             output, n = bin_search(
-                unperturbed, perturbed_input, self.model_interface, d=self.d,
+                unperturbed, perturbed_input, self.model_interface, d=self.d_eff,
                 grid_size=grid_size_dynamic, device=self.device, delta=self.delta_prob_unit,
                 label=label, targeted=self.targeted, prev_t=self.prev_t, prev_s=self.prev_s,
                 prev_e=self.prev_e, prior_frac=prior_frac, target_cos=target_cos,
@@ -135,7 +135,7 @@ class PopSkipJumpHuman(Attack):
                 num_retries += 1
                 print(f'Got t_map == 1, Retrying {num_retries}...')
                 output, n = bin_search(
-                    unperturbed, perturbed_input, self.model_interface, d=self.d,
+                    unperturbed, perturbed_input, self.model_interface, d=self.d_eff,
                     grid_size=grid_size_dynamic, device=self.device, delta=self.delta_prob_unit,
                     label=label, targeted=self.targeted, prev_t=self.prev_t, prev_s=self.prev_s,
                     prev_e=self.prev_e, prior_frac=prior_frac, target_cos=target_cos,
@@ -0,0 +1,136 @@
+import contextlib
+import os
+import resource
+import time
+import torch
+
+PROFILE_METRICS = ('wall', 'forward', 'forwards', 'samples', 'max_batch', 'memory')
+
+
+class Profiler(object):
+    """
+        Per-phase instrumentation of an attack, cheap enough to leave on (and free when disabled).
+        The attack switches phases with set_phase() (like QueryBudget.set_phase), ModelInterface times every forward
+        pass with forward(), and collect() returns what was recorded since the previous collect() as a flat dict
+        {'<phase>.<metric>': value} with the metrics
+            wall        seconds spent in the phase (perf_counter)
+            forward     seconds spent in model forward passes, wall - forward is the time of the attack logic
+            forwards    number of forward passes
+            samples     number of images forwarded, samples / forwards is the mean batch size
+            max_batch   largest batch forwarded
+            memory      bytes: growth of the allocator peak over the phase on GPU, growth of the process peak RSS on CPU
+        Timings of sub-phases reported with add() (e.g. the internals of infomax.bin_search) are summed under their own
+        name. With trace_dir, trace() also records the enclosed code with torch.profiler and saves a chrome trace.
+    """
+    def __init__(self, enabled=False, device=None, trace_dir=None):
+        self.enabled = enabled
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        self.trace_dir = trace_dir
+        self.phase = None
+        self.phase_start = None
+        self.phase_memory = None
+        self.values = {}
+        # record_function range of the current phase while a torch.profiler trace is recorded
+        self.tracing = False
+        self.phase_range = None
+
+    def _memory(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated()
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def add(self, name, value):
+        if not self.enabled:
+            return
+        self.values[name] = self.values.get(name, 0) + value
+
+    def _close_phase(self):
+        if self.phase is None:
+            return
+        self._sync()
+        self.add(self.phase + '.wall', time.perf_counter() - self.phase_start)
+        self.add(self.phase + '.memory', max(self._memory() - self.phase_memory, 0))
+        self._close_range()
+
+    def _close_range(self):
+        if self.phase_range is not None:
+            self.phase_range.__exit__(None, None, None)
+            self.phase_range = None
+
+    def _open_phase(self, phase):
+        self.phase = phase
+        if self.cuda:
+            self.phase_memory = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self.phase_memory = self._memory()
+        if self.tracing:
+            self.phase_range = torch.profiler.record_function(phase)
+            self.phase_range.__enter__()
+        self.phase_start = time.perf_counter()
+
+    def set_phase(self, phase):
+        if not self.enabled:
+            return
+        self._close_phase()
+        self._open_phase(phase)
+
+    def forward(self, batch_size):
+        """ Context manager around a forward pass of batch_size images """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._forward(batch_size)
+
+    @contextlib.contextmanager
+    def _forward(self, batch_size):
+        phase = self.phase if self.phase is not None else 'other'
+        self._sync()
+        start = time.perf_counter()
+        yield
+        self._sync()
+        self.add(phase + '.forward', time.perf_counter() - start)
+        self.add(phase + '.forwards', 1)
+        self.add(phase + '.samples', batch_size)
+        self.values[phase + '.max_batch'] = max(self.values.get(phase + '.max_batch', 0), batch_size)
+
+    def collect(self):
+        """ :return: values recorded since the last collect (None when disabled), the current phase goes on """
+        if not self.enabled:
+            return None
+        phase = self.phase
+        self._close_phase()
+        values, self.values = self.values, {}
+        if phase is not None:
+            self._open_phase(phase)
+        return values
+
+    def reset(self):
+        self._close_range()
+        self.phase = None
+        self.values = {}
+
+    def trace(self, name):
+        """ Context manager recording a torch.profiler trace saved as <trace_dir>/<name>.json (if trace_dir is set) """
+        if self.trace_dir is None:
+            return contextlib.nullcontext()
+        return self._trace(name)
+
+    @contextlib.contextmanager
+    def _trace(self, name):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+            self.tracing = True
+            try:
+                yield
+            finally:
+                self._close_range()
+                self.tracing = False
+        os.makedirs(self.trace_dir, exist_ok=True)
+        prof.export_chrome_trace(os.path.join(self.trace_dir, name + '.json'))
@@ -0,0 +1,131 @@
+import argparse
+import copy
+import logging
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from img_utils import get_samples
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+
+def attack_like_images(images, n_samples):
+    """
+    Points on segments between sample images and uniform noise / other samples.
+    Decision-based attacks query along such segments (initialization, binary search), so the calibration and the
+    disagreement report should cover them and not only clean images.
+    """
+    idx = torch.randint(len(images), size=(n_samples,))
+    others = torch.where(torch.rand(n_samples).view([-1] + [1] * (images.ndim - 1)) < 0.5,
+                         torch.rand_like(images[idx]), images[torch.randint(len(images), size=(n_samples,))])
+    alphas = torch.rand(n_samples).view([-1] + [1] * (images.ndim - 1))
+    return alphas * images[idx] + (1 - alphas) * others
+
+
+def calibration_images(dataset, n_samples=64, n_attack_like=64, samples_from=0):
+    images, _ = get_samples(dataset, n_samples=n_samples + samples_from, samples_from=samples_from)
+    images = torch.tensor(images, dtype=torch.float32)
+    return torch.cat([images, attack_like_images(images, n_attack_like)])
+
+
+def _module_inputs(model, images):
+    """ Input of model.model when model.predict(images) is called, i.e. after the wrapper's preprocessing """
+    inputs = []
+    handle = model.model.register_forward_pre_hook(lambda module, args: inputs.append(args))
+    model.predict(images)
+    handle.remove()
+    return inputs[0]
+
+
+def _views_to_reshapes(module):
+    """
+    Quantized convolutions return channels-last tensors, on which the x.view(-1, n) of the MNIST nets fails.
+    Every view of the traced graph is replaced by the equivalent reshape.
+    """
+    graph_module = torch.fx.symbolic_trace(module)
+    for node in graph_module.graph.nodes:
+        if node.op == 'call_method' and node.target == 'view':
+            node.target = 'reshape'
+    graph_module.recompile()
+    return graph_module
+
+
+def quantize_static(model, images, batch_size=64):
+    """
+    Post-training static quantization (FX graph mode): observers are calibrated on images, fed through the wrapper's
+    own preprocessing, before converting weights and activations to int8.
+    :param model: Model wrapper (see model_factory) holding the fp32 module
+    :return: quantized module
+    """
+    module = _views_to_reshapes(copy.deepcopy(model.model).eval())
+    example_inputs = _module_inputs(model, images[:1])
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(module, qconfig_mapping, example_inputs)
+    calibrating = copy.copy(model)
+    calibrating.model = prepared
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            calibrating.predict(images[start:start + batch_size])
+    return convert_fx(prepared)
+
+
+def quantize_model(model, mode, dataset, images=None):
+    """
+    :param model: Model wrapper holding the fp32 module
+    :param mode: 'dynamic' (int8 weights of Linear layers) or 'static' (int8 weights and activations)
+    :param images: calibration images, sampled from the test set of the dataset by default
+    :return: quantized module (CPU only)
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise RuntimeError(f'Unknown quantization mode: {mode}')
+    if images is None:
+        images = calibration_images(dataset)
+    if mode == 'dynamic':
+        quantized = quantize_dynamic(copy.deepcopy(model.model).eval(), {nn.Linear}, dtype=torch.qint8)
+    else:
+        quantized = quantize_static(model, images)
+    quantized_model = copy.copy(model)
+    quantized_model.model = quantized
+    report = disagreement_report(model, quantized_model, images)
+    logging.warning('Quantized ({}) model disagrees with fp32 on {:.4f} of calibration images'.format(
+        mode, report['disagreement']))
+    return quantized
+
+
+def disagreement_report(model, quantized_model, images, batch_size=256):
+    """
+    How often the quantized model's decision (argmax) differs from the fp32 model
+    :return: dict with the disagreement rate on images and on attack-like images built from them
+    """
+    def rate(batch):
+        disagreements = 0
+        max_prob_diff = 0.
+        with torch.no_grad():
+            for start in range(0, len(batch), batch_size):
+                probs = model.get_probs(batch[start:start + batch_size])
+                q_probs = quantized_model.get_probs(batch[start:start + batch_size])
+                disagreements += int((probs.argmax(dim=1) != q_probs.argmax(dim=1)).sum())
+                max_prob_diff = max(max_prob_diff, float((probs - q_probs).abs().max()))
+        return disagreements / len(batch), max_prob_diff
+
+    disagreement, max_prob_diff = rate(images)
+    disagreement_attack_like, _ = rate(attack_like_images(images, len(images)))
+    return {'n': len(images), 'disagreement': disagreement, 'disagreement_attack_like': disagreement_attack_like,
+            'max_prob_diff': max_prob_diff}
+
+
+if __name__ == '__main__':
+    from model_factory import get_model
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset", type=str, default='mnist')
+    parser.add_argument("-k", "--key", type=str, default='mnist_noman')
+    parser.add_argument("-m", "--mode", type=str, default='static')
+    parser.add_argument("-ns", "--num_samples", type=int, default=256,
+                        help="Number of held-out test images used for the report")
+    args = parser.parse_args()
+    fp32_model = get_model(args.key, args.dataset, noise='deterministic')
+    int8_model = get_model(args.key, args.dataset, noise='deterministic', quantize=args.mode)
+    # Images used for calibration are skipped
+    held_out = calibration_images(args.dataset, args.num_samples, args.num_samples, samples_from=64)
+    print(disagreement_report(fp32_model, int8_model, held_out))
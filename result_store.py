@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import torch
+from tracker import RunTracker, load_diaries, load_tracker
+
+
+class ShardedResultStore(object):
+    """
+        Append-only store of attack results, written while the run goes on.
+        Every attacked image (or (image, target) pair) gets its own shard: a columnar RunTracker holding its Diary.
+        index.json maps the key of every finished shard to its file and summary (final distance, model calls,
+        stop reason). Shards and index are written to a temporary file first and then renamed, so a crash never
+        leaves a partial shard in the index and a resumed run can skip every key already present.
+        The index also records the config of the run (with the image dtype), and a store is only resumed by a run with
+        the same one, so that a raw_data.pkl never mixes results of two configurations.
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, path, image_dtype='float32', resume=False, config=None):
+        """
+        :param config: JSON-able dict of the parameters that the results depend on. None skips the config check, e.g.
+                       to only read a store
+        """
+        self.path = path
+        self.image_dtype = image_dtype
+        if os.path.exists(path) and not resume:
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.index = self._read_index()
+        self._check_config(config)
+
+    def _read_index(self):
+        index_path = os.path.join(self.path, self.INDEX)
+        if not os.path.exists(index_path):
+            return {'version': 1, 'shards': {}}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _check_config(self, config):
+        """ Refuses to add to shards written with another config or image dtype """
+        if config is None:
+            return
+        # Normalised as in index.json, so that e.g. tuples compare equal to the lists they are read back as
+        config = json.loads(json.dumps(dict(config, image_dtype=self.image_dtype), sort_keys=True, default=str))
+        stored_config = self.index.get('config')
+        if len(self) > 0 and stored_config != config:
+            stored_config = stored_config or {}
+            differing = sorted(k for k in set(config) | set(stored_config) if stored_config.get(k) != config.get(k))
+            raise RuntimeError(f'Cannot resume {self.path}: its results were written with another config '
+                               f'(differing: {", ".join(differing)}). Run without resume to start over')
+        self.index['config'] = config
+
+    def _atomic_write(self, filename, write):
+        final_path = os.path.join(self.path, filename)
+        tmp_path = final_path + '.tmp'
+        write(tmp_path)
+        # The data must be on disk before the rename makes it visible, or a crash could leave an empty file behind
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, final_path)
+
+    def _write_index(self, tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+
+    def __contains__(self, key):
+        return str(key) in self.index['shards']
+
+    def __len__(self):
+        return len(self.index['shards'])
+
+    def append(self, key, diary, distance=None):
+        """
+        :param key: unique key of the result, e.g. the index of the image in the run
+        :param distance: final distance of the attack (None if no iteration was run)
+        """
+        key = str(key)
+        if key in self:
+            raise RuntimeError(f'Result {key} is already in the store')
+        filename = 'shard_{}.pkl'.format(key.replace(':', '_'))
+        tracker = RunTracker.from_diaries([diary], image_dtype=self.image_dtype)
+        self._atomic_write(filename, tracker.save)
+        last_calls = diary.iterations[-1].calls.end if len(diary.iterations) > 0 else None
+        self.index['shards'][key] = {'file': filename, 'order': len(self.index['shards']),
+                                     'distance': None if distance is None else float(distance),
+                                     'model_calls': last_calls, 'stop_reason': diary.stop_reason,
+                                     'iterations': len(diary.iterations)}
+        self._atomic_write(self.INDEX, self._write_index)
+
+    def export_shard(self, key):
+        """ :return: (bytes of the shard file, index entry) of a result, e.g. to send it to another store """
+        entry = self.index['shards'][str(key)]
+        with open(os.path.join(self.path, entry['file']), 'rb') as f:
+            return f.read(), dict(entry)
+
+    def import_shard(self, key, data, entry):
+        """ Adds a result exported by another store under a (possibly different) key """
+        key = str(key)
+        if key in self:
+            raise RuntimeError(f'Result {key} is already in the store')
+        filename = 'shard_{}.pkl'.format(key.replace(':', '_'))
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        self._atomic_write(filename, write)
+        self.index['shards'][key] = dict(entry, file=filename, order=len(self.index['shards']))
+        self._atomic_write(self.INDEX, self._write_index)
+
+    def keys(self):
+        """ Keys in image order ('<image>' or '<image>:<target>'), other keys in the order they were written """
+        def sort_key(key):
+            parts = key.split(':')
+            if all(p.isdigit() for p in parts):
+                return 0, tuple(int(p) for p in parts), 0
+            return 1, (), self.index['shards'][key]['order']
+        return sorted(self.index['shards'], key=sort_key)
+
+    def distances(self):
+        return [shard['distance'] for shard in self.index['shards'].values() if shard['distance'] is not None]
+
+    def _shard_path(self, key):
+        return os.path.join(self.path, self.index['shards'][key]['file'])
+
+    def _num_iterations(self, key):
+        """ Iterations of a shard, from the index or from the shard itself for stores written without them """
+        num_iterations = self.index['shards'][key].get('iterations')
+        if num_iterations is None:
+            num_iterations = int(load_tracker(self._shard_path(key)).num_iterations[0])
+        return num_iterations
+
+    def diaries(self, map_location='cpu'):
+        return [load_diaries(self._shard_path(key), map_location)[0] for key in self.keys()]
+
+    def consolidate(self, out_path):
+        """
+        Writes all the shards as a single columnar raw_data.pkl for the downstream tooling.
+        The shards are added one by one to a preallocated RunTracker, so only one Diary is held in memory at a time.
+        """
+        keys = self.keys()
+        max_iterations = max([self._num_iterations(key) for key in keys] + [1])
+        tracker = None
+        for key in keys:
+            diary = load_diaries(self._shard_path(key))[0]
+            if tracker is None:
+                image_shape = tuple(torch.as_tensor(diary.original).shape)
+                tracker = RunTracker(len(keys), max_iterations, image_shape, self.image_dtype)
+            tracker.add_diary(diary)
+        if tracker is None:
+            tracker = RunTracker.from_diaries([], image_dtype=self.image_dtype)
+        tracker.save(out_path)
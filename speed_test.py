@@ -1,3 +1,4 @@
+# Quick check of batched against one-by-one inference, see benchmark.py for the full benchmark suite
 import time
 import torch
 from tqdm import tqdm
@@ -8,7 +9,7 @@ from img_utils import get_samples, get_device
 device = torch.device(sys.argv[1])
 N = 10000
 B = 100
-model = get_model(key='mnist_noman', dataset='mnist', noise='determinisitc', device=device)
+model = get_model(key='mnist_noman', dataset='mnist', noise='deterministic', device=device)
 model.model = model.model.to(device)
 images = get_samples(N)[0]
 start = time.time()
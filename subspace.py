@@ -0,0 +1,121 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class SubspaceSampler:
+    """
+        Draws random directions in a k-dimensional subspace of the input space and maps them back to pixel space.
+        Images are expected in the layout used throughout the repo: (h, w) for mnist and (h, w, c) for cifar10.
+        self.dim is the effective dimension k, which replaces d in the infomax query budgeting.
+    """
+    def __init__(self, shape, device=None):
+        self.shape = tuple(shape)
+        self.device = device
+        self.h, self.w = self.shape[0], self.shape[1]
+        self.c = self.shape[2] if len(self.shape) == 3 else 1
+        self.coeff_shape = None
+        self.dim = None
+
+    def sample_coefficients(self, batch_size, constraint, generator=None):
+        noise_shape = [int(batch_size)] + list(self.coeff_shape)
+        if constraint == "l2":
+            return torch.randn(size=noise_shape, generator=generator, device=self.device)
+        elif constraint == "linf":
+            return 2 * torch.rand(size=noise_shape, generator=generator, device=self.device) - 1
+        else:
+            raise RuntimeError("Unknown constraint metric: {}".format(constraint))
+
+    def to_pixels(self, coeffs):
+        """
+        :param coeffs: tensor of shape [batch] + coeff_shape
+        :return: tensor of shape [batch] + shape
+        """
+        raise NotImplementedError
+
+    def sample(self, batch_size, constraint, generator=None):
+        return self.to_pixels(self.sample_coefficients(batch_size, constraint, generator))
+
+
+def dct_matrix(n, k, device=None):
+    """ First k rows of the orthonormal DCT-II matrix of size n x n """
+    freqs = torch.arange(k, dtype=torch.float32, device=device).view(-1, 1)
+    positions = torch.arange(n, dtype=torch.float32, device=device).view(1, -1)
+    mat = torch.cos(math.pi * (2 * positions + 1) * freqs / (2 * n)) * math.sqrt(2. / n)
+    mat[0] = mat[0] / math.sqrt(2.)
+    return mat
+
+
+class DCTSampler(SubspaceSampler):
+    """
+        Samples the lowest kh x kw frequencies of the 2D DCT of every channel.
+        The inverse DCT is an isometry, so isotropic coefficients give isotropic directions inside the subspace.
+    """
+    def __init__(self, shape, ratio, device=None):
+        super().__init__(shape, device)
+        self.kh = max(1, int(round(self.h * ratio)))
+        self.kw = max(1, int(round(self.w * ratio)))
+        self.dct_h = dct_matrix(self.h, self.kh, device)
+        self.dct_w = dct_matrix(self.w, self.kw, device)
+        self.coeff_shape = (self.kh, self.kw, self.c)
+        self.dim = self.kh * self.kw * self.c
+
+    def to_pixels(self, coeffs):
+        out = torch.einsum('ph,bpqc,qw->bhwc', self.dct_h, coeffs, self.dct_w)
+        return out.reshape([len(coeffs)] + list(self.shape))
+
+
+class ResizeSampler(SubspaceSampler):
+    """
+        Samples noise on a downsampled (kh x kw) grid and upsamples it bilinearly to the input resolution.
+    """
+    def __init__(self, shape, ratio, device=None):
+        super().__init__(shape, device)
+        self.kh = max(1, int(round(self.h * ratio)))
+        self.kw = max(1, int(round(self.w * ratio)))
+        self.coeff_shape = (self.c, self.kh, self.kw)
+        self.dim = self.kh * self.kw * self.c
+
+    def to_pixels(self, coeffs):
+        out = F.interpolate(coeffs, size=(self.h, self.w), mode='bilinear', align_corners=False)
+        return out.permute(0, 2, 3, 1).reshape([len(coeffs)] + list(self.shape))
+
+
+class BasisSampler(SubspaceSampler):
+    """
+        Samples in the span of a user-supplied basis of shape [k, d] with orthonormal rows.
+    """
+    def __init__(self, shape, basis, device=None):
+        super().__init__(shape, device)
+        basis = basis.type(torch.float32).to(device)
+        d = int(torch.prod(torch.tensor(self.shape)))
+        if basis.ndim != 2 or basis.shape[1] != d:
+            raise RuntimeError(f'Basis of shape {tuple(basis.shape)} does not match input dimension {d}')
+        gram = basis @ basis.T
+        if not torch.allclose(gram, torch.eye(len(basis), device=device), atol=1e-3):
+            raise RuntimeError('Rows of the sampling basis are not orthonormal')
+        self.basis = basis
+        self.coeff_shape = (len(basis),)
+        self.dim = len(basis)
+
+    def to_pixels(self, coeffs):
+        return (coeffs @ self.basis).view([len(coeffs)] + list(self.shape))
+
+
+def get_sampler(name, shape, ratio=0.25, basis_path=None, device=None):
+    """
+    :param name: one of 'full', 'dct', 'resize', 'custom'
+    :return: a SubspaceSampler, or None when sampling in the full pixel space
+    """
+    if name == 'full':
+        return None
+    elif name == 'dct':
+        return DCTSampler(shape, ratio, device)
+    elif name == 'resize':
+        return ResizeSampler(shape, ratio, device)
+    elif name == 'custom':
+        if basis_path is None:
+            raise RuntimeError("A basis_path is required for the 'custom' sampling basis")
+        return BasisSampler(shape, torch.load(basis_path, map_location='cpu'), device)
+    else:
+        raise RuntimeError(f'Unknown sampling basis: {name}')
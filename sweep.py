@@ -0,0 +1,240 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+OUT_DIR = 'thesis'
+CONFIG_FILE = 'config.json'
+# Parameters encoded in the experiment name, in the order crunch_experiments.py and the plotting scripts expect
+NAME_FIELDS = (('hsja_repeat_queries', 'r'), ('smoothing_noise', 'sn'), ('crop_size', 'cs'), ('drop_rate', 'dr'),
+               ('distance', 'dm'), ('beta', 'b'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("grid", type=str,
+                    help="JSON file with the sweep: {\"tag\": optional name tag, \"fixed\": {param: value}, "
+                    "\"grid\": {param: [values]}} (params named like the destinations of app.py arguments)")
+parser.add_argument("-w", "--workers", type=int, default=1, help="Number of runs executed in parallel")
+parser.add_argument("-cpr", "--cores_per_run", type=int, default=None,
+                    help="(Optional) Cores pinned to every run, all available cores are shared out by default")
+parser.add_argument("--no_crunch", action='store_true', help="(Optional) Do not crunch the runs once they are done")
+parser.add_argument("--dry_run", action='store_true', help="(Optional) Only print the runs of the sweep")
+
+
+def app_parser():
+    # app.py loads torch and the models, so it is only imported when the sweep is expanded
+    import app
+    return app.parser
+
+
+def expand_grid(spec):
+    """
+    :param spec: dict with 'fixed' (app.py parameters shared by all runs) and 'grid' (parameter -> list of values)
+    :return: list of configs (dicts of app.py parameters, by destination name) in the order of the grid
+    """
+    fixed = spec.get('fixed', {})
+    grid = spec.get('grid', {})
+    names = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        config = dict(fixed)
+        config.update(zip(names, values))
+        configs.append(config)
+    return configs
+
+
+def complete_config(config, parser):
+    """ Adds the defaults of app.py to a config and checks that every parameter exists """
+    dests = {action.dest: action for action in parser._actions}
+    for name in config:
+        if name not in dests or name == 'help':
+            raise RuntimeError(f'Unknown app.py parameter in sweep: {name}')
+    full = {action.dest: action.default for action in parser._actions if action.dest != 'help'}
+    full.update(config)
+    return full
+
+
+def short_option(parser, dest):
+    for action in parser._actions:
+        if action.dest == dest:
+            return min(action.option_strings, key=len).lstrip('-')
+    raise RuntimeError(f'Unknown app.py parameter: {dest}')
+
+
+def experiment_name(config, varying, parser, tag=None):
+    """
+    Legacy name '<dataset>_<attack>[_<tag>][_<opt>_<value>...]_r_.._sn_.._cs_.._dr_.._dm_.._b_.._<noise>_fp_.._ns_..'.
+    Parameters that vary in the sweep but are not part of the fixed layout are inserted after the attack, by short
+    option (e.g. mnist_psj_pf_0_q_5_r_1_...).
+    """
+    layout = {'dataset', 'attack', 'noise', 'flip_prob', 'num_samples', 'exp_name'} | {f for f, _ in NAME_FIELDS}
+    parts = [str(config['dataset']), str(config['attack'])]
+    if tag:
+        parts.append(tag)
+    for name in varying:
+        if name not in layout:
+            parts += [short_option(parser, name), str(config[name])]
+    for name, short in NAME_FIELDS:
+        parts += [short, str(config[name])]
+    parts += [str(config['noise']), 'fp', str(config['flip_prob']), 'ns', str(config['num_samples'])]
+    return '_'.join(parts)
+
+
+def config_to_argv(config, parser):
+    """ app.py command line of a complete config """
+    argv = []
+    for action in parser._actions:
+        if action.dest not in config or action.dest == 'help' or not action.option_strings:
+            continue
+        value = config[action.dest]
+        if action.nargs == 0:
+            # Flags (store_true / store_false) are only passed when they set their constant
+            if value == action.const and value != action.default:
+                argv.append(action.option_strings[-1])
+        elif value is not None and value != action.default:
+            argv += [action.option_strings[-1], str(value)]
+    return argv
+
+
+def read_metadata(exp_name, out_dir=OUT_DIR):
+    path = os.path.join(out_dir, exp_name, CONFIG_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_metadata(exp_name, metadata, out_dir=OUT_DIR):
+    os.makedirs(os.path.join(out_dir, exp_name), exist_ok=True)
+    path = os.path.join(out_dir, exp_name, CONFIG_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def is_done(exp_name, config, crunch=True, out_dir=OUT_DIR):
+    """ A run is done when it finished with the same config (and was crunched, if crunching is asked for) """
+    metadata = read_metadata(exp_name, out_dir)
+    if metadata is None or metadata.get('config') != config or metadata.get('status') != 'done':
+        return False
+    return not crunch or metadata.get('crunched', False)
+
+
+def plan_sweep(spec, parser, crunch=True, out_dir=OUT_DIR):
+    """ :return: list of (exp_name, config, done) of the sweep """
+    varying = [name for name, values in spec.get('grid', {}).items() if len(values) > 1]
+    runs = []
+    for config in expand_grid(spec):
+        config = complete_config(config, parser)
+        exp_name = config['exp_name'] if config.get('exp_name') else experiment_name(config, varying, parser,
+                                                                                     spec.get('tag'))
+        config['exp_name'] = exp_name
+        runs.append((exp_name, config, is_done(exp_name, config, crunch, out_dir)))
+    return runs
+
+
+def core_slots(workers, cores_per_run=None):
+    """ Disjoint sets of cores, one per worker """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if cores_per_run is None:
+        cores_per_run = max(1, len(cores) // workers)
+    slots = []
+    for w in range(workers):
+        slot = cores[w * cores_per_run:(w + 1) * cores_per_run]
+        # More workers than cores: slots wrap around and share cores
+        slots.append(slot if len(slot) > 0 else [cores[w % len(cores)]])
+    return slots
+
+
+def run_pinned(command, cores, log_path):
+    """ Runs a command with its threads pinned to cores, appending its output to log_path """
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+    preexec = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+    with open(log_path, 'a') as log:
+        log.write('$ {}\n'.format(' '.join(command)))
+        log.flush()
+        return subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec)
+
+
+def run_config(exp_name, config, parser, cores, crunch=True, out_dir=OUT_DIR):
+    """ Runs app.py (and crunch_experiments.py) for one config and keeps its metadata up to date """
+    previous = read_metadata(exp_name, out_dir)
+    metadata = {'exp_name': exp_name, 'config': config, 'status': 'running', 'crunched': False,
+                'host': socket.gethostname(), 'cores': cores, 'git_commit': git_commit(), 'started': time.time()}
+    # A failed run of the same config continues from its result shards and checkpoints
+    resume = previous is not None and previous.get('config') == config and previous.get('status') != 'done'
+    argv = config_to_argv(config, parser) + (['--resume'] if resume else [])
+    metadata['argv'] = argv
+    write_metadata(exp_name, metadata, out_dir)
+    log_path = os.path.join(out_dir, exp_name, 'log.txt')
+    if previous is None or previous.get('status') != 'done' or previous.get('config') != config:
+        code = run_pinned([sys.executable, 'app.py'] + argv, cores, log_path)
+        metadata['return_code'] = code
+        metadata['status'] = 'done' if code == 0 else 'failed'
+    else:
+        metadata['status'] = 'done'
+    metadata['finished'] = time.time()
+    write_metadata(exp_name, metadata, out_dir)
+    if metadata['status'] == 'done' and crunch:
+        code = run_pinned([sys.executable, 'crunch_experiments.py', exp_name, config['dataset']], cores, log_path)
+        metadata['crunched'] = code == 0
+        write_metadata(exp_name, metadata, out_dir)
+    return metadata
+
+
+def run_sweep(spec, workers=1, cores_per_run=None, crunch=True, out_dir=OUT_DIR):
+    """
+    Runs every config of the sweep that is not done yet on a pool of `workers` slots, each pinned to its own cores
+    :return: list of the metadata of the runs executed
+    """
+    parser = app_parser()
+    runs = [(exp_name, config) for exp_name, config, done in plan_sweep(spec, parser, crunch, out_dir) if not done]
+    slots = core_slots(workers, cores_per_run)
+    free_slots = list(range(len(slots)))
+    lock = threading.Lock()
+
+    def execute(exp_name, config):
+        with lock:
+            slot = free_slots.pop()
+        try:
+            logging.warning('Running {} on cores {}'.format(exp_name, slots[slot]))
+            metadata = run_config(exp_name, config, parser, slots[slot], crunch, out_dir)
+            logging.warning('{}: {}'.format(exp_name, metadata['status']))
+            return metadata
+        finally:
+            with lock:
+                free_slots.append(slot)
+
+    with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+        futures = [pool.submit(execute, exp_name, config) for exp_name, config in runs]
+        return [future.result() for future in futures]
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.grid, 'r') as f:
+        spec = json.load(f)
+    if args.dry_run:
+        for exp_name, config, done in plan_sweep(spec, app_parser(), not args.no_crunch):
+            print('{} {}'.format('done' if done else 'todo', exp_name))
+        return
+    results = run_sweep(spec, args.workers, args.cores_per_run, not args.no_crunch)
+    failed = [m['exp_name'] for m in results if m['status'] != 'done']
+    logging.warning('{} runs, {} failed {}'.format(len(results), len(failed), failed if failed else ''))
+
+
+if __name__ == '__main__':
+    main()
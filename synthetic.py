@@ -0,0 +1,97 @@
+import math
+import torch
+from infomax import get_py_txse
+from model_factory import Model
+
+
+class SyntheticBoundary(torch.nn.Module):
+    """
+        Analytic binary classifier on [0, 1]^d around an original point x0 = (0.5, ..., 0.5).
+        The signed distance-like score of a point x, with u = x - x0 and a = <w, u> for a random unit normal w, is
+            linear: f(x) = a - r
+            curved: f(x) = a - r - curvature / 2 * |u - a w|^2
+        Points with f > 0 are adversarial (class 1), x0 is of class 0. The curved boundary is a paraboloid whose vertex
+        x0 + r w is the closest adversarial point for curvature >= 0 (it bends away from x0), so in both cases the
+        optimal l2 perturbation has norm r.
+    """
+    def __init__(self, d, radius=0.05, boundary='linear', curvature=1., seed=0):
+        super().__init__()
+        if boundary not in ('linear', 'curved'):
+            raise RuntimeError(f'Unknown synthetic boundary: {boundary}')
+        generator = torch.Generator().manual_seed(seed)
+        w = torch.randn(d, generator=generator)
+        self.register_buffer('w', w / torch.norm(w))
+        self.register_buffer('x0', torch.full((d,), 0.5))
+        # radius is relative to sqrt(d) so that x0 + 2 r w stays (mostly) inside the bounds whatever d
+        self.r = radius * math.sqrt(d)
+        self.boundary = boundary
+        self.curvature = curvature if boundary == 'curved' else 0.
+
+    def forward(self, images):
+        u = images.flatten(1).to(self.w.dtype) - self.x0
+        a = u @ self.w
+        f = a - self.r
+        if self.curvature != 0.:
+            f = f - self.curvature / 2 * (torch.sum(u * u, dim=1) - a * a)
+        return f
+
+    def optimal_distance(self, constraint='l2'):
+        """ Norm of the smallest adversarial perturbation of x0 (linf only for the linear boundary) """
+        if constraint == 'l2':
+            return self.r
+        if self.boundary != 'linear':
+            raise RuntimeError('The optimal linf distance is only known for the linear boundary')
+        return self.r / float(torch.sum(torch.abs(self.w)))
+
+
+class SyntheticModel(Model):
+    """
+        Model backed by a SyntheticBoundary, usable by ModelInterface like the CNN models, with 2 classes.
+        Its class probabilities follow the sigmoid family of infomax.get_py_txse along the boundary normal:
+            P(class 1 | x) = eps + (1 - 2 eps) * sigmoid(s * f(x))
+        so s is the inverse scale of the noise (per unit of l2 distance, s=inf is noiseless) and eps its level far from
+        the boundary. ModelInterface samples these probabilities with noise='bayesian', and takes their argmax (the
+        noiseless classifier) with noise='deterministic'.
+    """
+    def __init__(self, boundary: SyntheticBoundary, s=float('inf'), eps=0., noise='bayesian', device=None):
+        super().__init__(boundary, noise=noise, n_classes=2, device=device)
+        self.s = s
+        self.eps = eps
+
+    def predict(self, images):
+        """ Boundary score f of every image (no logits: use get_probs) """
+        return self.model(images)
+
+    def get_probs(self, images):
+        if type(images) != torch.Tensor:
+            images = torch.tensor(images, dtype=torch.float32)
+        f = self.predict(images)
+        p = get_py_txse(1, torch.zeros((), device=f.device), f, torch.tensor(self.s, device=f.device), self.eps)
+        return torch.stack([1 - p, p], dim=1)
+
+    def ask_model(self, images):
+        probs = self.get_probs(images)
+        if self.noise == 'bayesian':
+            return torch.bernoulli(probs[:, 1]).long()
+        return probs.argmax(dim=1)
+
+    def ask_model_repeated(self, images, samples):
+        probs = self.get_probs(images)
+        if self.noise == 'bayesian':
+            return torch.bernoulli(probs[:, 1:].repeat(1, samples)).long()
+        return probs.argmax(dim=1)[:, None].repeat(1, samples)
+
+
+def make_problem(d, boundary='linear', s=float('inf'), eps=0., radius=0.05, curvature=1., noise='bayesian', seed=0,
+                 device=None):
+    """
+    :return: (model, original image, label, starting point): the original is x0 (class 0) and the starting point
+             x0 + 2 r w (clipped to the bounds) lies on the adversarial side. Images have shape (d,).
+    """
+    boundary = SyntheticBoundary(d, radius, boundary, curvature, seed).to(device)
+    model = SyntheticModel(boundary, s, eps, noise, device)
+    original = boundary.x0.clone()
+    start = torch.clamp(original + 2 * boundary.r * boundary.w, 0, 1)
+    if float(boundary(start[None])[0]) <= 0:
+        raise RuntimeError('Starting point is not adversarial, use a smaller radius')
+    return model, original, 0, start
@@ -0,0 +1,40 @@
+import torch
+from tracker import Diary, DiaryPage, load_diaries, load_tracker, convert_raw_data
+
+
+def old_diary(num_iterations=3):
+    """ Diary as pickled before the columnar tracker: none of the attributes added since (stop_reason, budget...) """
+    diary = Diary.__new__(Diary)
+    diary.__dict__.update({'true_label': 3, 'original': torch.rand(28, 28), 'targeted_label': None,
+                           'initial_image': torch.rand(28, 28), 'initial_projection': torch.rand(28, 28),
+                           'calls_initialization': 10, 'calls_initial_bin_search': 30, 'epoch_start': 0.,
+                           'epoch_initialization': 1., 'epoch_initial_bin_search': 2., 'iterations': []})
+    for t in range(num_iterations):
+        page = DiaryPage()
+        delattr(page, 'profile')
+        page.distance = 1. / (t + 1)
+        page.bin_search = torch.rand(28, 28)
+        page.calls.bin_search = 100 * (t + 1)
+        diary.iterations.append(page)
+    return diary
+
+
+def test_load_old_pickle(tmp_path):
+    path = str(tmp_path / 'raw_data.pkl')
+    diaries = [old_diary(), old_diary(2)]
+    torch.save(diaries, open(path, 'wb'))
+
+    tracker = load_tracker(path)
+    assert tracker.size == 2
+    assert tracker.extras[0] == {'stop_reason': None, 'budget': None}
+    diary = tracker.diary(1)
+    assert len(diary.iterations) == 2
+    assert diary.stop_reason is None and diary.shared_calls == 0
+    assert diary.iterations[1].calls.bin_search == 200
+    assert torch.equal(diary.iterations[0].bin_search, diaries[1].iterations[0].bin_search)
+
+    out_path = str(tmp_path / 'raw_data_columnar.pkl')
+    convert_raw_data(path, out_path)
+    converted = load_diaries(out_path)
+    assert [len(d.iterations) for d in converted] == [3, 2]
+    assert converted[0].true_label == 3
@@ -1,3 +1,7 @@
+import math
+import torch
+
+
 class Diary(object):
     def __init__(self, image, label, targeted_label):
         self.true_label = label
@@ -15,6 +19,10 @@ class Diary(object):
         self.epoch_initial_bin_search = None
 
         self.iterations = list()
+        self.stop_reason = None  # 'iterations', 'target_distance', 'query_budget' or 'plateau'
+        self.budget = None  # QueryBudget.report(): model calls spent per attack phase
+        self.shared_calls = 0  # model calls shared with the other targets of the image (MultiTargetAttack)
+        self.profile = None  # Profiler.collect() of initialization and initial binary search, when profiling
 
 
 class DiaryPage(object):
@@ -30,6 +38,7 @@ class DiaryPage(object):
         self.time: Time = Time()
         self.grad_estimate = None
         self.grad_true = None
+        self.profile = None  # Profiler.collect() of the iteration, when profiling
 
 
 class InfoMaxStats(object):
@@ -59,3 +68,260 @@ class Calls(object):
         self.approx_grad = None
         self.step_search = None
         self.bin_search = None
+
+
+IMAGE_DTYPES = ('float32', 'float16', 'uint8')
+DIARY_SCALARS = ('true_label', 'targeted_label', 'initialization_calls', 'calls_initialization',
+                 'calls_initial_bin_search', 'epoch_start', 'epoch_initialization', 'epoch_initial_bin_search',
+                 'shared_calls')
+DIARY_IMAGES = ('original', 'initial_image', 'initial_projection')
+PAGE_SCALARS = ('distance', 'num_eval_det', 'num_eval_prob')
+PAGE_CALLS = ('start', 'initial_projection', 'approx_grad', 'step_search', 'opposite', 'bin_search', 'end')
+PAGE_TIMES = ('start', 'num_evals', 'approx_grad', 'step_search', 'opposite', 'bin_search', 'end')
+PAGE_INFOMAX = ('s', 'tmap', 'e', 'n')
+PAGE_IMAGES = ('approx_grad', 'opposite', 'bin_search', 'perturbed', 'grad_estimate', 'grad_true')
+PROFILE_PREFIXES = ('profile.', 'init_profile.')
+INT_FIELDS = ('true_label', 'targeted_label', 'initialization_calls', 'calls_initialization',
+              'calls_initial_bin_search', 'shared_calls', 'num_eval_det', 'num_eval_prob',
+              'calls.start', 'calls.initial_projection', 'calls.approx_grad', 'calls.step_search', 'calls.opposite',
+              'calls.bin_search', 'calls.end', 'infomax.n', 'init_infomax.n')
+
+
+class ImageColumn(object):
+    """
+        Images of one field for the whole run, in a single preallocated array of shape [*index_shape, *image_shape].
+        uint8 storage quantizes every image affinely between its own min and max.
+    """
+    def __init__(self, index_shape, image_shape, dtype='float32'):
+        if dtype not in IMAGE_DTYPES:
+            raise RuntimeError(f'Unknown image dtype: {dtype}')
+        self.dtype = dtype
+        self.present = torch.zeros(index_shape, dtype=torch.bool)
+        self.values = torch.zeros(list(index_shape) + list(image_shape), dtype=getattr(torch, dtype))
+        if dtype == 'uint8':
+            self.low = torch.zeros(index_shape)
+            self.high = torch.zeros(index_shape)
+
+    def set(self, index, image):
+        image = torch.as_tensor(image).detach().float().cpu()
+        if self.dtype == 'uint8':
+            low, high = image.min(), image.max()
+            scale = (high - low) if high > low else 1.
+            self.values[index] = torch.round((image - low) / scale * 255).to(torch.uint8)
+            self.low[index], self.high[index] = low, high
+        else:
+            self.values[index] = image
+        self.present[index] = True
+
+    def get(self, index):
+        if not self.present[index]:
+            return None
+        image = self.values[index].float()
+        if self.dtype == 'uint8':
+            low, high = self.low[index], self.high[index]
+            image = image / 255 * ((high - low) if high > low else 1.) + low
+        return image
+
+    def state_dict(self):
+        state = {'dtype': self.dtype, 'present': self.present, 'values': self.values}
+        if self.dtype == 'uint8':
+            state.update(low=self.low, high=self.high)
+        return state
+
+    @classmethod
+    def from_state_dict(cls, state):
+        column = cls.__new__(cls)
+        column.__dict__.update(state)
+        return column
+
+
+class RunTracker(object):
+    """
+        Struct-of-arrays version of a list of Diaries (one per attacked image).
+        Scalars are stored in preallocated float64 arrays of shape [num_images] or [num_images, max_iterations]
+        (NaN when missing), images in ImageColumns of the chosen dtype ('float32', 'float16' or 'uint8').
+        Only the image fields listed in image_fields are kept. InfoMax sample points are not kept.
+        Profiler values get their columns when first seen: 'profile.<phase>.<metric>' per page and
+        'init_profile.<phase>.<metric>' per diary.
+        diary(i) rebuilds the i-th Diary so that existing tooling keeps working.
+    """
+    def __init__(self, num_images, max_iterations, image_shape, image_dtype='float32',
+                 image_fields=DIARY_IMAGES + PAGE_IMAGES):
+        self.num_images = num_images
+        self.max_iterations = max_iterations
+        self.image_shape = tuple(image_shape)
+        self.image_dtype = image_dtype
+        self.image_fields = tuple(image_fields)
+        self.size = 0
+        self.num_iterations = torch.zeros(num_images, dtype=torch.long)
+        diary_scalars = list(DIARY_SCALARS) + ['init_infomax.' + i for i in PAGE_INFOMAX]
+        self.scalars = {name: torch.full((num_images,), float('nan'), dtype=torch.float64) for name in diary_scalars}
+        page_scalars = list(PAGE_SCALARS) + ['calls.' + c for c in PAGE_CALLS] + ['time.' + t for t in PAGE_TIMES] \
+            + ['infomax.' + i for i in PAGE_INFOMAX]
+        for name in page_scalars:
+            self.scalars[name] = torch.full((num_images, max_iterations), float('nan'), dtype=torch.float64)
+        self.images = {}  # field -> ImageColumn, allocated when the field is first seen
+        self.extras = [None] * num_images  # per image: stop_reason, budget
+
+    def _image_column(self, name, per_page):
+        if name not in self.images:
+            index_shape = (self.num_images, self.max_iterations) if per_page else (self.num_images,)
+            self.images[name] = ImageColumn(index_shape, self.image_shape, self.image_dtype)
+        return self.images[name]
+
+    def _scalar_column(self, name, per_page):
+        if name not in self.scalars:
+            shape = (self.num_images, self.max_iterations) if per_page else (self.num_images,)
+            self.scalars[name] = torch.full(shape, float('nan'), dtype=torch.float64)
+        return self.scalars[name]
+
+    @staticmethod
+    def _scalar(value):
+        return float('nan') if value is None else float(value)
+
+    def add_diary(self, diary: Diary):
+        """ :return: index of the diary in the run """
+        i = self.size
+        if i >= self.num_images:
+            raise RuntimeError(f'RunTracker is full ({self.num_images} images)')
+        if len(diary.iterations) > self.max_iterations:
+            raise RuntimeError(f'Diary has {len(diary.iterations)} iterations, max is {self.max_iterations}')
+        for name in DIARY_SCALARS:
+            self.scalars[name][i] = self._scalar(getattr(diary, name, None))
+        init_infomax = getattr(diary, 'init_infomax', None)
+        if init_infomax is not None:
+            # Estimates may be views of the whole infomax grid, so only their values are kept
+            for name in PAGE_INFOMAX:
+                self.scalars['init_infomax.' + name][i] = self._scalar(getattr(init_infomax, name))
+        if getattr(diary, 'profile', None) is not None:
+            for name, value in diary.profile.items():
+                self._scalar_column('init_profile.' + name, per_page=False)[i] = float(value)
+        for name in DIARY_IMAGES:
+            if name in self.image_fields and getattr(diary, name, None) is not None:
+                self._image_column(name, per_page=False).set(i, getattr(diary, name))
+        for t, page in enumerate(diary.iterations):
+            for name in PAGE_SCALARS:
+                self.scalars[name][i, t] = self._scalar(getattr(page, name, None))
+            for name in PAGE_CALLS:
+                self.scalars['calls.' + name][i, t] = self._scalar(getattr(page.calls, name, None))
+            for name in PAGE_TIMES:
+                self.scalars['time.' + name][i, t] = self._scalar(getattr(page.time, name, None))
+            if page.info_max_stats is not None:
+                for name in PAGE_INFOMAX:
+                    self.scalars['infomax.' + name][i, t] = self._scalar(getattr(page.info_max_stats, name))
+            if getattr(page, 'profile', None) is not None:
+                for name, value in page.profile.items():
+                    self._scalar_column('profile.' + name, per_page=True)[i, t] = float(value)
+            for name in PAGE_IMAGES:
+                if name in self.image_fields and getattr(page, name, None) is not None:
+                    self._image_column(name, per_page=True).set((i, t), getattr(page, name))
+        self.num_iterations[i] = len(diary.iterations)
+        # Diaries pickled before early stopping and query budgets have neither attribute
+        self.extras[i] = {'stop_reason': getattr(diary, 'stop_reason', None), 'budget': getattr(diary, 'budget', None)}
+        self.size += 1
+        return i
+
+    def _value(self, name, index):
+        value = float(self.scalars[name][index])
+        if math.isnan(value):
+            return None
+        return int(value) if name in INT_FIELDS else value
+
+    def _infomax_stats(self, prefix, index):
+        if self._value(prefix + 's', index) is None:
+            return None
+        s, tmap, e, n = [self._value(prefix + name, index) for name in PAGE_INFOMAX]
+        return InfoMaxStats(s, tmap, None, e, n)
+
+    def _profile(self, prefix, index):
+        profile = {name[len(prefix):]: self._value(name, index) for name in self.scalars if name.startswith(prefix)}
+        profile = {name: value for name, value in profile.items() if value is not None}
+        return profile if len(profile) > 0 else None
+
+    def diary(self, i):
+        diary = Diary(None, None, None)
+        for name in DIARY_SCALARS:
+            setattr(diary, name, self._value(name, i))
+        for name in DIARY_IMAGES:
+            setattr(diary, name, self.images[name].get(i) if name in self.images else None)
+        for t in range(int(self.num_iterations[i])):
+            page = DiaryPage()
+            for name in PAGE_SCALARS:
+                setattr(page, name, self._value(name, (i, t)))
+            for name in PAGE_CALLS:
+                setattr(page.calls, name, self._value('calls.' + name, (i, t)))
+            for name in PAGE_TIMES:
+                setattr(page.time, name, self._value('time.' + name, (i, t)))
+            page.info_max_stats = self._infomax_stats('infomax.', (i, t))
+            page.profile = self._profile('profile.', (i, t))
+            for name in PAGE_IMAGES:
+                setattr(page, name, self.images[name].get((i, t)) if name in self.images else None)
+            diary.iterations.append(page)
+        diary.shared_calls = diary.shared_calls or 0
+        diary.stop_reason = self.extras[i]['stop_reason']
+        diary.budget = self.extras[i]['budget']
+        diary.profile = self._profile('init_profile.', i)
+        init_infomax = self._infomax_stats('init_infomax.', i)
+        if init_infomax is not None:
+            diary.init_infomax = init_infomax
+        return diary
+
+    def diaries(self):
+        return [self.diary(i) for i in range(self.size)]
+
+    def column(self, name):
+        """ Scalar column of the stored images, e.g. 'distance' or 'calls.bin_search' (NaN where missing) """
+        return self.scalars[name][:self.size]
+
+    def state_dict(self):
+        return {'format': 'columnar', 'version': 1, 'num_images': self.num_images,
+                'max_iterations': self.max_iterations, 'image_shape': self.image_shape,
+                'image_dtype': self.image_dtype, 'image_fields': self.image_fields, 'size': self.size,
+                'num_iterations': self.num_iterations, 'scalars': self.scalars,
+                'images': {name: column.state_dict() for name, column in self.images.items()},
+                'extras': self.extras}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        tracker = cls(0, 0, state['image_shape'], state['image_dtype'], state['image_fields'])
+        for name in ('num_images', 'max_iterations', 'size', 'num_iterations', 'scalars', 'extras'):
+            setattr(tracker, name, state[name])
+        tracker.images = {name: ImageColumn.from_state_dict(column) for name, column in state['images'].items()}
+        return tracker
+
+    def save(self, path):
+        torch.save(self.state_dict(), open(path, 'wb'))
+
+    @classmethod
+    def from_diaries(cls, diaries, image_dtype='float32', image_fields=DIARY_IMAGES + PAGE_IMAGES):
+        max_iterations = max([len(diary.iterations) for diary in diaries] + [1])
+        image_shape = tuple(torch.as_tensor(diaries[0].original).shape) if len(diaries) > 0 else ()
+        tracker = cls(len(diaries), max_iterations, image_shape, image_dtype, image_fields)
+        for diary in diaries:
+            tracker.add_diary(diary)
+        return tracker
+
+
+def is_columnar(raw):
+    return isinstance(raw, dict) and raw.get('format') == 'columnar'
+
+
+def load_tracker(path, map_location='cpu'):
+    """ Loads raw_data.pkl as a RunTracker, converting old pickles (list of Diaries) on the fly """
+    raw = torch.load(open(path, 'rb'), map_location=map_location, weights_only=False)
+    if is_columnar(raw):
+        return RunTracker.from_state_dict(raw)
+    return RunTracker.from_diaries(raw)
+
+
+def load_diaries(path, map_location='cpu'):
+    """ Loads raw_data.pkl as a list of Diaries, whichever format it was saved in """
+    raw = torch.load(open(path, 'rb'), map_location=map_location, weights_only=False)
+    if is_columnar(raw):
+        return RunTracker.from_state_dict(raw).diaries()
+    return raw
+
+
+def convert_raw_data(path, out_path, image_dtype='float32', image_fields=DIARY_IMAGES + PAGE_IMAGES):
+    """ Rewrites an old raw_data.pkl (list of Diaries) in the columnar format """
+    RunTracker.from_diaries(load_diaries(path), image_dtype, image_fields).save(out_path)